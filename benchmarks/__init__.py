@@ -0,0 +1,4 @@
+# Benchmarks for py2scala.  corpus generates synthetic Python input and
+# harness measures conversion speed and memory use on it; the bench_*.py
+# scripts are standalone benchmarks for particular parts of the conversion,
+# and differential checks that two versions of py2scala convert identically.
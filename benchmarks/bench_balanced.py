@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Regression checks for the balanced-expression rewrites of _modline()
+# (comprehensions, 'in' -> 'contains', len() -> .length and, with -b,
+# brackets -> parens).  These used to be done with nested regexps that could
+# only handle two levels of nesting, and that backtracked so much on some
+# long fragments that converting a single line could take seconds or more.
+#
+# Usage: bench_balanced.py [SIZE]
+#
+# Checks the results of the rewrites on some small fragments, then runs them
+# on pathological fragments of about SIZE characters (default 20000), each of
+# which must be converted within a time limit.  Prints the time taken for
+# each, and exits with a nonzero status if anything fails.
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import py2scala
+
+# (FUNCTION, FRAGMENT, EXPECTED RESULT)
+cases = [
+  (py2scala.convert_comprehension, '[x for x in y]', '(for (x <- y) yield x)'),
+  (py2scala.convert_comprehension, 'f([g(x) for (x, y) in z.items()])',
+   'f((for ((x, y) <- z.items()) yield g(x)))'),
+  (py2scala.convert_comprehension, '[f(g(h(x))) for x in a[b[c[0]]]]',
+   '(for (x <- a[b[c[0]]]) yield f(g(h(x))))'),
+  (py2scala.convert_comprehension, '[x for x in y', '[x for x in y'),
+  (py2scala.convert_contains, 'if x in y:', 'if y contains x:'),
+  (py2scala.convert_contains, 'x in y and z in w', 'y contains x and w contains z'),
+  (py2scala.convert_contains, 'a(b[c(0)]) in d', 'd contains a(b[c(0)])'),
+  (py2scala.convert_contains, 'f(x in y) in z', 'z contains f(x in y)'),
+  (py2scala.convert_len, 'len(x) + len(y[0])', 'x.length + y[0].length'),
+  (py2scala.convert_len, 'len(f(g(h(x))))', 'f(g(h(x))).length'),
+  (py2scala.convert_len, 'len(len(x))', 'len(x).length'),
+  (py2scala.convert_len, 'len()', 'len()'),
+  (py2scala.convert_brackets, 'a[i] + Array[Int] + [1, 2]',
+   'a(i) + Array[Int] + [1, 2]'),
+  (py2scala.convert_brackets, 'a[b[c[d[0]]]]', 'a(b[c[d[0]]])'),
+  (py2scala.convert_brackets, 'a[]', 'a[]'),
+]
+
+# (NAME, FUNCTION, FRAGMENT OF ABOUT SIZE CHARACTERS, TIME LIMIT IN SECONDS)
+def pathological(size):
+  n = size // 10
+  return [
+    # The old regexps took cubic time on this
+    ('comprehension', py2scala.convert_comprehension,
+     '(' + 'a for b in c ' * (size // 13), 2.0),
+    ('comprehension nested', py2scala.convert_comprehension,
+     '[' * n + 'x for x in y' + ']' * n, 2.0),
+    # ... and quadratic time on these
+    ('contains', py2scala.convert_contains, 'a' * size + ' ix', 2.0),
+    ('contains groups', py2scala.convert_contains,
+     'x in ' + '[a](b)' * (size // 6), 2.0),
+    ('len', py2scala.convert_len, 'len(' + '(a)' * (size // 3), 2.0),
+    ('len nested', py2scala.convert_len,
+     'len(' + 'f(' * n + ')' * n + ')', 2.0),
+    ('brackets', py2scala.convert_brackets, 'a[' * (size // 2), 2.0),
+  ]
+
+def main():
+  size = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  failures = 0
+  for (fun, text, expected) in cases:
+    result = fun(text)
+    if result != expected:
+      print("FAIL: %s(%r) gave %r, expected %r" % (
+        fun.__name__, text, result, expected))
+      failures += 1
+  for (name, fun, text, limit) in pathological(size):
+    start = time.time()
+    fun(text)
+    elapsed = time.time() - start
+    print("%-22s %7d chars %8.3fs" % (name, len(text), elapsed))
+    if elapsed > limit:
+      print("FAIL: %s took more than %.1fs" % (name, limit))
+      failures += 1
+  if failures:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# Benchmark for checking whether conversion would change files (see --check
+# and py2scala.check_lines()).
+#
+# Usage: bench_check.py [OPTIONS] [FILE ...]
+#
+# Takes the FILEs (default: the corpus generated by corpus.py, and the Python
+# files in the standard library directory containing `os') as they are, and
+# as converted already by a first conversion, and for each set prints the
+# best of several runs of converting every file in full, of checking every
+# file, and of checking them again with a warm --cache-dir cache, along with
+# how many files would change.  Checking stops at the first change, so it
+# should take much less time than converting for the files as they are; the
+# converted files mostly convert to themselves, so checking them takes a full
+# conversion the first time, and a lookup in the cache after that.  OPTIONS
+# are the conversion options of py2scala, used for the conversions and
+# checks (e.g. -2); the first conversion uses none.
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import py2scala
+from benchmarks import corpus
+from benchmarks import harness
+
+def convert_all(options, sources):
+  converter = py2scala.Converter(options)
+  return [list(converter.convert_lines(lines)) for (lines, data) in sources]
+
+def check_all(options, sources, cache=None):
+  return [py2scala.check_lines(options, lines, data, cache)
+          for (lines, data) in sources]
+
+def bench(name, options, sources):
+  nlines = sum(len(lines) for (lines, data) in sources)
+  (convtime, converted) = harness.best_time(convert_all, options, sources)
+  expected = [py2scala.first_change(lines, outlines)
+              for ((lines, data), outlines) in zip(sources, converted)]
+  (checktime, changes) = harness.best_time(check_all, options, sources)
+  cachedir = tempfile.mkdtemp(prefix='py2scala-cache')
+  try:
+    cache = py2scala.ConversionCache(cachedir, 1024 * 1024 * 1024)
+    check_all(options, sources, cache)
+    (cachedtime, cachedchanges) = harness.best_time(check_all, options,
+                                                    sources, cache)
+  finally:
+    shutil.rmtree(cachedir)
+  if changes != expected or cachedchanges != expected:
+    print("MISMATCH: checking %s gives different lines from converting" % name)
+    sys.exit(1)
+  print("%s: %d files, %d lines, %d would change" % (
+    name, len(sources), nlines, len(sources) - changes.count(None)))
+  for (what, elapsed) in [('convert', convtime), ('check', checktime),
+                          ('check, cached', cachedtime)]:
+    print("  %-14s %8.3f s %8.2f us/line" % (what, elapsed,
+                                             elapsed * 1e6 / nlines))
+
+def read_sources(paths):
+  sources = []
+  for path in paths:
+    data = open(path, 'rb').read()
+    sources.append((py2scala.split_lines(data), data))
+  return sources
+
+def converted_sources(sources):
+  (options, _) = py2scala.parse_args([])
+  converter = py2scala.Converter(options)
+  result = []
+  for (lines, data) in sources:
+    outlines = list(converter.convert_lines(lines))
+    data = py2scala.encode_output(''.join(line + '\n' for line in outlines))
+    result.append((outlines, data))
+  return result
+
+# Return the SOURCES that convert using OPTIONS without an error (some
+# converted files trip up the conversion), and the number left out.
+def convertible(options, sources):
+  result = []
+  for (lines, data) in sources:
+    try:
+      list(py2scala.Converter(options).convert_lines(lines))
+    except Exception:
+      continue
+    result.append((lines, data))
+  return (result, len(sources) - len(result))
+
+def bench_sources(name, options, sources):
+  for (setname, setsources) in [(name, sources),
+                                (name + ' converted',
+                                 converted_sources(sources))]:
+    (setsources, skipped) = convertible(options, setsources)
+    if skipped:
+      print("%s: leaving out %d files whose conversion fails" % (setname,
+                                                                  skipped))
+    bench(setname, options, setsources)
+
+def main():
+  (options, paths) = py2scala.parse_args()
+  if paths:
+    bench_sources('files', options, read_sources(paths))
+    return
+  tmpdir = tempfile.mkdtemp(prefix='py2scala-corpus')
+  try:
+    bench_sources('corpus', options, read_sources(corpus.generate(tmpdir)))
+  finally:
+    shutil.rmtree(tmpdir)
+  bench_sources('stdlib', options, read_sources(harness.stdlib_paths()))
+
+if __name__ == '__main__':
+  main()
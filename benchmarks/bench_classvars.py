@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+# Benchmark for classes with very many class variables and self.*
+# variables.  Each of these gets moved into the companion object or out of
+# __init__() as it is seen, along with the comments before it, which used
+# to mean renumbering every line reference held for the class each time.
+#
+# Usage: bench_classvars.py [NUMVARS ...]
+#
+# For each NUMVARS (default 1000 2000 5000 10000), converts a generated class
+# with NUMVARS commented class variables and NUMVARS/10 commented self.*
+# variables set in __init__(), and prints the time taken.  The time should
+# grow linearly with NUMVARS.
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import py2scala
+
+def classvars_source(numvars):
+  '''Return the lines of a class with NUMVARS class variables and
+NUMVARS/10 self.* variables.'''
+  lines = ['class Big(object):']
+  for i in range(numvars):
+    lines += ['  # Constant number %d' % i, '  C%d = %d' % (i, i)]
+  lines += ['', '  def __init__(self, a):']
+  for i in range(numvars // 10):
+    lines += ['    # Attribute number %d' % i, '    self.a%d = a + %d' % (i, i)]
+  lines += ['', '  def get(self):', '    return self.a0']
+  return lines
+
+def main():
+  sizes = [int(x) for x in sys.argv[1:]] or [1000, 2000, 5000, 10000]
+  converter = py2scala.Converter()
+  for numvars in sizes:
+    source = classvars_source(numvars)
+    start = time.time()
+    outlines = sum(1 for line in converter.convert_lines(source))
+    elapsed = time.time() - start
+    print("%6d vars: %7d lines in, %7d lines out, %8.3fs" % (
+      numvars, len(source), outlines, elapsed))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# Benchmark for converting source archives directly (see
+# py2scala.convert_archive_tree()) and for writing output in blocks.
+#
+# Usage: bench_io.py [--copies N] [--jobs N] [DIR]
+#
+# Packs the Python files under DIR (default: the standard library directory
+# containing `os') N times over (default 1) into a .tar.gz archive, then
+# converts it to a .tar.gz archive of Scala files in two ways: by unpacking
+# it to disk, converting the directory tree and packing the result, and by
+# converting the archive directly.  Checks that both give the same files and
+# prints the time each took.  Also times writing the converted lines to
+# /dev/null with one print statement per line and with write_chunked().
+
+from __future__ import print_function
+
+import optparse
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import py2scala
+
+def make_archive(path, srcdir, copies):
+  archive = tarfile.open(path, 'w:gz')
+  count = 0
+  for n in range(copies):
+    for (srcpath, dstpath) in py2scala.tree_files(srcdir, srcdir):
+      name = 'copy%d/%s' % (n, os.path.relpath(srcpath, srcdir))
+      archive.add(srcpath, name)
+      count += 1
+  archive.close()
+  return count
+
+def archive_contents(path):
+  archive = tarfile.open(path)
+  contents = dict((member.name, archive.extractfile(member).read())
+                  for member in archive if member.isfile())
+  archive.close()
+  return contents
+
+def main():
+  parser = optparse.OptionParser(usage="%prog [--copies N] [--jobs N] [DIR]")
+  parser.add_option("--copies", type="int", default=1,
+                    help="Number of copies of DIR to pack (default %default).")
+  parser.add_option("--jobs", type="int",
+                    help="Number of worker processes (default one per CPU).")
+  (opts, args) = parser.parse_args()
+  srcdir = args and args[0] or os.path.dirname(os.__file__)
+  (options, _) = py2scala.parse_args([])
+  tmpdir = tempfile.mkdtemp(prefix='py2scala-io')
+  try:
+    srcarchive = os.path.join(tmpdir, 'src.tar.gz')
+    count = make_archive(srcarchive, srcdir, opts.copies)
+    size = os.path.getsize(srcarchive)
+
+    start = time.time()
+    unpacked = os.path.join(tmpdir, 'src')
+    converted = os.path.join(tmpdir, 'dst')
+    archive = tarfile.open(srcarchive)
+    archive.extractall(unpacked)
+    archive.close()
+    py2scala.convert_tree(options, unpacked, converted, opts.jobs)
+    viadisk = os.path.join(tmpdir, 'viadisk.tar.gz')
+    archive = tarfile.open(viadisk, 'w:gz')
+    for (srcpath, dstpath) in py2scala.tree_files(unpacked, converted):
+      archive.add(dstpath, os.path.relpath(dstpath, converted))
+    archive.close()
+    disktime = time.time() - start
+
+    start = time.time()
+    direct = os.path.join(tmpdir, 'direct.tar.gz')
+    py2scala.convert_tree(options, srcarchive, direct, opts.jobs)
+    directtime = time.time() - start
+
+    contents = archive_contents(direct)
+    if contents != archive_contents(viadisk):
+      print("MISMATCH: converting the archive directly gives different files")
+      sys.exit(1)
+    lines = []
+    for name in sorted(contents):
+      lines += py2scala.split_lines(contents[name])
+    outfile = py2scala.open_output(os.devnull)
+    start = time.time()
+    for line in lines:
+      print(line, file=outfile)
+    printtime = time.time() - start
+    start = time.time()
+    py2scala.write_chunked(outfile, lines)
+    chunkedtime = time.time() - start
+    outfile.close()
+  finally:
+    shutil.rmtree(tmpdir)
+  print("%d files, %.1f MB compressed" % (count, size / 1e6))
+  print("unpack, convert tree, pack: %7.2f s" % disktime)
+  print("convert archive directly:   %7.2f s" % directtime)
+  print("writing %d lines: print %.1f ms, write_chunked() %.1f ms" % (
+    len(lines), printtime * 1000, chunkedtime * 1000))
+
+if __name__ == '__main__':
+  main()
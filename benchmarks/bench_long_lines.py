@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# Benchmark for very long logical lines (see --max-logical-lines).
+#
+# Usage: bench_long_lines.py [OPTIONS]
+#
+# Converts generated files of increasing size made of one very long logical
+# line: a big list literal, a def with a long argument list (with and
+# without a Python 3 return annotation, which definere can't match) and a
+# stray left paren with the rest of the file after it.  Prints the best of
+# several runs of each in microseconds per line, which should stay about the
+# same as the size grows.  The stray paren is converted both without a limit
+# on the length of logical lines and with --max-logical-lines (default 100
+# here), and the other files are checked to convert the same with the limit
+# as without it when the limit is above the length of their long line.
+# OPTIONS are the conversion options of py2scala.
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import py2scala
+from benchmarks import harness
+
+# Numbers of lines in the long logical line
+sizes = [2000, 5000, 10000, 20000]
+
+# Ordinary code following the long line
+tail = '''
+class Foo(object):
+  def bar(self, x):
+    total = 0
+    for y in x:
+      if y > 1:
+        total += y
+    return total
+'''.split('\n')
+
+def list_literal(size):
+  return (['values = ['] + ['  %d, "item %d",' % (i, i) for i in range(size)]
+          + [']'] + tail)
+
+def def_header(size):
+  return (['def f('] + ['    arg%d=%d,' % (i, i) for i in range(size)]
+          + ['    last):', '  return last'] + tail)
+
+def annotated_def_header(size):
+  return (['def f('] + ['    arg%d: int = %d,' % (i, i) for i in range(size)]
+          + ['    last) -> int:', '  return last'] + tail)
+
+def stray_paren(size):
+  lines = ['print(foo(1, 2)']
+  while len(lines) < size:
+    lines += tail
+  return lines
+
+def convert(options, lines):
+  converter = py2scala.Converter(options)
+  return (list(converter.convert_lines(lines)), converter.warnings)
+
+def main():
+  (options, paths) = py2scala.parse_args()
+  limit = options.max_logical_lines or 100
+  print("%-22s %7s %10s %10s %9s" % ("file", "lines", "us/line", "limited",
+                                    "warnings"))
+  for (name, generate) in [('list literal', list_literal),
+                           ('def header', def_header),
+                           ('annotated def header', annotated_def_header),
+                           ('stray paren', stray_paren)]:
+    for size in sizes:
+      lines = generate(size)
+      options.max_logical_lines = None
+      (plaintime, plain) = harness.best_time(convert, options, lines)
+      options.max_logical_lines = (limit if generate is stray_paren
+                                   else size + 2)
+      (limitedtime, limited) = harness.best_time(convert, options, lines)
+      if generate is not stray_paren and limited != plain:
+        print("MISMATCH: %s of %d lines converts differently with a limit" % (
+          name, size))
+        sys.exit(1)
+      print("%-22s %7d %10.2f %10.2f %4d %4d" % (
+        name, len(lines), plaintime * 1e6 / len(lines),
+        limitedtime * 1e6 / len(lines), len(plain[1]), len(limited[1])))
+
+if __name__ == '__main__':
+  main()
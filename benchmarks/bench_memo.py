@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+# Benchmark for the memo of code fragment rewrites (see
+# py2scala.FragmentMemo).
+#
+# Usage: bench_memo.py [OPTIONS] [FILE ...]
+#
+# Converts the FILEs (default: the corpus generated by corpus.py, and the
+# Python files in the standard library directory containing `os') with and
+# without the memo, checks that the output is identical, and prints the best
+# of several runs of each, along with how often code was found in the memo.
+# OPTIONS are the conversion options of py2scala; --memo-size sets the size
+# of the memo.
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import py2scala
+from benchmarks import corpus
+from benchmarks import harness
+
+def convert(options, lines):
+  converter = py2scala.Converter(options)
+  return (list(converter.convert_lines(lines)), converter.memo)
+
+def bench(name, options, lines):
+  memo_size = options.memo_size
+  options.memo_size = 0
+  (plaintime, (plainresult, _)) = harness.best_time(convert, options, lines)
+  options.memo_size = memo_size
+  (memotime, (memoresult, memo)) = harness.best_time(convert, options,
+                                                      lines)
+  if plainresult != memoresult:
+    print("MISMATCH: the memo gives different output for %s" % name)
+    sys.exit(1)
+  lookups = memo.hits + memo.misses
+  print("%s: %d lines" % (name, len(lines)))
+  print("  no memo:  %6.2f us/line" % (plaintime * 1e6 / len(lines)))
+  print("  memo:     %6.2f us/line (%d lookups, %.1f%% hits)" % (
+    memotime * 1e6 / len(lines), lookups,
+    100.0 * memo.hits / max(lookups, 1)))
+
+def main():
+  (options, paths) = py2scala.parse_args()
+  if not options.memo_size:
+    options.memo_size = py2scala.default_memo_size
+  if paths:
+    bench('files', options, harness.read_lines(paths))
+    return
+  tmpdir = tempfile.mkdtemp(prefix='py2scala-corpus')
+  try:
+    bench('corpus', options, harness.read_lines(corpus.generate(tmpdir)))
+  finally:
+    shutil.rmtree(tmpdir)
+  bench('stdlib', options, harness.read_lines(harness.stdlib_paths()))
+
+if __name__ == '__main__':
+  main()
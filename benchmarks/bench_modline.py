@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Micro-benchmark for the keyword rules that _modline() applies to each code
+# fragment (or -> ||, not -> !, pass -> (), self. removal and so on).  These
+# used to be done by one re.sub() per rule; now they are done by a combined
+# pass per WordRules table.
+#
+# Usage: bench_modline.py [OPTIONS] [FILE ...]
+#
+# Splits the lines of each FILE (default: the Python files in the standard
+# library directory containing `os') into code fragments the way
+# _modline() does, applies the rules both ways to every fragment, checks that
+# the results are identical, and prints the cost per source line of each.
+# OPTIONS are the conversion options of py2scala, e.g. -r to remove self.
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import py2scala
+from benchmarks import harness
+
+# The rules as they were applied before, one re.sub() at a time
+def sequential_rules(vv, prev, scala, remove_self):
+  vv = re.sub(r'\bor\b', '||', vv)
+  vv = re.sub(r'\band\b', '&&', vv)
+  vv = re.sub(r'\bTrue\b', 'true', vv)
+  vv = re.sub(r'\bFalse\b', 'false', vv)
+  if not scala:
+    vv = re.sub(r'\bNone\b', 'null', vv)
+  vv = re.sub(r'\bnot ', '!', vv)
+  vv = re.sub(r'\bpass\b', '()', vv)
+  if prev and prev[0] in py2scala.single_quote_delims:
+    vv = re.sub(r'^( +)%( +)', r'\1format\2', vv)
+  if remove_self:
+    vv = re.sub(r'\bself\.', '', vv)
+    vv = re.sub(r'\bself\b', 'this', vv)
+    vv = re.sub(r'\bcls\.', '', vv)
+  return vv
+
+# The rules as _modline() applies them now
+def combined_rules(vv, prev, rules):
+  vv = rules.keyword_rules.sub(vv)
+  if prev and prev[0] in py2scala.single_quote_delims:
+    vv = re.sub(r'^( +)%( +)', r'\1format\2', vv)
+  return rules.statement_rules.sub(vv)
+
+def fragments(paths, rules):
+  '''Return the number of lines in the files in PATHS, and a list of
+(FRAGMENT, PREV) for the code fragments in them.'''
+  numlines = 0
+  frags = []
+  for line in harness.read_lines(paths):
+    numlines += 1
+    split = rules.stringre.split(line.rstrip('\r\n').expandtabs())
+    for i in range(0, len(split), 2):
+      if split[i]:
+        frags.append((split[i], split[i-1] if i > 0 else None))
+  return (numlines, frags)
+
+def timeit(fun, frags, *args):
+  start = time.time()
+  results = [fun(vv, prev, *args) for (vv, prev) in frags]
+  return (time.time() - start, results)
+
+def main():
+  (options, paths) = py2scala.parse_args()
+  if not paths:
+    paths = harness.stdlib_paths()
+  rules = py2scala.get_rules(options)
+  (numlines, frags) = fragments(paths, rules)
+  (seqtime, seqresults) = timeit(sequential_rules, frags, rules.scala,
+                                 rules.remove_self)
+  (combtime, combresults) = timeit(combined_rules, frags, rules)
+  if seqresults != combresults:
+    print("MISMATCH: combined rules give different results")
+    sys.exit(1)
+  print("%d lines, %d code fragments" % (numlines, len(frags)))
+  print("sequential: %6.2f us/line" % (seqtime * 1e6 / numlines))
+  print("combined:   %6.2f us/line" % (combtime * 1e6 / numlines))
+
+if __name__ == '__main__':
+  main()
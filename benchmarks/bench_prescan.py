@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+# Benchmark for the --prescan front-end, which lexes a whole file up front
+# (see py2scala.Prescan) instead of splitting each line as it is converted.
+#
+# Usage: bench_prescan.py [OPTIONS] [FILE ...]
+#
+# Converts each FILE (default: the Python files in the standard library
+# directory containing `os') with and without prescan, checks that the
+# output is identical, and prints the best of several runs of each, along
+# with the time taken by the prescan alone.  OPTIONS are the conversion
+# options of py2scala, e.g. -s for the Scala lexing rules.
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import py2scala
+from benchmarks import harness
+
+def convert(options, lines):
+  return list(py2scala.Converter(options).convert_lines(lines))
+
+def main():
+  (options, paths) = py2scala.parse_args()
+  lines = harness.read_lines(paths or harness.stdlib_paths())
+  options.prescan = False
+  (plaintime, plainresult) = harness.best_time(convert, options, lines)
+  options.prescan = True
+  (prescantime, prescanresult) = harness.best_time(convert, options, lines)
+  (scantime, scan) = harness.best_time(py2scala.Prescan,
+                                       py2scala.get_rules(options), lines)
+  if plainresult != prescanresult:
+    print("MISMATCH: prescan gives different output")
+    sys.exit(1)
+  print("%d lines" % len(lines))
+  print("per line: %6.2f us/line" % (plaintime * 1e6 / len(lines)))
+  print("prescan:  %6.2f us/line (scan alone %.2f us/line)" % (
+    prescantime * 1e6 / len(lines), scantime * 1e6 / len(lines)))
+
+if __name__ == '__main__':
+  main()
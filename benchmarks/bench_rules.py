@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# Benchmark for user-defined rewrite rules (see --rule-file and
+# py2scala.UserRules).
+#
+# Usage: bench_rules.py [OPTIONS] [FILE ...]
+#
+# Converts the FILEs (default: Python files from the standard library
+# directory containing `os', about 16,000 lines' worth) with 0 to 500
+# generated rules, a few of which match real code (e.g. range( and
+# .iteritems()) and the rest library call renames that don't occur.  For
+# each number of rules, prints the best of several runs of the whole
+# conversion, and the time taken by the rules alone on the code fragments of
+# the input, both through the trigger index and by trying every rule on
+# every fragment in turn (as a series of re.sub() calls in _modline()
+# would).  Also checks that the conversion is the same without the memo of
+# code fragment rewrites (see --memo-size) as with it; one of the rules is
+# anchored with ^, so must not match indented code, and on Python 3 another
+# ignores case in a group.  OPTIONS are the conversion options of py2scala.
+
+from __future__ import print_function
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import py2scala
+from benchmarks import harness
+
+# Numbers of rules to time
+rule_counts = [0, 10, 50, 100, 250, 500]
+
+# Rules that match code in the standard library
+real_rules = [
+  (r'\bxrange\(', 'range('),
+  (r'(\w+)\.iteritems\(\)', r'\1.iterator'),
+  (r'\bos\.path\.join\(', 'Paths.get('),
+  (r'\.has_key\(', '.contains('),
+  (r'\bsys\.stderr\.write\(', 'System.err.print('),
+  # Only imports at the top level, not the ones inside functions
+  (r'^import (\w+)$', r'import \1._'),
+]
+if py2scala.py3:
+  # Ignores case in part, so mustn't be triggered by "none" (scoped flags
+  # are new in Python 3)
+  real_rules.append((r'\b(?i:none)\b', 'null'))
+
+def make_rules(count):
+  rules = real_rules[:count]
+  for i in range(count - len(rules)):
+    rules.append((r'\bmylib%d\.call_%d\(' % (i % 37, i), r'MyLib%d.call%d(' %
+                  (i % 37, i)))
+  return tuple(rules)
+
+def convert(options, lines):
+  return list(py2scala.Converter(options).convert_lines(lines))
+
+def indexed(userrules, fragments):
+  return [userrules.sub(text) for text in fragments]
+
+def sequential(userrules, fragments):
+  result = []
+  for text in fragments:
+    for rule in userrules.rules:
+      text = rule.sub(text)
+    result.append(text)
+  return result
+
+def main():
+  (options, paths) = py2scala.parse_args()
+  if not paths:
+    paths = harness.stdlib_paths(['decimal.py', 'inspect.py', 'pydoc.py',
+                                  'argparse.py', 'tarfile.py', 'ftplib.py'])
+  lines = harness.read_lines(paths)
+  # The code fragments of the lines (roughly, since multi-line strings
+  # aren't followed from line to line)
+  stringre = py2scala.get_rules(options).stringre
+  fragments = [text for line in lines for text in stringre.split(line)[0::2]
+               if text]
+  print("%d lines, %d code fragments" % (len(lines), len(fragments)))
+  print("%6s %14s %18s %18s" % ("rules", "convert us/line", "indexed us/frag",
+                                "sequential us/frag"))
+  for count in rule_counts:
+    options.user_rules = make_rules(count)
+    (convtime, converted) = harness.best_time(convert, options, lines)
+    memo_size = options.memo_size
+    options.memo_size = 0
+    if convert(options, lines) != converted:
+      print("MISMATCH: the memo gives different output with %d rules" % count)
+      sys.exit(1)
+    options.memo_size = memo_size
+    if count:
+      userrules = py2scala.UserRules(options.user_rules)
+      (indextime, indexresult) = harness.best_time(indexed, userrules,
+                                                   fragments)
+      (seqtime, seqresult) = harness.best_time(sequential, userrules,
+                                               fragments)
+      if indexresult != seqresult:
+        print("MISMATCH: indexed rules give different results")
+        sys.exit(1)
+    else:
+      indextime = seqtime = 0
+    print("%6d %14.2f %18.2f %18.2f" % (
+      count, convtime * 1e6 / len(lines), indextime * 1e6 / len(fragments),
+      seqtime * 1e6 / len(fragments)))
+
+if __name__ == '__main__':
+  main()
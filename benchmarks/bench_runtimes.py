@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+# Benchmark comparing Python runtimes (CPython 2 and 3, PyPy) for running
+# py2scala, to choose the fastest one for converting in bulk.
+#
+# Usage: bench_runtimes.py [OPTIONS] [FILE ...]
+#
+# Converts the FILEs (default: the corpus generated by corpus.py) with each
+# of the Python interpreters given with --python (default: the one running
+# this script, and python2, python3, pypy and pypy3 if they are on the PATH).
+# First it checks that py2scala writes exactly the same output and warnings
+# on each interpreter, for each of the option sets in harness.modes.  Then it
+# times the conversion with harness.py, each interpreter and option set in a
+# process of its own.  It prints the lines per second and peak memory use for
+# each, and the speed relative to the first interpreter.  Interpreters too
+# old to run py2scala are left out, with a note.  PyPy's JIT takes a while to
+# warm up, so give it a bigger --repeat or --scale than CPython needs.  Run
+# with --help for the options.
+
+from __future__ import print_function
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+topdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, topdir)
+from benchmarks import corpus
+from benchmarks import harness
+
+script = os.path.join(topdir, 'py2scala.py')
+
+# Interpreters tried by default if they are on the PATH, after the one
+# running this script
+default_pythons = ['python2', 'python3', 'pypy', 'pypy3']
+
+# Prints the implementation and version of the interpreter running it, and
+# whether it can run py2scala (Python 2.7, or 3.7 and up)
+describe_code = '''
+import platform, sys
+print("%s %s" % (platform.python_implementation(), platform.python_version()))
+print((2, 7) <= sys.version_info < (3,) or sys.version_info >= (3, 7))
+'''
+
+def find_program(name):
+  '''Return the path of the program NAME on the PATH, or None.'''
+  for directory in os.environ.get('PATH', '').split(os.pathsep):
+    path = os.path.join(directory, name)
+    if os.path.isfile(path) and os.access(path, os.X_OK):
+      return path
+  return None
+
+def describe(python):
+  '''Return (NAME, SUPPORTED) for the Python interpreter PYTHON (a command),
+where NAME is its implementation and version, or None if it doesn't run.'''
+  try:
+    process = subprocess.Popen([python, '-c', describe_code],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  except OSError:
+    return (None, False)
+  output = process.communicate()[0].decode('ascii', 'replace').split('\n')
+  if process.returncode or len(output) < 2:
+    return (None, False)
+  return (output[0], output[1] == 'True')
+
+def interpreters(pythons):
+  '''Return (NAME, PYTHON) for each of the interpreters PYTHONS that can run
+py2scala (default: see default_pythons), leaving out the same interpreter
+found twice.'''
+  if not pythons:
+    pythons = [sys.executable] + [path for path in map(find_program,
+                                                        default_pythons)
+                                  if path]
+  result = []
+  seen = set()
+  for python in pythons:
+    real = os.path.realpath(find_program(python) or python)
+    if real in seen:
+      continue
+    seen.add(real)
+    (name, supported) = describe(python)
+    if name is None:
+      print("%s: doesn't run, left out" % python)
+    elif not supported:
+      print("%s: %s can't run py2scala, left out" % (python, name))
+    else:
+      result.append((name, python))
+  return result
+
+def convert(python, args, paths):
+  '''Run py2scala with the interpreter PYTHON and the options ARGS on PATHS,
+and return its (OUTPUT, WARNINGS, STATUS), the output being bytes.'''
+  process = subprocess.Popen([python, script] + args + paths,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  (output, warnings) = process.communicate()
+  return (output, warnings, process.returncode)
+
+# Return the number of the first line that differs between the bytes A and
+# B.
+def first_different_line(a, b):
+  alines = a.split(b'\n')
+  blines = b.split(b'\n')
+  for i in range(min(len(alines), len(blines))):
+    if alines[i] != blines[i]:
+      return i + 1
+  return min(len(alines), len(blines)) + 1
+
+def check_same(pythons, paths):
+  '''Check that py2scala converts PATHS the same with each of PYTHONS, a
+list of (NAME, PYTHON), for each option set.  Returns whether they do,
+printing the first difference if not.'''
+  for (mode, args) in harness.modes:
+    (refname, refpython) = pythons[0]
+    reference = convert(refpython, args, paths)
+    for (name, python) in pythons[1:]:
+      result = convert(python, args, paths)
+      for (what, index) in [('output', 0), ('warnings', 1)]:
+        if result[index] != reference[index]:
+          print("MISMATCH: %s %s differ from %s at line %d with options %s" % (
+            name, what, refname,
+            first_different_line(reference[index], result[index]), mode))
+          return False
+      if result[2] != reference[2]:
+        print("MISMATCH: %s exits with status %d, %s with %d, with options %s"
+              % (name, result[2], refname, reference[2], mode))
+        return False
+  return True
+
+def main():
+  parser = optparse.OptionParser(usage="%prog [OPTIONS] [FILE ...]")
+  parser.add_option("--python", action="append", metavar="COMMAND",
+                    help="""Compare the Python interpreter COMMAND (e.g.
+pypy3 or /usr/bin/python3.11).  Can be given more than once; the speed of
+the others is given relative to the first.""")
+  parser.add_option("--scale", type="int", default=1,
+                    help="""Scale of the generated corpus, if no FILEs are
+given (default %default).""")
+  parser.add_option("--repeat", type="int", default=3,
+                    help="""Number of times to convert each file, taking the
+best time (default %default).""")
+  (options, paths) = parser.parse_args()
+  pythons = interpreters(options.python)
+  if not pythons:
+    print("No interpreter to compare")
+    sys.exit(1)
+  tmpdir = None
+  if not paths:
+    tmpdir = tempfile.mkdtemp(prefix='py2scala-corpus')
+    paths = corpus.generate(tmpdir, options.scale)
+  try:
+    if not check_same(pythons, paths):
+      sys.exit(1)
+    print("Same output on %s" % ', '.join(name for (name, python) in pythons))
+    print("%-17s %-24s %10s %8s %10s" % ("mode", "python", "lines/sec",
+                                         "relative", "peak RSS"))
+    for (mode, args) in harness.modes:
+      first = None
+      for (name, python) in pythons:
+        result = harness.run_mode_process(args, paths, options.repeat, python)
+        speed = result['lines_per_sec']
+        if first is None:
+          first = speed
+        print("%-17s %-24s %10.0f %7.2fx %7d KB" % (
+          mode, name, speed, speed / first, result['peak_rss_kb']))
+  finally:
+    if tmpdir:
+      shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+  main()
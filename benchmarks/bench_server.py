@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# Benchmark for the per-request latency of --server, compared with running
+# py2scala.py once per file.
+#
+# Usage: bench_server.py [OPTIONS] [FILE ...]
+#
+# Converts each FILE (default: a selection of typical modules from the
+# standard library directory containing `os') by sending requests one at a
+# time to a server reading stdin, and by running the program on it, and
+# checks that the output is the same.  Prints the average time per file of
+# each, along with the time the conversion itself takes in a warm process,
+# so that what is left is the overhead of the request.  OPTIONS are the
+# conversion options of py2scala, passed to both.
+
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import py2scala
+from benchmarks import harness
+
+script = os.path.splitext(os.path.abspath(py2scala.__file__))[0] + '.py'
+
+# Number of times to convert each file
+runs = 5
+
+def main():
+  (options, paths) = py2scala.parse_args()
+  args = [arg for arg in sys.argv[1:] if arg not in paths]
+  if not paths:
+    paths = harness.stdlib_paths(['shlex.py', 'glob.py', 'Queue.py',
+                                  'base64.py', 'textwrap.py', 'netrc.py',
+                                  'sched.py', 'fnmatch.py'])
+  lines = len(harness.read_lines(paths))
+  server = subprocess.Popen([sys.executable, script, '--server', '-j', '1'] +
+                            args, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+  # Each way of converting is timed in a loop of its own, so that they
+  # don't disturb each other's caches
+  outputs = {}
+  start = time.time()
+  for n in range(runs):
+    for path in paths:
+      outputs[path] = subprocess.Popen([sys.executable, script] + args +
+                                       [path], stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE).communicate()[0]
+  processtime = time.time() - start
+  start = time.time()
+  for n in range(runs):
+    for path in paths:
+      request = json.dumps({'id': path, 'path': path}) + '\n'
+      server.stdin.write(request.encode('ascii'))
+      server.stdin.flush()
+      response = json.loads(server.stdout.readline())
+      if 'error' in response or response['output'].encode(
+          response.get('encoding', 'utf-8')) != outputs[path]:
+        print("MISMATCH: server gives different output for %s" % path)
+        sys.exit(1)
+  servertime = time.time() - start
+  sources = [py2scala.split_lines(open(path, 'rb').read()) for path in paths]
+  start = time.time()
+  for n in range(runs):
+    for source in sources:
+      py2scala.convert_lines_cached(options, source)
+  convtime = time.time() - start
+  server.stdin.close()
+  server.wait()
+  count = runs * len(paths)
+  print("%d files, %d lines on average" % (len(paths), lines // len(paths)))
+  print("one process per file: %7.1f ms/file" % (processtime * 1000 / count))
+  print("server request:       %7.1f ms/file" % (servertime * 1000 / count))
+  print("conversion alone:     %7.1f ms/file" % (convtime * 1000 / count))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+# Benchmark for converting one big file in shards (see --shard-lines and
+# py2scala.convert_sharded()).
+#
+# Usage: bench_shard.py [OPTIONS] [FILE ...]
+#
+# Converts the FILEs (default: the Python files in the standard library
+# directory containing `os'), taken together as one big file, once in a
+# single process and then in shards with 2, 4 and so on up to the number of
+# CPUs worker processes, and prints the best of several runs of each, after
+# checking that the converted lines and the warnings are the same.  OPTIONS
+# are the conversion options of py2scala; --shard-lines sets the size of the
+# shards (default: the number of lines over 4 times the number of CPUs).
+
+from __future__ import print_function
+
+import multiprocessing
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import py2scala
+from benchmarks import harness
+
+def convert(options, lines):
+  converter = py2scala.Converter(options)
+  return (list(converter.convert_lines(lines)), converter.warnings)
+
+def main():
+  (options, paths) = py2scala.parse_args()
+  lines = harness.read_lines(paths or harness.stdlib_paths())
+  cpus = multiprocessing.cpu_count()
+  size = options.shard_lines or len(lines) // (4 * cpus) + 1
+  starts = py2scala.shard_starts(py2scala.get_rules(options), lines, size)
+  print("%d lines, %d shards of at least %d lines, %d CPUs" % (
+    len(lines), len(starts), size, cpus))
+  (serialtime, serial) = harness.best_time(convert, options, lines)
+  print("%8s %10s %8s" % ("jobs", "seconds", "speedup"))
+  print("%8s %10.2f %8s" % ("serial", serialtime, ""))
+  jobs = 2
+  while True:
+    pool = multiprocessing.Pool(jobs)
+    try:
+      (shardtime, sharded) = harness.best_time(py2scala.convert_sharded,
+                                               options, lines, pool, size)
+    finally:
+      pool.close()
+      pool.join()
+    if sharded != serial:
+      print("MISMATCH: sharded conversion differs with %d jobs" % jobs)
+      sys.exit(1)
+    print("%8d %10.2f %7.2fx" % (jobs, shardtime, serialtime / shardtime))
+    if jobs >= cpus:
+      break
+    jobs = min(jobs * 2, cpus)
+
+if __name__ == '__main__':
+  main()
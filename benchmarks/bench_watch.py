@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# Benchmark for the incremental conversion used by --watch (see
+# py2scala.IncrementalConverter).
+#
+# Usage: bench_watch.py [OPTIONS] [FILE ...]
+#
+# Converts the FILEs (default: Python files from the standard library
+# directory containing `os', about 16,000 lines' worth) as a single module,
+# then repeatedly edits a line inside a function somewhere in the module
+# and reconverts it, both incrementally and from scratch.  Checks that the
+# results are the same and prints the average time of each, and the median
+# and maximum time of the incremental conversions.  These depend on the size
+# of the top-level block edited, since a whole class is reconverted when one
+# of its methods changes.  OPTIONS are the conversion options of py2scala.
+
+from __future__ import print_function
+
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import py2scala
+from benchmarks import harness
+
+# Number of edits to time
+edits = 20
+
+def main():
+  (options, paths) = py2scala.parse_args()
+  if not paths:
+    paths = harness.stdlib_paths(['decimal.py', 'inspect.py', 'pydoc.py',
+                                  'argparse.py', 'tarfile.py', 'ftplib.py'])
+  source = harness.read_lines(paths)
+  # Lines inside functions where a statement can be added
+  candidates = [i for (i, line) in enumerate(source)
+                if re.match(r'^        [a-z_]+ = ', line)]
+  if not candidates:
+    print("No lines to edit")
+    sys.exit(1)
+  random.seed(1)
+  inc = py2scala.IncrementalConverter(options)
+  start = time.time()
+  inc.convert(source)
+  firsttime = time.time() - start
+  inctimes = []
+  fulltime = 0
+  for n in range(edits):
+    i = random.choice(candidates)
+    source = source[:i] + [source[i], source[i].rstrip() + '  # edited'] + \
+             source[i + 1:]
+    candidates = [j + (j > i) for j in candidates]
+    start = time.time()
+    result = inc.convert(source)
+    inctimes.append(time.time() - start)
+    start = time.time()
+    conv = py2scala.Converter(options)
+    full = (list(conv.convert_lines(source)), conv.warnings)
+    fulltime += time.time() - start
+    if result != full:
+      print("MISMATCH: incremental conversion differs after edit %d" % n)
+      sys.exit(1)
+  inctimes.sort()
+  print("%d lines, %d segments, the largest %d lines" % (
+    len(source), len(inc.segments), max(seg.size for seg in inc.segments)))
+  print("first conversion:  %7.1f ms" % (firsttime * 1000))
+  print("full reconversion: %7.1f ms/edit" % (fulltime * 1000 / edits))
+  print("incremental:       %7.1f ms/edit (median %.1f ms, max %.1f ms)" % (
+    sum(inctimes) * 1000 / edits, inctimes[edits // 2] * 1000,
+    inctimes[-1] * 1000))
+
+if __name__ == '__main__':
+  main()
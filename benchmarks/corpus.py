@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+# Generator for a synthetic corpus of Python files for benchmarking py2scala.
+#
+# Usage: corpus.py [--scale N] DIR
+#
+# Writes one file per kind of input in kinds (see below) to the directory
+# DIR, creating it if needed.  The files are generated deterministically, so
+# the same scale always gives the same corpus; SCALE (default 1) multiplies
+# their size, which is about 1,500-4,500 lines each at scale 1.
+
+from __future__ import print_function
+
+import optparse
+import os
+
+# Each of the functions below returns the lines of one kind of input, of a
+# size proportional to SCALE.
+
+# Functions with blocks nested DEPTH deep, cycling through the different
+# kinds of block statement.
+def nesting_source(scale=1, depth=12):
+  openers = ['if x%d > 0:', 'for y%d in range(10):', 'while z%d:', 'try:',
+             'with open(f%d) as g:']
+  lines = []
+  for r in range(40 * scale):
+    lines.append('def nested%d(x, y, z):' % r)
+    indent = '  '
+    for d in range(depth):
+      opener = openers[d % len(openers)]
+      if '%d' in opener:
+        opener = opener % d
+      lines.append(indent + opener)
+      indent += '  '
+      lines.append(indent + 'v%d = x + %d' % (d, d))
+      if opener == 'try:':
+        lines.append(indent[:-2] + 'except ValueError, e:')
+        lines.append(indent + 'pass')
+        lines.append(indent[:-2] + 'finally:')
+        lines.append(indent + 'v%d = None' % d)
+    lines.append(indent + 'return v%d' % (depth - 1))
+    lines.append('')
+  return lines
+
+# Functions with docstrings of DOCLINES lines (some of them with quotes,
+# comment signs and keywords in them).
+def docstrings_source(scale=1, doclines=40):
+  lines = []
+  for f in range(60 * scale):
+    lines.append('def documented%d(a, b=None):' % f)
+    lines.append('  """Summary line for function %d.' % f)
+    for d in range(doclines):
+      if d % 7 == 3:
+        lines.append("  Don't treat 'this' or # this as code: if a and not b.")
+      elif d % 11 == 5:
+        lines.append('  Example: x = [i for i in range(%d)] (see "foo").' % d)
+      else:
+        lines.append('  Line %d of the description of the arguments A and B.'
+                     % d)
+    lines.append('  """')
+    lines.append('  if a is None and b is not None:')
+    lines.append('    return b')
+    lines.append('  return a')
+    lines.append('')
+  return lines
+
+# Classes with NUMVARS commented class variables and NUMVARS self.* variables
+# set (and some reset) in __init__().
+def classvars_source(scale=1, numvars=80):
+  lines = []
+  for c in range(10 * scale):
+    lines.append('class Holder%d(object):' % c)
+    for v in range(numvars):
+      lines.append('  # Class variable %d' % v)
+      lines.append('  C%d = %d' % (v, v))
+    lines.append('')
+    lines.append('  def __init__(self, a, b):')
+    for v in range(numvars):
+      lines.append('    # Instance variable %d' % v)
+      lines.append('    self.v%d = a + %d' % (v, v))
+    for v in range(0, numvars, 3):
+      lines.append('    self.v%d += b' % v)
+    lines.append('')
+    lines.append('  def total(self):')
+    lines.append('    t = 0')
+    for v in range(numvars):
+      lines.append('    t += self.v%d * Holder%d.C%d' % (v, c, v))
+    lines.append('    return t')
+    lines.append('')
+  return lines
+
+# Functions with comprehensions, `in' tests and len() calls of WIDTH terms,
+# on one line and spread over several.
+def expressions_source(scale=1, width=12):
+  lines = []
+  for f in range(150 * scale):
+    terms = ' + '.join('foo(a[%d], b[%d])' % (i, i) for i in range(width))
+    tests = ' or '.join('x%d in seq[%d]' % (i, i) for i in range(width))
+    lines.append('def exprs%d(a, b, seq):' % f)
+    lines.append('  r = [%s for x in seq if x not in b]' % terms)
+    lines.append('  s = (len(z) for z in [%s])' %
+                 ', '.join('a[%d]' % i for i in range(width)))
+    lines.append('  if %s:' % tests)
+    lines.append('    return len(r)')
+    lines.append('  t = [x + y')
+    lines.append('       for x in a')
+    lines.append('       for y in b')
+    lines.append('       if x in seq and y not in seq]')
+    lines.append('  return r, s, t')
+    lines.append('')
+  return lines
+
+# Literals of SIZE lines: dicts, lists and multi-line strings.
+def literals_source(scale=1, size=300):
+  lines = []
+  for n in range(12 * scale):
+    kind = n % 3
+    if kind == 0:
+      lines.append('TABLE%d = {' % n)
+      for i in range(size):
+        lines.append("  'key%d': (%d, [%d, %d], None)," % (i, i, i, i + 1))
+      lines.append('}')
+    elif kind == 1:
+      lines.append('LIST%d = [' % n)
+      for i in range(size):
+        lines.append('  ("item %d", %d, True),' % (i, i))
+      lines.append(']')
+    else:
+      lines.append("TEXT%d = '''" % n)
+      for i in range(size):
+        lines.append('Text line %d with "quotes", (parens and [brackets.' % i)
+      lines.append("'''")
+    lines.append('')
+  return lines
+
+# Regions of SIZE lines passed through with the PY2SCALA directives,
+# alternating with ordinary code.
+def passthru_source(scale=1, size=50):
+  lines = []
+  for n in range(40 * scale):
+    lines.append('def before%d(a):' % n)
+    lines.append('  return a and not None')
+    lines.append('')
+    lines.append('# !!PY2SCALA: BEGIN_PASSTHRU')
+    for i in range(size):
+      lines.append('val kept%d = if (a && b) x(%d) else None' % (i, i))
+    lines.append('# !!PY2SCALA: END_PASSTHRU')
+    lines.append('')
+  return lines
+
+# The kinds of input, as (NAME, FUNCTION)
+kinds = [
+  ('nesting', nesting_source),
+  ('docstrings', docstrings_source),
+  ('classvars', classvars_source),
+  ('expressions', expressions_source),
+  ('literals', literals_source),
+  ('passthru', passthru_source),
+]
+
+def generate(directory, scale=1):
+  '''Write the corpus at scale SCALE to DIRECTORY, creating it if needed.
+Returns a list of the paths of the files written.'''
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  paths = []
+  for (name, fun) in kinds:
+    path = os.path.join(directory, name + '.py')
+    outfile = open(path, 'w')
+    try:
+      for line in fun(scale):
+        outfile.write(line + '\n')
+    finally:
+      outfile.close()
+    paths.append(path)
+  return paths
+
+def main():
+  parser = optparse.OptionParser(usage="%prog [--scale N] DIR")
+  parser.add_option("--scale", type="int", default=1,
+                    help="Size multiplier for the files (default %default).")
+  (options, args) = parser.parse_args()
+  if len(args) != 1:
+    parser.error("exactly one DIR must be given")
+  for path in generate(args[0], options.scale):
+    print(path)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+
+# Differential test of two versions of py2scala, for checking that an
+# optimized conversion gives exactly the same results as before.
+#
+# Usage: differential.py [OPTIONS] [FILE ...]
+#
+# Converts the same inputs with a reference version of py2scala (default: the
+# one in the last commit, HEAD) and a candidate version (default: the one in
+# the working tree), each with each of the option sets in harness.modes, and
+# compares the converted lines, the warnings (line numbers and text) and any
+# exception raised.  The inputs are the FILEs (default: the corpus generated
+# by corpus.py), then randomly generated Python until the time budget runs
+# out.  At the first difference, the input is shrunk to as few lines as
+# still show a difference, which is written out as a reproducer, and the
+# first differing line is printed with the lines before it; the exit status
+# is then 1.  The two versions can also be the same file run with different
+# options, e.g. --candidate-args=--prescan checks prescanning against the
+# line-by-line lexing.  Both versions run in the interpreter running this,
+# so on Python 3 the reference has to be a version that supports it.  Run
+# with --help for the options.
+
+from __future__ import print_function
+
+import optparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+topdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, topdir)
+from benchmarks import corpus
+from benchmarks import harness
+import py2scala
+
+###########################################################################
+#
+# Running the two versions
+#
+###########################################################################
+
+def load_version(spec, name):
+  '''Load the version of py2scala SPEC, either a file or a git revision of
+py2scala.py in this repository, as a module named NAME.'''
+  if os.path.isfile(spec):
+    path = spec
+    infile = open(spec, 'rb')
+    try:
+      source = infile.read()
+    finally:
+      infile.close()
+  else:
+    path = spec + ':py2scala.py'
+    source = subprocess.Popen(['git', 'show', path], cwd=topdir,
+                              stdout=subprocess.PIPE).communicate()[0]
+    if not source:
+      raise ValueError("%s is neither a file nor a git revision" % spec)
+  # Compiled here rather than imported, so that no .pyc or __pycache__ is
+  # left behind, and without the __future__ imports of this module (older
+  # versions use the print statement)
+  code = compile(source, path, 'exec', 0, True)
+  module = types.ModuleType(name)
+  module.__file__ = path
+  sys.modules[name] = module
+  exec(code, module.__dict__)
+  return module
+
+class Engine:
+  '''One version of py2scala, the module MODULE, run with the command line
+options ARGS.'''
+  def __init__(self, module, args):
+    self.module = module
+    (self.options, _) = module.parse_args(args)
+
+  def run(self, lines):
+    '''Convert LINES, and return (OUTLINES, WARNINGS, ERROR), where ERROR
+describes the exception raised, if any.'''
+    converter = self.module.Converter(self.options)
+    outlines = []
+    try:
+      for line in converter.convert_lines(lines):
+        outlines.append(line)
+    except Exception as e:
+      return (outlines, converter.warnings, "%s: %s" % (type(e).__name__, e))
+    return (outlines, converter.warnings, None)
+
+class Divergence:
+  '''The first difference between the results REF and CAND of the reference
+and candidate versions, as returned by Engine.run().  WHAT is 'output',
+'warning' or 'error', and INDEX the index of the first differing output line
+or warning.'''
+  def __init__(self, ref, cand, what, index):
+    self.ref = ref
+    self.cand = cand
+    self.what = what
+    self.index = index
+
+  def report(self, context, outfile=sys.stdout):
+    '''Print the difference, with CONTEXT lines before, to OUTFILE.'''
+    if self.what == 'error':
+      print("  exception:", file=outfile)
+      print("    reference: %s" % self.ref[2], file=outfile)
+      print("    candidate: %s" % self.cand[2], file=outfile)
+      return
+    if self.what == 'output':
+      print("  first difference at output line %d:" % (self.index + 1),
+            file=outfile)
+      show = lambda item: item
+    else:
+      print("  first difference at warning %d:" % (self.index + 1),
+            file=outfile)
+      show = lambda item: "line %d: %s" % item
+    items = self.ref[self.what == 'warning' and 1 or 0]
+    for i in range(max(self.index - context, 0), self.index):
+      print("    %6d    %s" % (i + 1, show(items[i])), file=outfile)
+    for (label, result) in (('-', self.ref), ('+', self.cand)):
+      items = result[self.what == 'warning' and 1 or 0]
+      if self.index < len(items):
+        text = show(items[self.index])
+      else:
+        text = "(end of %s; %s)" % (self.what == 'output' and 'output' or
+                                    'warnings',
+                                    result[2] or 'no exception')
+      print("  %s %6d    %s" % (label, self.index + 1, text), file=outfile)
+
+def first_difference(ref, cand):
+  '''Return a Divergence for the results REF and CAND, or None if they are
+the same.'''
+  for (what, part) in (('output', 0), ('warning', 1)):
+    (refitems, canditems) = (ref[part], cand[part])
+    if refitems != canditems:
+      for i in range(min(len(refitems), len(canditems))):
+        if refitems[i] != canditems[i]:
+          return Divergence(ref, cand, what, i)
+      return Divergence(ref, cand, what, min(len(refitems), len(canditems)))
+  if ref[2] != cand[2]:
+    return Divergence(ref, cand, 'error', 0)
+  return None
+
+def compare(reference, candidate, lines):
+  '''Convert LINES with the Engines REFERENCE and CANDIDATE, and return a
+Divergence, or None if the results are the same.'''
+  return first_difference(reference.run(lines), candidate.run(lines))
+
+###########################################################################
+#
+# Random input
+#
+###########################################################################
+
+# Pieces of random Python input, chosen to exercise the conversion rules:
+# operators and keywords rewritten, quotes, comments and brackets that the
+# splitting of lines has to get right, and self.* and class variables
+
+names = ['x', 'y', 'foo', 'bar_2', 'self.a', 'self.items', 'cls.count',
+         'Holder.C1', 'os.path', 'self']
+atoms = ['None', 'True', 'False', '0', '42', '3.5', "'s'", '"d#q"',
+         "'it''s'", '"a \\" b"', "u'x'", "r'\\d+'", "'# not a comment'",
+         '"if x: and y"', "''", '[]', '{}', '()']
+binops = [' and ', ' or ', ' + ', ' - ', ' * ', ' % ', ' == ', ' != ', ' is ',
+          ' is not ', ' in ', ' not in ', ' < ', '>=']
+calls = ['len', 'str', 'isinstance', 'foo', 'self.bar', 'max', 'xrange',
+         'dict', 'open']
+comments = ['# comment', '# x = 1: not code', "# don't", '#', '// slashes',
+            '# !!PY2SCALA: BEGIN_PASSTHRU', '# !!PY2SCALA: END_PASSTHRU']
+
+def random_expr(rng, depth=0):
+  choice = rng.randrange(depth > 2 and 2 or 10)
+  if choice == 0:
+    return rng.choice(names)
+  if choice == 1:
+    return rng.choice(atoms)
+  if choice == 2:
+    return random_expr(rng, depth + 1) + rng.choice(binops) + \
+        random_expr(rng, depth + 1)
+  if choice == 3:
+    return 'not ' + random_expr(rng, depth + 1)
+  if choice == 4:
+    return '%s(%s)' % (rng.choice(calls), ', '.join(
+      random_expr(rng, depth + 1) for i in range(rng.randrange(3))))
+  if choice == 5:
+    return '[%s for %s in %s if %s]' % (
+      random_expr(rng, depth + 1), rng.choice(names[:4]),
+      random_expr(rng, depth + 1), random_expr(rng, depth + 1))
+  if choice == 6:
+    return 'lambda %s: %s' % (rng.choice(names[:4]),
+                              random_expr(rng, depth + 1))
+  if choice == 7:
+    return '%s[%s]' % (rng.choice(names), random_expr(rng, depth + 1))
+  if choice == 8:
+    return '{%s: %s}' % (random_expr(rng, depth + 1),
+                         random_expr(rng, depth + 1))
+  return '(%s)' % random_expr(rng, depth + 1)
+
+# Return a random statement, as a list of lines without the indentation of
+# the first, and whether it opens a block.
+def random_statement(rng):
+  choice = rng.randrange(24)
+  expr = lambda: random_expr(rng)
+  if choice < 6:
+    op = rng.choice(['=', '=', '=', '+=', '-=', '*='])
+    return (['%s %s %s' % (rng.choice(names[:-1]), op, expr())], False)
+  if choice == 6:
+    return (['def %s(%s):' % (rng.choice(['f', 'g', '__init__', 'run']),
+                              rng.choice(['', 'self', 'self, a, b=None',
+                                          'cls, *args', 'x, **kw']))], True)
+  if choice == 7:
+    return (['class %s%s:' % (rng.choice(['A', 'B', 'Holder']),
+                              rng.choice(['', '(object)', '(A)', '(A, B)']))],
+            True)
+  if choice == 8:
+    return (['%s %s:' % (rng.choice(['if', 'elif', 'while']), expr())], True)
+  if choice == 9:
+    return (['for %s in %s:' % (rng.choice(names[:4]), expr())], True)
+  if choice == 10:
+    return ([rng.choice(['else:', 'try:', 'finally:', 'except:',
+                         'except ValueError, e:', 'except (A, B) as e:'])],
+            True)
+  if choice == 11:
+    return (['return %s' % expr()], False)
+  if choice == 12:
+    return (['print %s' % expr()], False)
+  if choice == 13:
+    return ([rng.choice(comments)], False)
+  if choice == 14:
+    return ([''], False)
+  if choice == 15:
+    # A docstring or other multi-line string
+    quote = rng.choice(["'''", '"""'])
+    return ([quote + 'Doc: x = 1 and not y (see "z").', "It's # here",
+             expr() + quote], False)
+  if choice == 16:
+    # An expression continued over lines by brackets
+    return (['%s = foo(%s,' % (rng.choice(names[:-1]), expr()),
+             '    %s,' % expr(), '    %s)' % expr()], False)
+  if choice == 17:
+    return (['%s = %s + \\' % (rng.choice(names[:-1]), expr()),
+             '    %s' % expr()], False)
+  if choice == 18:
+    return (['%s  %s' % (expr(), rng.choice(comments))], False)
+  if choice == 19:
+    # Scala-style lines, as seen with -2
+    return ([rng.choice(['val %s = %s' % (rng.choice(names[:4]), expr()),
+                         'var %s = %s' % (rng.choice(names[:4]), expr()),
+                         'def f(a: Int) = {', '}', 'if (x) {', '} else {'])],
+            False)
+  if choice == 20:
+    return (['%s: %s' % (rng.choice(['if', 'while']), expr())], False)
+  return (['%s(%s)' % (rng.choice(calls), expr())], False)
+
+def random_source(rng, size):
+  '''Return a list of about SIZE lines of random Python input from the
+random.Random RNG.'''
+  lines = []
+  indents = [0]
+  while len(lines) < size:
+    (statement, opens) = random_statement(rng)
+    indent = ' ' * indents[-1]
+    if rng.randrange(20) == 0:
+      indent = indent.replace('  ', '\t', 1)
+    lines.append(indent + statement[0])
+    lines += statement[1:]
+    if opens:
+      indents.append(indents[-1] + rng.choice([2, 2, 4]))
+    elif len(indents) > 1 and rng.randrange(4) == 0:
+      del indents[-rng.randrange(1, len(indents)):]
+  return lines
+
+###########################################################################
+#
+# Shrinking
+#
+###########################################################################
+
+def shrink(lines, diverges, deadline):
+  '''Return a sublist of LINES for which DIVERGES (a function of a list of
+lines) is still true, trying to remove as many lines as possible before the
+time DEADLINE (delta debugging: remove ever smaller chunks of lines).'''
+  chunks = 2
+  while len(lines) > 1 and time.time() < deadline:
+    size = -(-len(lines) // chunks)
+    removed = False
+    for start in range(0, len(lines), size):
+      if time.time() >= deadline:
+        break
+      trial = lines[:start] + lines[start + size:]
+      if trial and diverges(trial):
+        lines = trial
+        chunks = max(chunks - 1, 2)
+        removed = True
+        break
+    if not removed:
+      if size == 1:
+        break
+      chunks = min(chunks * 2, len(lines))
+  return lines
+
+###########################################################################
+#
+# Main program
+#
+###########################################################################
+
+def engine_pairs(reference, candidate, options):
+  '''Return the (NAME, REFERENCE, CANDIDATE) Engines to compare for each
+option set.'''
+  modes = harness.modes
+  if options.args is not None:
+    modes = [(options.args or 'default', options.args.split())]
+  return [(name, Engine(reference, args + options.reference_args.split()),
+           Engine(candidate, args + options.candidate_args.split()))
+          for (name, args) in modes]
+
+def check(name, lines, pairs, options, deadline):
+  '''Compare the conversions of LINES, the input NAME, with each pair of
+Engines in PAIRS.  At the first difference, shrink the input, report it and
+return True.'''
+  for (mode, reference, candidate) in pairs:
+    divergence = compare(reference, candidate, lines)
+    if divergence is None:
+      continue
+    print("DIVERGENCE in %s (%d lines) with options %s" % (name, len(lines),
+                                                           mode))
+    diverges = lambda trial: compare(reference, candidate, trial) is not None
+    shrunk = shrink(lines, diverges, max(deadline, time.time()) +
+                    options.shrink_time)
+    divergence = compare(reference, candidate, shrunk)
+    print("  shrunk to %d lines, written to %s" % (len(shrunk),
+                                                   options.output))
+    outfile = py2scala.open_output(options.output)
+    try:
+      for line in shrunk:
+        outfile.write(line + '\n')
+    finally:
+      outfile.close()
+    if len(shrunk) <= 20:
+      for line in shrunk:
+        print("    | " + line)
+    divergence.report(options.context)
+    return True
+  return False
+
+def main():
+  parser = optparse.OptionParser(usage="%prog [OPTIONS] [FILE ...]")
+  parser.add_option("--reference", default="HEAD", metavar="FILE|REV",
+                    help="""The reference version: a py2scala.py file, or the
+git revision to take it from (default %default).""")
+  parser.add_option("--candidate", metavar="FILE|REV",
+                    default=os.path.join(topdir, 'py2scala.py'),
+                    help="""The candidate version (default the py2scala.py in
+the working tree).""")
+  parser.add_option("--args", metavar="ARGS",
+                    help="""Compare with only the py2scala options ARGS,
+instead of each option set of the benchmark harness.""")
+  parser.add_option("--reference-args", default="", metavar="ARGS",
+                    help="Extra py2scala options for the reference only.")
+  parser.add_option("--candidate-args", default="", metavar="ARGS",
+                    help="Extra py2scala options for the candidate only.")
+  parser.add_option("--budget", type="float", default=60.0, metavar="SECONDS",
+                    help="""Time to spend checking, after which no more random
+inputs are tried (default %default).""")
+  parser.add_option("--shrink-time", type="float", default=30.0,
+                    metavar="SECONDS",
+                    help="""Time to spend shrinking a differing input
+(default %default).""")
+  parser.add_option("--seed", type="int", default=0,
+                    help="Seed for the random inputs (default %default).")
+  parser.add_option("--size", type="int", default=200,
+                    help="Lines per random input (default %default).")
+  parser.add_option("--context", type="int", default=5,
+                    help="""Lines of context to print before a difference
+(default %default).""")
+  parser.add_option("-o", "--output", default="divergence.py", metavar="FILE",
+                    help="""Write the shrunk input to FILE (default
+%default).""")
+  (options, paths) = parser.parse_args()
+  py2scala.set_up_std_streams()
+  start = time.time()
+  deadline = start + options.budget
+  pairs = engine_pairs(load_version(options.reference, 'py2scala_reference'),
+                       load_version(options.candidate, 'py2scala_candidate'),
+                       options)
+  tmpdir = None
+  if not paths:
+    tmpdir = tempfile.mkdtemp(prefix='py2scala-corpus')
+    paths = corpus.generate(tmpdir)
+  try:
+    inputs = [(path, pairs[0][1].module.split_lines(open(path, 'rb').read()))
+              for path in paths]
+  finally:
+    if tmpdir:
+      shutil.rmtree(tmpdir)
+  total = 0
+  count = 0
+  for (name, lines) in inputs:
+    if check(name, lines, pairs, options, deadline):
+      sys.exit(1)
+    total += len(lines)
+    count += 1
+  rng = random.Random(options.seed)
+  while time.time() < deadline:
+    seed = rng.randrange(1 << 30)
+    lines = random_source(random.Random(seed), options.size)
+    if check("random input (seed %d)" % seed, lines, pairs, options,
+             deadline):
+      sys.exit(1)
+    total += len(lines)
+    count += 1
+  print("No divergence: %d inputs, %d lines, %d option sets, in %.1f s" % (
+    count, total, len(pairs), time.time() - start))
+
+if __name__ == '__main__':
+  main()
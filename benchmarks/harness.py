@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+# Benchmark harness for py2scala.
+#
+# Usage: harness.py [OPTIONS] [FILE ...]
+#
+# Converts each FILE (default: a corpus generated by corpus.py in a temporary
+# directory) with each of the option sets in modes below, and records for
+# each the conversion speed in lines per second, the peak memory use (RSS)
+# and the time taken for each file (the best of several runs).  Each option
+# set is run in a process of its own, so that its memory use can be measured
+# separately.  The results are written as JSON, for comparing against later
+# runs; with --baseline, the speed and memory use are compared against an
+# earlier run right away.  Run with --help for the options.
+
+from __future__ import print_function
+
+import datetime
+import json
+import optparse
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import py2scala
+from benchmarks import corpus
+
+# The option sets benchmarked, as (NAME, ARGUMENTS)
+modes = [
+  ('default', []),
+  ('scala', ['-s']),
+  ('remove-self', ['-r']),
+  ('convert-brackets', ['-b']),
+  ('second-pass', ['-2']),
+]
+
+# Return the peak RSS of this process so far, in kilobytes.
+def peak_rss_kb():
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, OS X bytes
+  if sys.platform == 'darwin':
+    maxrss //= 1024
+  return maxrss
+
+# Number of runs the benchmarks take the best of
+runs = 3
+
+def best_time(fun, *args):
+  '''Call FUN(*ARGS) `runs' times, and return (SECONDS, RESULT), the time
+taken by the fastest call and the result of the last.'''
+  best = None
+  for i in range(runs):
+    start = time.time()
+    result = fun(*args)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return (best, result)
+
+def stdlib_paths(names=None):
+  '''Return the paths of the Python files in the standard library directory
+containing `os', in order, or of those of the files NAMES that are there.'''
+  libdir = os.path.dirname(os.__file__)
+  if names is None:
+    names = sorted(name for name in os.listdir(libdir)
+                   if name.endswith('.py'))
+  paths = [os.path.join(libdir, name) for name in names]
+  return [path for path in paths if os.path.exists(path)]
+
+def read_lines(paths):
+  '''Return the lines of the files PATHS, one after another.'''
+  lines = []
+  for path in paths:
+    lines += py2scala.split_lines(open(path, 'rb').read())
+  return lines
+
+def run_mode(args, paths, repeat):
+  '''Convert each file in PATHS with the py2scala options ARGS, REPEAT times,
+and return a dict of the results for the mode.'''
+  (options, _) = py2scala.parse_args(args)
+  converter = py2scala.Converter(options)
+  files = {}
+  total_lines = 0
+  total_seconds = 0.0
+  for path in paths:
+    lines = py2scala.split_lines(open(path, 'rb').read())
+    best = None
+    for i in range(repeat):
+      start = time.time()
+      for line in converter.convert_lines(lines):
+        pass
+      elapsed = time.time() - start
+      if best is None or elapsed < best:
+        best = elapsed
+    files[path] = {'lines': len(lines), 'seconds': best,
+                   'warnings': len(converter.warnings)}
+    total_lines += len(lines)
+    total_seconds += best
+  return {'options': args, 'lines': total_lines, 'seconds': total_seconds,
+          'lines_per_sec': total_lines / max(total_seconds, 1e-9),
+          'peak_rss_kb': peak_rss_kb(), 'files': files}
+
+def run_mode_process(args, paths, repeat, python=None):
+  '''Like run_mode(), but in a separate process, run by the Python
+interpreter PYTHON (a command, default the one running this).'''
+  command = [python or sys.executable, os.path.abspath(__file__), '--worker',
+             '--repeat', str(repeat), '--mode-args', ' '.join(args)] + paths
+  output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0]
+  return json.loads(output)
+
+def run(paths, repeat, scale=None):
+  '''Benchmark all the modes on the files in PATHS, and return the results
+as a dict.  SCALE is the scale of the generated corpus, if that is what PATHS
+is.'''
+  results = {
+    'py2scala_version': py2scala.__version__,
+    'python': '%s %s' % (platform.python_implementation(),
+                         platform.python_version()),
+    'platform': platform.platform(),
+    'date': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+    'scale': scale,
+    'repeat': repeat,
+    'modes': {},
+  }
+  for (name, args) in modes:
+    result = run_mode_process(args, paths, repeat)
+    # Name files by their corpus name if generated, since the temporary
+    # directory is different every time
+    if scale is not None:
+      result['files'] = dict((os.path.basename(path), fileresult)
+                             for (path, fileresult)
+                             in result['files'].items())
+    results['modes'][name] = result
+  return results
+
+def print_summary(results, outfile=sys.stderr):
+  for (name, args) in modes:
+    result = results['modes'][name]
+    print("%-17s %9.0f lines/sec  peak RSS %7d KB" % (
+      name, result['lines_per_sec'], result['peak_rss_kb']), file=outfile)
+
+def compare(baseline, results, max_slowdown, outfile=sys.stderr):
+  '''Print how RESULTS compare with the earlier results BASELINE.  Returns
+whether any mode is more than MAX_SLOWDOWN percent slower.'''
+  slower = False
+  for (name, args) in modes:
+    if name not in baseline['modes']:
+      continue
+    old = baseline['modes'][name]
+    new = results['modes'][name]
+    speed = 100.0 * (new['lines_per_sec'] / old['lines_per_sec'] - 1)
+    rss = 100.0 * (float(new['peak_rss_kb']) / old['peak_rss_kb'] - 1)
+    print("%-17s speed %+6.1f%%  peak RSS %+6.1f%%" % (name, speed, rss),
+          file=outfile)
+    if -speed > max_slowdown:
+      slower = True
+  return slower
+
+def main():
+  parser = optparse.OptionParser(usage="%prog [OPTIONS] [FILE ...]")
+  parser.add_option("--scale", type="int", default=1,
+                    help="""Scale of the generated corpus, if no FILEs are
+given (default %default).""")
+  parser.add_option("--repeat", type="int", default=3,
+                    help="""Number of times to convert each file, taking the
+best time (default %default).""")
+  parser.add_option("-o", "--output", metavar="FILE",
+                    help="Write the JSON results to FILE instead of stdout.")
+  parser.add_option("--baseline", metavar="FILE",
+                    help="""Compare the results against the JSON results of
+an earlier run in FILE.""")
+  parser.add_option("--max-slowdown", type="float", metavar="PERCENT",
+                    default=10.0,
+                    help="""With --baseline, exit with status 1 if any mode
+is more than PERCENT percent slower than before (default %default).""")
+  # Used to run one mode in a subprocess
+  parser.add_option("--worker", action="store_true", help=optparse.SUPPRESS_HELP)
+  parser.add_option("--mode-args", default="", help=optparse.SUPPRESS_HELP)
+  (options, paths) = parser.parse_args()
+  if options.worker:
+    json.dump(run_mode(options.mode_args.split(), paths, options.repeat),
+              sys.stdout)
+    return
+  tmpdir = None
+  scale = None
+  if not paths:
+    tmpdir = tempfile.mkdtemp(prefix='py2scala-corpus')
+    scale = options.scale
+    paths = corpus.generate(tmpdir, scale)
+  try:
+    results = run(paths, options.repeat, scale)
+  finally:
+    if tmpdir:
+      shutil.rmtree(tmpdir)
+  if options.output:
+    outfile = open(options.output, 'w')
+    try:
+      json.dump(results, outfile, indent=2, separators=(',', ': '),
+                sort_keys=True)
+    finally:
+      outfile.close()
+  else:
+    json.dump(results, sys.stdout, indent=2, separators=(',', ': '),
+              sort_keys=True)
+    print()
+  print_summary(results)
+  if options.baseline:
+    baseline = json.load(open(options.baseline))
+    if compare(baseline, results, options.max_slowdown):
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -26,10 +26,139 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from __future__ import print_function
+
+import os
+import posixpath
 import re
+import array
 import sys
-import fileinput
+import errno
+import copy
+import pickle
+import io
+import codecs
+import hashlib
+import string
+import tempfile
+import time
+import functools
+import itertools
+import json
+import collections
 import optparse
+import multiprocessing
+import mmap
+import tarfile
+import zipfile
+import socket
+import stat
+import threading
+try:
+  # Python 3.11 and up, where importing sre_parse gives a warning
+  from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+  import sre_parse
+  import sre_constants
+
+###########################################################################
+#
+# Python 2 and 3
+#
+###########################################################################
+
+# The program runs on Python 2.7 and Python 3 (3.7 and up, CPython or PyPy),
+# with the same output on each.  Source text is a `str' either way: on
+# Python 2 the bytes as read, on Python 3 the bytes as decoded by
+# decode_source(), where every byte that Python 3 would treat differently
+# from Python 2 becomes a character of its own that no string method or
+# regexp takes for a letter, digit, space or line break.  encode_output()
+# turns such text back into the same bytes.
+
+py3 = sys.version_info[0] >= 3
+
+if py3:
+  import socketserver as SocketServer
+  xrange = range
+  izip = zip
+  imap = map
+  izip_longest = itertools.zip_longest
+else:
+  import SocketServer
+  izip = itertools.izip
+  imap = itertools.imap
+  izip_longest = itertools.izip_longest
+
+# The control characters 0x1c to 0x1f, which are whitespace to Python 3 but
+# not to Python 2, as the characters decode_source() gives them (the
+# surrogates 0xdc1c to 0xdc1f, as surrogateescape gives bytes from 0x80 up),
+# and back
+escaped_controls = dict((c, 0xdc00 + c) for c in xrange(0x1c, 0x20))
+unescaped_controls = dict((0xdc00 + c, c) for c in xrange(0x1c, 0x20))
+controls_re = re.compile(u'[\x1c-\x1f]')
+escaped_controls_re = re.compile(u'[\udc1c-\udc1f]')
+
+# Error handler for encode_output(), writing the surrogates decode_source()
+# gives as the bytes they stand for
+def py2scala_errors(e):
+  text = e.object[e.start:e.end]
+  if escaped_controls_re.search(text):
+    text = text.translate(unescaped_controls)
+  return (text.encode('utf-8', 'surrogateescape'), e.end)
+
+if py3:
+  codecs.register_error('py2scala', py2scala_errors)
+
+  def decode_source(data):
+    '''Return DATA, bytes of source, as text whose characters behave as the
+bytes do on Python 2.  Text is returned as it is.'''
+    if isinstance(data, str):
+      return data
+    text = data.decode('ascii', 'surrogateescape')
+    if controls_re.search(text):
+      text = text.translate(escaped_controls)
+    return text
+
+  def encode_output(text):
+    '''Return TEXT, converted text, as the bytes it stands for (see
+decode_source()).  Characters not from the source are written as UTF-8.'''
+    return text.encode('utf-8', 'py2scala')
+else:
+  def decode_source(data):
+    return data
+
+  def encode_output(text):
+    if type(text) is unicode:
+      return text.encode('utf-8')
+    return text
+
+# Return the binary stream underlying the standard stream STREAM (e.g.
+# sys.stdin), which on Python 2 is STREAM itself.
+def binary_stream(stream):
+  return getattr(stream, 'buffer', stream)
+
+# Make stdout and stderr write text the way encode_output() does.  Exits on
+# Python 3 before 3.7, whose streams can't be changed in place, and which
+# therefore isn't supported (replacing the streams wouldn't do, since the
+# old ones are the default arguments of many functions).
+def set_up_std_streams():
+  if py3:
+    if sys.version_info < (3, 7):
+      sys.exit("%s: needs Python 2.7, or Python 3.7 or later" %
+               os.path.basename(sys.argv[0]))
+    for stream in (sys.stdout, sys.stderr):
+      stream.reconfigure(encoding='utf-8', errors='py2scala')
+
+# Open the file PATH for writing converted text, as open(PATH, 'w') does on
+# Python 2.
+def open_output(path):
+  if py3:
+    return open(path, 'w', encoding='utf-8', errors='py2scala')
+  return open(path, 'w')
+
+# Version of the conversion rules.  Part of the key for cached conversions,
+# so bump this whenever a change can alter the output.
+__version__ = "1.4"
 
 ###########################################################################
 #
@@ -73,7 +202,13 @@ import optparse
 #
 ###########################################################################
 
-usage = """%prog [OPTIONS] [FILE]
+# Default number of code fragment rewrites a Converter memoizes (see
+# FragmentMemo)
+default_memo_size = 4096
+
+usage = """%prog [OPTIONS] [FILE ...]
+       %prog [OPTIONS] --tree SRC --out DST
+       %prog [OPTIONS] --check [FILE ... | --tree SRC]
 
 Convert a Python file to Scala.
 
@@ -125,6 +260,52 @@ that way, it can be embedded in a comment or whatever.  However, it will only
 be recognized if it has exactly the opening tag "!!PY2SCALA: " followed by a
 directive command, and only if the command is one of the recognized ones.
 That way it's highly unlikely such a directive would appear by accident.
+
+Normally the FILEs (or stdin) are converted as a single stream and written to
+stdout.  To convert a whole source tree instead, use --tree SRC --out DST;
+every .py file under SRC is converted separately and written to the
+corresponding .scala file under DST.  Files are spread across a pool of
+worker processes (see --jobs), and warnings are prefixed with the file name
+and printed in the order of the files, regardless of which finishes first.
+Since the program is normally run several times over the same tree, --tree
+can keep a cache of conversions (see --cache-dir), so that files that haven't
+changed since the last run aren't converted again.  SRC and DST can also be
+archives (e.g. foo.tar.gz or foo.zip), which are read and written directly,
+without unpacking anything to disk.
+
+For files that go straight through without manual fixes, --both-passes does
+steps 1 and 3 above in one run, writing both results.
+
+To find out which files of a partly converted tree running the program again
+(e.g. with -2) would still change, without converting them all, use --check.
+
+Each file is normally converted knowing nothing of the others, so e.g. an
+attribute set in __init__() is declared as val even if a subclass in another
+file sets it again.  With --symbol-index, all the files are indexed first,
+and the conversion of each takes the classes in the others into account.
+
+A very big file keeps one CPU busy however many are converted at once.
+With --shard-lines, big files are split at the start of top-level blocks
+(functions, classes and so on) into shards that are converted in parallel,
+and the results put together again; the output is the same.
+
+While files are being edited, --watch keeps converting them whenever they
+change.  Only the top-level blocks (functions, classes and so on) affected by
+a change are converted again; the output for the rest is reused.
+
+For editors and other tools that convert many files one at a time, --server
+keeps running and converts files on request, avoiding the startup cost of
+running the program for each file.  Each request is a line holding a JSON
+object with either "source", the text to convert, or "path", the name of a
+file to convert, and optionally "options", an object whose keys can be
+"scala", "remove_self", "convert_brackets" and "second_pass" (defaulting to
+the options given on the command line), and "id", which is copied to the
+response.  Each response is a line holding a JSON object with "id", and
+either "output", the converted text, and "warnings", a list of objects with
+"line" and "message", or "error", saying what went wrong.  If the output
+isn't valid UTF-8, it is given as Latin-1 and "encoding" is "latin-1".  Requests are
+carried out in parallel by worker processes (see --jobs), so responses can
+come in a different order from the requests.
 """
 
 parser = optparse.OptionParser(usage=usage)
@@ -147,12 +328,135 @@ type parameters) using the assumption that types in Scala begin with an
 uppercase letter.""")
 parser.add_option("-2", "--second-pass", action="store_true",
                    help="""Equivalent to -srb.  Used when doing a second pass through already Scala-fied code to remove self.* references and convert brackets to parens for array refs.""")
+parser.add_option("--rule-file", action="append", metavar="FILE",
+                   help="""Also apply the rewrite rules in FILE to code (but
+not strings or comments).  Each line of FILE is either blank, a comment
+beginning with #, or a rule of the form PATTERN => REPLACEMENT, where PATTERN
+is a regexp and REPLACEMENT is what to replace each match with, as for
+Python's re.sub() (so \\1 is the text of the first group).  The rules are
+applied in order, before the built-in ones.  Rules are only tried on code
+containing the literal text their PATTERN needs to match (e.g. `.iteritems()'
+for `(\\w+)\\.iteritems\\(\\)'), so many rules can be used without slowing down
+conversion much.  Can be given more than once.""")
+parser.add_option("--prescan", action="store_true",
+                   help="""Split each input file into code, quoted strings
+and comments in a single pass before converting it, instead of line by line.
+A little faster for files that are mostly code, but slower for ones that are
+mostly docstrings or other multi-line strings, and needs memory for the
+whole file.  Doesn't change the output.""")
+parser.add_option("--memo-size", type="int", metavar="N",
+                   default=default_memo_size,
+                   help="""Remember the conversions of up to N different
+pieces of code (the code between strings and comments on a line), so that
+code that occurs again, as much does, isn't converted again; the least
+recently used are forgotten first (default %default, 0 to turn this off).
+Doesn't change the output.  --profile-stages and --rewrite-stats also report
+how often code was found in the memo.""")
+parser.add_option("--max-logical-lines", type="int", metavar="N",
+                   help="""End a logical line (a statement spanning several
+lines because of an open paren or bracket) after N lines, with a warning,
+assuming a paren was left unclosed.  Otherwise an unclosed paren is only
+noticed at the next block statement (if, def and so on), and everything up
+to there is taken as one statement.  By default there is no limit, since
+generated files can have very long literals.""")
+parser.add_option("--profile-stages", action="store_true",
+                   help="""After converting, print to stderr how much time
+each stage of the conversion took for each file, and which logical lines
+took longest.  Makes conversion somewhat slower.""")
+parser.add_option("--trace-rules", action="store_true",
+                   help="""After converting, print to stderr how many times
+each rewrite rule (e.g. `and' to `&&', `if' blocks, val to var) was applied
+and how many times it changed something, and how much time each took, the
+slowest first.  Makes conversion slower.""")
+parser.add_option("--trace-log", metavar="FILE",
+                   help="""Write each rewrite done by a rule to FILE, as a
+line of JSON giving the source file and line number, the rule and the text
+before and after.  Implies --trace-rules.""")
+parser.add_option("--rewrite-stats", action="store_true",
+                   help="""After converting, print to stderr for each file
+how many lines no rewrite rule could apply to (so they were passed through
+by a fast path) and how many lines were changed.  Run on code converted
+already, this shows how far it is from needing no more changes.""")
+parser.add_option("--tree", metavar="SRC",
+                   help="""Convert every .py file in the directory tree SRC,
+each on its own, writing the results to the directory given by --out.  SRC
+can also be an archive (.tar, .tar.gz, .tgz, .tar.bz2, .tbz2 or .zip), whose
+files are converted without unpacking it.""")
+parser.add_option("--out", metavar="DST",
+                   help="""Output directory for --tree.  Created if necessary;
+SRC/foo/bar.py is converted to DST/foo/bar.scala.  If DST ends in one of the
+archive suffixes above, an archive of that type is created instead.""")
+parser.add_option("-j", "--jobs", type="int",
+                   help="""Number of worker processes to use with --tree,
+--both-passes, --server or --shard-lines.  Defaults to the number of CPUs.""")
+parser.add_option("--shard-lines", type="int", metavar="N",
+                   help="""Split input of more than N lines into shards of at
+least N lines, each beginning at a line that starts a new top-level block,
+and convert the shards in parallel with the --jobs worker processes.  For
+very big files, which would otherwise take one CPU however many files are
+converted at once.  Works for the FILEs (or stdin) converted to stdout, and
+for each file of --both-passes and of --tree (unless it is an archive),
+where the files to split are picked by their size, taking a line to be 35
+bytes.  Doesn't change the output.""")
+parser.add_option("--both-passes", action="store_true",
+                   help="""Do both passes at once, for files that need no
+manual fixes in between: write the normal conversion to foo.scala and the
+result of converting that again with -2 to foo.pass2.scala.  Works with --tree
+or with FILE arguments, where foo.py is converted to foo.scala and
+foo.pass2.scala in the same directory.""")
+parser.add_option("--check", action="store_true",
+                   help="""Write nothing, but check whether converting the
+FILEs (each on its own), or the files of --tree, would change them, printing
+FILE:LINE for the first line that would change in each one that would.
+Exits with status 1 if any would change.  The conversion of a file stops at
+its first change.  With --cache-dir, files found to convert to themselves are
+noted in the cache, so checking them again doesn't convert them.""")
+parser.add_option("--watch", action="store_true",
+                   help="""Convert as for --tree, or for FILE arguments as for
+--both-passes (foo.py to foo.scala, and also foo.pass2.scala if --both-passes
+is given), then keep watching the files and reconvert them when they change.
+Only the top-level blocks affected by a change are reconverted.  Stop with
+Ctrl-C.""")
+parser.add_option("--watch-interval", type="float", metavar="SECONDS",
+                   default=1.0,
+                   help="""How often --watch checks the files for changes
+(default %default seconds).  Only modification times and sizes are checked.""")
+parser.add_option("--server", action="store_true",
+                   help="""Run as a server, reading conversion requests
+from stdin and writing the results to stdout, one JSON object per line, until
+the end of stdin.  See above for the format.""")
+parser.add_option("--socket", metavar="PATH",
+                   help="""With --server, take requests on connections to
+the Unix domain socket PATH instead of stdin, serving several connections at
+once.  Runs until killed.""")
+parser.add_option("--symbol-index", metavar="FILE",
+                   help="""Before converting, index the classes in all the
+files to convert (the files of --tree, or the FILEs), noting the class
+variables and self.* attributes of each class and where they are assigned,
+so that the conversion of each file can take the others into account: a
+variable assigned in another file (e.g. in a subclass) is declared as var,
+and an attribute declared by a base class in another file isn't declared
+again in a subclass.  The index is kept in FILE, and only the files that
+have changed since the last run are indexed again.""")
+parser.add_option("--cache-dir", metavar="DIR",
+                   help="""With --tree, --both-passes, --server or --check, keep a cache of converted files in DIR.
+Files whose contents and conversion options match a cached conversion are not
+converted again; the cached output and warnings are used instead.""")
+parser.add_option("--cache-size", type="int", metavar="MB", default=256,
+                   help="""Maximum size of the --cache-dir cache, in megabytes.
+The least recently used entries are removed at the end of a run to bring the
+cache back under this size (default %default).""")
 
-(options, args) = parser.parse_args()
-if options.second_pass:
-  options.scala = True
-  options.remove_self = True
-  options.convert_brackets = True
+def parse_args(argv=None):
+  '''Parse the command line in ARGV (default sys.argv[1:]).  Returns a tuple
+(OPTIONS, ARGS) just like OptionParser.parse_args(), except that -2 has been
+expanded into the options it stands for.'''
+  (options, args) = parser.parse_args(argv)
+  if options.second_pass:
+    options.scala = True
+    options.remove_self = True
+    options.convert_brackets = True
+  return (options, args)
 
 ## Process file(s)
 
@@ -164,12 +468,12 @@ stdout).  Uses the 'print' command, and normally outputs a newline; but
 this can be suppressed using NONL.  Output is not normally flushed (unless
 the stream does this automatically); but this can be forced using FLUSH.'''
   
-  if type(text) is unicode:
+  if not py3 and type(text) is unicode:
     text = text.encode("utf-8")
   if nonl:
-    print >>outfile, text,
+    print(text, end=' ', file=outfile)
   else:
-    print >>outfile, text
+    print(text, file=outfile)
   if flush:
     outfile.flush()
 
@@ -180,278 +484,673 @@ without errors.  Uses the 'print' command, and normally outputs a newline; but
 this can be suppressed using NONL.'''
   uniprint(text, outfile=sys.stderr, nonl=nonl)
 
-# A hackish function for print-debugging.
-def debprint(fmt, *vals):
-  errprint("Debug: Line %d, %s" % (lineno, fmt % vals))
-
-# RE's for balanced expressions.  This is a major hack.  We only use this
-# for things like converting '$1 in $2' to '$2 contains $1'.  In general,
-# we count parens and brackets properly.
-balparenexpr = r'\([^()]*\)'
-balbracketexpr = r'\[[^\[\]]*\]'
-balstr0 = r'(?:[^()\[\]]|%s|%s)*' % (balparenexpr, balbracketexpr)
-bal2parenexpr = r'\(%s\)' % balstr0
-bal2bracketexpr = r'\[%s\]' % balstr0
-bal2str0 = r'(?:[^()\[\]]|%s|%s)*' % (bal2parenexpr, bal2bracketexpr)
-bal2strnospace0 = r'(?:[^ ()\[\]]|%s|%s)*' % (bal2parenexpr, bal2bracketexpr)
-bal2str = r'(?:[^()\[\]]|%s|%s)+' % (bal2parenexpr, bal2bracketexpr)
-bal2strnospace = r'(?:[^ ()\[\]]|%s|%s)+' % (bal2parenexpr, bal2bracketexpr)
-
-if options.scala:
-  commentre = r''' | /\* .*? \*/  # C-style Scala comment
-                   | /\* .*       # C-style Scala comment unmatched (multi-line)
-                   | //.*         # C++-style Scala comment
-               '''
-else:
-  commentre = r''' | [#].*'''     # Python comment
-
-# RE to split off quoted strings and comments.
-# FIXME: The handling of backslashes in raw strings is slightly wrong;
-# I think we only want to look for a backslashed quote of the right type.
-# (Or maybe we look for no backslashes at all?)
-# FIXME: We don't handle XML literals at all
-stringre = re.compile(r'''(   r?'[']' .*? '[']'   # 3-single-quoted string
-                            | r?""" .*? """       # 3-double-quoted string 
-                            | r?'[']'.*           # unmatched 3-single-quote
-                            | r?""".*             # unmatched 3-double-quote
-                            | r?' (?:\\.|[^'])* ' # single-quoted string
-                            | r?" (?:\\.|[^"])* " # double-quoted string
-                            | r?'.*               # unmatched single-quote
-                            | r?".*               # unmatched double-quote
-                            %s
-                          )''' % commentre, re.X)
-
-# Test function for above RE.  Not called.
-def teststr(x):
-  split = stringre.split(x)
-  for y in split:
-    print y
+# Balanced expressions.  We only use these for things like converting
+# '$1 in $2' to '$2 contains $1'.  In general, we count parens and brackets
+# properly.  A balanced expression is a sequence of characters other than
+# parens and brackets, and of groups consisting of a left paren or bracket,
+# a balanced expression and the matching right paren or bracket.  The
+# rewrites below find them by looking up where the longest balanced
+# expression starting at each position ends, which takes time linear in the
+# length of the text however deeply things are nested.
 
-# List of multi-line delimiters (quotes, comments).  Each entry is a tuple
-# of (start, end) -- this handles comments like /* ... */ properly.
-multi_line_delims = [('"""', '"""'), ("'''", "'''")]
-if options.scala:
-  multi_line_delims += [('/*', '*/')]
-single_quote_delims = ['"', "'"]
+closing_brackets = {'(': ')', '[': ']'}
 
-# If we added a triple-quote delimiter, remove it. (We add such delimiters
-# to the beginning of a line if we're in the middle of a multi-line quote,
-# so our string-handling works right.)
-def line_no_added_delim(line, delim):
-  if delim:
-    dlen = len(delim)
-    assert line[0:dlen] == delim
-    return line[dlen:]
-  else:
-    return line
+word_chars = frozenset(string.ascii_letters + string.digits + '_')
 
-# Add a "virtual line", possibly spanning multiple lines, to the line list
-def add_bigline(bigline):
-  global lines
-  if bigline is not None:
-    lines += bigline.split('\n')
-
-# Main function to frob the inside of a line.  Passed a line split by
-# stringre.split() into alternating text and delimiters composed of
-# quoted strings and/or comments.  This is a generator function that
-# returns values with `yield'.
-def modline(split):
-  for i in xrange(len(split)):
-    prev = None
-    if i > 0:
-      prev = split[i-1]
-    vv = split[i]
-    #debprint("Saw #%d: %s", i, vv)
-
-    # Skip blank sections (e.g. at end of line after a comment)
-    if len(vv) == 0:
-      yield vv
-      continue
+uppercase_chars = frozenset(string.ascii_uppercase)
 
-    # If we're handling a string composed from the added delimiter,
-    # don't try to frob it.
-    nofrob = old_openquote and i == 1 and prev == ""
-
-    if i % 2 == 1: # We are looking at a delimiter
-
-      # Look for raw-string prefix on strings
-      vv2 = vv
-      # raw will be None if no quote of any sort here, 'r' if a raw Python
-      # string, '' if non-raw string
-      raw = None
-      if vv[0] == 'r' and len(vv) > 1 and vv[1] in single_quote_delims:
-        vv2 = vv[1:]
-        raw = "r"
-      elif vv[0] in single_quote_delims:
-        raw = ""
-
-      # Look for (unclosed) multi-line quote or comment
-      saw_multiline_delim = False
-      unclosed = False
-      global openquote
-      for delim in multi_line_delims:
-        (delimstart, delimend) = delim
-        if vv2.startswith(delimstart):
-          #debprint("Saw multi-line delim %s", delimstart)
-          saw_multiline_delim = True
-          if vv2 == delimstart or not vv2.endswith(delimend):
-            openquote = delimstart
-            unclosed = True
-      if saw_multiline_delim and not unclosed:
-        openquote = None
-
-      if raw is not None: # We're handline some sort of string, frob it
-        if saw_multiline_delim:
-          # FIXME!! Python has eight types of strings: Single and triple
-          # quoted strings, using both single and double quotes (i.e.
-          # ', ", ''', """), as well as the "raw" variants prefixed with r.
-          # Scala has only two types: Strings quoted like "foo", and
-          # raw multiline strings quoted like """foo""".  We're not properly
-          # shoehorning the various types of Python strings into Scala
-          # strings.  The only thing we do is try to convert Python strings
-          # like r"foo" and r'foo' into Scala raw """foo""" strings.
-          #
-          # Note that Scala also has single-character literals like 'f',
-          # whereas Python uses normal strings for this.  We try to do the
-          # right thing here (i.e. leave 'f' as 'f' but convert 'ff' to "ff"),
-          # but we can't be perfect because (a) we don't know whether a
-          # single-character Python string should become a Scala string or
-          # character literal, and (b) since we can be run more than once,
-          # we can't distinguish "f" as a Scala single-character string
-          # (should be left alone) from "f" as a Python single-character
-          # string (potentially convertible to Scala 'f').
-          if vv2.startswith("'''") and not nofrob:
-            if unclosed:
-              yield raw + '"""' + vv2[3:]
-            else:
-              yield raw + '"""' + vv2[3:-3] + '"""'
-          else:
-            yield vv
-          continue
-        for delim in single_quote_delims:
-          if (vv2.startswith(delim) and
-              (vv2 == delim or not vv2.endswith(delim))):
-            warning("Saw unfinished single quoted string %s" % vv)
-            yield vv
-            continue
-        revisedstr = vv2
-        if vv2.startswith("'") and (
-            (len(vv2) != 4 if not raw and vv2[1] == '\\' else len(vv2) != 3)
-            ):
-          # Single-quoted string of length != 1
-          # Convert to double-quoted string
-          revisedstr = '"' + vv2[1:-1] + '"'
-        # FIXME! This may fail with unbackslashed quotes of the other
-        # sort in the string.  See comments above about the eight types of
-        # Python strings.
-        if raw:
-          yield '""' + revisedstr + '""'
+def balanced_ends(text):
+  '''Return a list giving, for each position in TEXT (including the end), the
+end of the longest balanced expression starting there.'''
+  n = len(text)
+  ends = [n] * (n + 1)
+  for i in xrange(n - 1, -1, -1):
+    c = text[i]
+    if c in closing_brackets:
+      j = ends[i + 1]
+      if j < n and text[j] == closing_brackets[c]:
+        ends[i] = ends[j + 1]
+      else:
+        ends[i] = i
+    elif c == ')' or c == ']':
+      ends[i] = i
+    else:
+      ends[i] = ends[i + 1]
+  return ends
+
+def balanced_nospace_ends(text, ends):
+  '''Like balanced_ends(), but for balanced expressions with no spaces
+outside of groups.  ENDS is what balanced_ends() returns for TEXT.'''
+  n = len(text)
+  nsends = [n] * (n + 1)
+  for i in xrange(n - 1, -1, -1):
+    c = text[i]
+    if c in closing_brackets:
+      j = ends[i + 1]
+      if j < n and text[j] == closing_brackets[c]:
+        nsends[i] = nsends[j + 1]
+      else:
+        nsends[i] = i
+    elif c == ' ' or c == ')' or c == ']':
+      nsends[i] = i
+    else:
+      nsends[i] = nsends[i + 1]
+  return nsends
+
+# Convert a list comprehension '[$1 for $2 in $3]' (or with parens) to
+# '(for ($2 <- $3) yield $1)', where $1 and $3 are nonempty balanced
+# expressions.  Like re.sub() would, this uses the leftmost left paren or
+# bracket where a comprehension starts, the longest $1 and then the longest
+# $2 possible; this means there is at most one comprehension per fragment
+# (typically there is only one anyway).
+def convert_comprehension(text):
+  n = len(text)
+  ends = balanced_ends(text)
+  # Find the last ' in $3]'
+  inpos = text.rfind(' in ')
+  while inpos >= 0:
+    end = ends[inpos + 4]
+    if end > inpos + 4 and end < n and text[end] in ')]':
+      break
+    inpos = text.rfind(' in ', 0, inpos + 3)
+  if inpos < 0:
+    return text
+  # For each position, the last ' for ' at the same nesting level (and
+  # before the ' in ') that a balanced expression starting there can
+  # reach, if any
+  forpos = [None] * (n + 1)
+  for i in xrange(n - 1, -1, -1):
+    c = text[i]
+    if c in closing_brackets:
+      j = ends[i + 1]
+      if j < n and text[j] == closing_brackets[c]:
+        forpos[i] = forpos[j + 1]
+    elif c != ')' and c != ']':
+      forpos[i] = forpos[i + 1]
+      if forpos[i] is None and i + 5 <= inpos and text.startswith(' for ', i):
+        forpos[i] = i
+  for start in xrange(n):
+    if text[start] in closing_brackets:
+      forstart = forpos[start + 1]
+      if forstart is not None and forstart > start + 1:
+        return '%s(for (%s <- %s) yield %s)%s' % (
+          text[:start], text[forstart + 5:inpos], text[inpos + 4:end],
+          text[start + 1:forstart], text[end + 1:])
+  return text
+
+# Convert '$1 in $2' to '$2 contains $1', where $1 and $2 are nonempty
+# balanced expressions without spaces (outside of groups), taking the
+# longest $1 and $2 possible but making $2 end at a word boundary.
+def convert_contains(text):
+  n = len(text)
+  ends = balanced_ends(text)
+  nsends = balanced_nospace_ends(text, ends)
+  # Ends of the $2 starting at a given position, or None if there is none
+  rhsends = {}
+  def rhs_end(start):
+    if start not in rhsends:
+      # Walk through the positions the balanced expression can end at,
+      # noting the last one at a word boundary
+      rhsend = None
+      i = start
+      while i < n:
+        c = text[i]
+        if c in closing_brackets:
+          j = ends[i + 1]
+          if j >= n or text[j] != closing_brackets[c]:
+            break
+          i = j + 1
+        elif c == ' ' or c == ')' or c == ']':
+          break
         else:
-          yield revisedstr
+          i += 1
+        if (text[i - 1] in word_chars) != (i < n and text[i] in word_chars):
+          rhsend = i
+      rhsends[start] = rhsend
+    return rhsends[start]
+  result = []
+  pos = 0
+  start = 0
+  while start < n:
+    inpos = nsends[start]
+    if inpos > start and text.startswith(' in ', inpos):
+      end = rhs_end(inpos + 4)
+      if end is not None:
+        result += [text[pos:start], text[inpos + 4:end], ' contains ',
+                   text[start:inpos]]
+        pos = start = end
+        continue
+    start += 1
+  result.append(text[pos:])
+  return ''.join(result)
+
+# Convert 'len($1)' to '$1.length', where $1 is a nonempty balanced
+# expression.
+def convert_len(text):
+  n = len(text)
+  ends = balanced_ends(text)
+  result = []
+  pos = 0
+  start = text.find('len(')
+  while start >= 0:
+    end = ends[start + 4]
+    if end > start + 4 and end < n and text[end] == ')':
+      result += [text[pos:start], text[start + 4:end], '.length']
+      pos = end + 1
+      start = text.find('len(', pos)
+    else:
+      start = text.find('len(', start + 1)
+  result.append(text[pos:])
+  return ''.join(result)
+
+# Convert bracketed expressions like 'foo[$1]' to 'foo($1)', but avoid list
+# constructors (previous character not alphanumeric) and scala generic
+# vars/types (the type in brackets is usually uppercase).  $1 is any
+# character other than an uppercase letter or right bracket, followed by a
+# (possibly empty) balanced expression.
+def convert_brackets(text):
+  n = len(text)
+  ends = balanced_ends(text)
+  result = []
+  pos = 0
+  start = text.find('[', 1)
+  while start >= 0:
+    if (text[start - 1] in word_chars and start + 1 < n and
+        text[start + 1] != ']' and text[start + 1] not in uppercase_chars):
+      end = ends[start + 2]
+      if end < n and text[end] == ']':
+        result += [text[pos:start], '(', text[start + 1:end], ')']
+        pos = end + 1
+        start = text.find('[', pos + 1)
         continue
-        # We don't convert in the opposite direction because in Scala
-        # someone might reasonably have a double-quoted string of length 1
+    start = text.find('[', start + 1)
+  result.append(text[pos:])
+  return ''.join(result)
+
+single_quote_delims = ['"', "'"]
+
+# Return the effective conversion options as a hashable tuple
+# (scala, remove_self, convert_brackets).  OPTIONS is anything with some or
+# all of the attributes set by parse_args(), e.g. an optparse.Values object;
+# missing attributes count as False, and `second_pass' implies all three.
+# None means the default options.
+def option_key(options):
+  second_pass = getattr(options, 'second_pass', False)
+  return tuple(bool(second_pass or getattr(options, name, False))
+               for name in ('scala', 'remove_self', 'convert_brackets'))
+
+# Whether OPTIONS (as for option_key()) convert the way a second pass does,
+# whether given as -2 or as the -srb it stands for.
+def is_second_pass(options):
+  return all(option_key(options))
+
+# A set of rules replacing words by other fixed strings in code fragments,
+# all done in a single pass over the fragment.  TABLE maps each word to its
+# replacement.  A word must begin at a word boundary, and unless it ends in
+# a space or period, it must end at one too.
+class WordRules(object):
+  def __init__(self, table):
+    self.table = table
+    # Longest first, so that e.g. `self.' wins over `self'
+    words = sorted(table, key=len, reverse=True)
+    self.regexp = re.compile(r'\b(?:%s)' % '|'.join(
+      re.escape(w) if w[-1] in ' .' else w + r'\b' for w in words))
+
+  def _replace(self, m):
+    return self.table[m.group()]
+
+  def sub(self, text):
+    '''Return TEXT with all the rules applied.'''
+    return self.regexp.sub(self._replace, text)
+
+# A rule replacing matches of the regexp PATTERN in code fragments by
+# REPLACEMENT, as re.sub() does.
+class RegexRule(object):
+  def __init__(self, pattern, replacement):
+    self.regexp = re.compile(pattern)
+    self.replacement = replacement
+    # sub(TEXT) returns TEXT with the rule applied.  It goes straight to the
+    # compiled regexp, so it costs no more than calling re.sub() would.
+    self.sub = functools.partial(self.regexp.sub, replacement)
+
+# A rule converting code fragments with the function FUN, e.g.
+# convert_len().  Like the other rules, it has a sub(TEXT) method (which is
+# FUN itself).
+class FunctionRule(object):
+  def __init__(self, fun):
+    self.sub = fun
 
-      # Convert comments
-      if vv.startswith('#'):
-        yield '//' + vv[1:]
+# Return the longest run of literal text that every match of the regexp
+# PATTERN must contain, or None if there is none (or the pattern ignores
+# case).  Case is the only flag that changes what a literal matches.
+def required_literal(pattern):
+  if re.compile(pattern).flags & re.I:
+    return None
+  parsed = sre_parse.parse(pattern)
+  runs = ['']
+  def scan(items):
+    for (op, av) in items:
+      if op == sre_constants.LITERAL:
+        runs[-1] += chr(av)
+      elif op == sre_constants.SUBPATTERN and len(av) == 4 and av[1] & re.I:
+        # A group ignoring case, e.g. (?i:foo) (Python 3 only), may match
+        # varying text
+        runs.append('')
+      elif op == sre_constants.SUBPATTERN:
+        # A group matches in line with what is around it
+        scan(av[-1])
+      elif op != sre_constants.AT:
+        # Anything else may match varying text; anchors like \b match no
+        # text, so they don't break up a run
+        runs.append('')
+  scan(parsed)
+  return max(runs, key=len) or None
+
+# Return a regexp pattern matching any of the strings WORDS, the longest
+# possible at any position.  The alternatives are factored into a trie, so
+# that the regexp engine follows a single path through them at each
+# position, however many words there are, rather than trying each in turn.
+def trie_pattern(words):
+  trie = {}
+  for word in words:
+    node = trie
+    for c in word:
+      node = node.setdefault(c, {})
+    node[''] = None
+  def build(node):
+    alts = [re.escape(c) + build(node[c]) for c in sorted(node) if c]
+    if not alts:
+      return ''
+    pattern = len(alts) == 1 and alts[0] or '(?:%s)' % '|'.join(alts)
+    if '' in node:
+      # The word can end here, but prefer to go on
+      pattern = '(?:%s)?' % pattern
+    return pattern
+  return build(trie)
+
+# A set of user-defined rules (see --rule-file) applied to code fragments,
+# in order, each a RegexRule.  SPECS is a list of (PATTERN, REPLACEMENT).
+# Each rule is indexed by the longest literal text any match of it must
+# contain (see required_literal()), and a fragment is first searched for
+# all of these triggers at once, with a single trie-shaped regexp (a
+# multi-pattern search in the manner of Aho-Corasick), so only the rules
+# whose triggers occur are tried.  Adding rules thus costs little per
+# fragment.  Rules with no trigger are tried on every fragment.
+class UserRules(object):
+  def __init__(self, specs):
+    self.rules = [RegexRule(pattern, replacement)
+                  for (pattern, replacement) in specs]
+    triggers = [required_literal(pattern) for (pattern, _) in specs]
+    # Rules with no trigger
+    self.always = [i for (i, trigger) in enumerate(triggers)
+                   if trigger is None]
+    literals = sorted(set(t for t in triggers if t is not None))
+    # RE matching a trigger at each position where one begins (the
+    # lookahead lets matches overlap), or None if there are no triggers
+    self.triggerre = None
+    if literals:
+      self.triggerre = re.compile('(?=(%s))' % trie_pattern(literals))
+    # The rules (as indexes in rules[]) to try for each trigger matched.
+    # Since only the longest trigger beginning at a position is matched,
+    # this includes the rules of the triggers that are prefixes of it.
+    self.dispatch = dict(
+      (literal, [i for (i, trigger) in enumerate(triggers)
+                 if trigger is not None and literal.startswith(trigger)])
+      for literal in literals)
+
+  # Return the indexes of the rules after rule START (if given) whose
+  # triggers occur in TEXT, in order.
+  def _candidates(self, text, start=-1):
+    found = set(i for i in self.always if i > start)
+    if self.triggerre:
+      dispatch = self.dispatch
+      for m in self.triggerre.finditer(text):
+        found.update(i for i in dispatch[m.group(1)] if i > start)
+    return sorted(found)
+
+  def sub(self, text):
+    '''Return TEXT with the rules applied in order.'''
+    candidates = self._candidates(text)
+    rules = self.rules
+    k = 0
+    while k < len(candidates):
+      i = candidates[k]
+      newtext = rules[i].sub(text)
+      k += 1
+      if newtext != text:
+        # The rewrite may have added or removed triggers of later rules
+        text = newtext
+        candidates = self._candidates(text, i)
+        k = 0
+    return text
+
+# Return the user-defined rules in the rule files PATHS (see --rule-file),
+# as a tuple of (PATTERN, REPLACEMENT), checking that each pattern is a
+# valid regexp and its replacement valid for it.  Raises ValueError, giving
+# the file and line, for a bad rule.
+def load_rule_files(paths):
+  specs = []
+  for path in paths:
+    for (lineno, line) in enumerate(split_lines(read_file(path)), 1):
+      line = line.strip()
+      if not line or line.startswith('#'):
         continue
-      yield vv
+      m = re.match(r'(.*?)\s+=>(?:\s+(.*))?$', line)
+      if not m:
+        raise ValueError("%s:%d: expected PATTERN => REPLACEMENT" %
+                         (path, lineno))
+      (pattern, replacement) = (m.group(1), m.group(2) or '')
+      try:
+        regexp = re.compile(pattern)
+        # Check the replacement against an empty match with the same
+        # groups, since it is otherwise only checked when a rule matches
+        names = dict((i, name) for (name, i) in regexp.groupindex.items())
+        empty = ''.join(i in names and '(?P<%s>)' % names[i] or '()'
+                        for i in xrange(1, regexp.groups + 1))
+        re.match(empty, '').expand(replacement)
+      except (re.error, IndexError) as e:
+        raise ValueError("%s:%d: %s" % (path, lineno, e))
+      specs.append((pattern, replacement))
+  return tuple(specs)
+
+# Regexps and tables that depend on the conversion options.  These are
+# compiled once per option set and shared by every Converter using that
+# set; use get_rules() rather than creating these directly.  USER_RULES is a
+# tuple of (PATTERN, REPLACEMENT) for any user-defined rules (see
+# UserRules).
+class RuleSet(object):
+  def __init__(self, key, user_rules=()):
+    self.key = key
+    (self.scala, self.remove_self, self.convert_brackets) = key
+
+    if self.scala:
+      commentre = r''' | /\* .*? \*/  # C-style Scala comment
+                       | /\* .*       # C-style Scala comment unmatched (multi-line)
+                       | //.*         # C++-style Scala comment
+                   '''
+    else:
+      commentre = r''' | [#].*'''     # Python comment
+
+    # RE to split off quoted strings and comments.
+    # FIXME: The handling of backslashes in raw strings is slightly wrong;
+    # I think we only want to look for a backslashed quote of the right type.
+    # (Or maybe we look for no backslashes at all?)
+    # FIXME: We don't handle XML literals at all
+    self.stringre = re.compile(r'''(   r?'[']' .*? '[']'   # 3-single-quoted string
+                                     | r?""" .*? """       # 3-double-quoted string
+                                     | r?'[']'.*           # unmatched 3-single-quote
+                                     | r?""".*             # unmatched 3-double-quote
+                                     | r?' (?:\\.|[^'])* ' # single-quoted string
+                                     | r?" (?:\\.|[^"])* " # double-quoted string
+                                     | r?'.*               # unmatched single-quote
+                                     | r?".*               # unmatched double-quote
+                                     %s
+                                   )''' % commentre, re.X)
+    # RE matching the characters that can begin a match of stringre; a line
+    # without any is all code.
+    self.delimcharre = re.compile(self.scala and r'''['"/]''' or r'''['"#]''')
+
+    # List of multi-line delimiters (quotes, comments).  Each entry is a tuple
+    # of (start, end) -- this handles comments like /* ... */ properly.
+    self.multi_line_delims = [('"""', '"""'), ("'''", "'''")]
+    if self.scala:
+      self.multi_line_delims += [('/*', '*/')]
+    self.delim_ends = dict(self.multi_line_delims)
+
+    # Rules replacing keywords and the like in code fragments, applied by
+    # _modline() in one pass each.  The replacements never create or destroy
+    # a word boundary next to them, so doing them all at once gives the same
+    # result as doing them one after another.
+    words = {'or': '||', 'and': '&&', 'True': 'true', 'False': 'false',
+             'not ': '!'}
+    # some None in Scala code should actually be None (e.g. when
+    # Option[T] is used)
+    if not self.scala:
+      words['None'] = 'null'
+    self.keyword_rules = WordRules(words)
+    words = {'pass': '()'}
+    if self.remove_self:
+      words.update({'self.': '', 'self': 'this', 'cls.': ''})
+      # Not sure about this
+      #words['cls'] = 'this'
+    self.statement_rules = WordRules(words)
+    # The other rules _modline() applies to code fragments.  These don't
+    # depend on the options, but keeping all the rules here means that
+    # TracingConverter can trace them by wrapping them in a copy of the
+    # RuleSet, with no cost to conversion when not tracing.
+    self.is_none_rule = RegexRule(r'\bis (None|null)\b', '== null')
+    self.is_not_none_rule = RegexRule(r'\bis !.*(None|null)\b', '!= null')
+    self.lambda_rule = RegexRule(r'lambda ([A-Za-z0-9]+): ?', r'\1 => ')
+    self.comprehension_rule = FunctionRule(convert_comprehension)
+    self.contains_rule = FunctionRule(convert_contains)
+    self.len_rule = FunctionRule(convert_len)
+    self.format_rule = RegexRule(r'^( +)%( +)', r'\1format\2')
+    self.brackets_rule = FunctionRule(convert_brackets)
+    # The user-defined rules, applied before all the others, or None
+    self.user_rules = None
+    if user_rules:
+      self.user_rules = UserRules(user_rules)
+    # RE matching anything in a code fragment that one of the rules above
+    # might change.  A fragment without a match is passed through untouched
+    # by _modline(), which saves trying all the rules on code that has
+    # already been converted.  Each alternative is a necessary condition for
+    # some rules to do anything: `is ' for the None rules, ` in ' for
+    # comprehensions and `in' tests, `%' for format, and the triggers of
+    # the user-defined rules (any text at all if one of them has none).
+    triggers = [self.keyword_rules.regexp.pattern,
+                self.statement_rules.regexp.pattern,
+                r'\bis ', 'lambda ', ' in ', r'len\(', '%']
+    if self.convert_brackets:
+      triggers.append(r'\[')
+    if self.user_rules:
+      if self.user_rules.always:
+        triggers.append('')
+      elif self.user_rules.triggerre:
+        triggers.append(trie_pattern(self.user_rules.dispatch))
+    self.triggerre = re.compile('|'.join(triggers))
+
+  def multi_line_delim(self, text):
+    '''If TEXT (a quoted string, without any raw-string prefix, or a comment)
+begins with a multi-line delimiter, return a tuple (START, UNCLOSED) of the
+delimiter and whether TEXT leaves it open; otherwise return (None, False).'''
+    for (delimstart, delimend) in self.multi_line_delims:
+      if text.startswith(delimstart):
+        return (delimstart, text == delimstart or
+                            not text.endswith(delimend))
+    return (None, False)
+
+  def closes_delim(self, delim, text):
+    '''Whether TEXT, the (nonempty) rest of a multi-line quote or comment
+begun with DELIM on an earlier line, closes it.  This is checked the same way
+as for multi_line_delim(DELIM + TEXT).'''
+    delimend = self.delim_ends[delim]
+    return (delim + text[-len(delimend):]).endswith(delimend)
+
+  def split_quote_rest(self, delim, line):
+    '''Split LINE, going on with a multi-line quote or comment begun with
+DELIM on an earlier line, the way stringre.split() splits DELIM + LINE, less
+the DELIM.  The end of the quote is looked for directly.'''
+    delimend = self.delim_ends[delim]
+    end = line.find(delimend)
+    if end < 0:
+      return ['', line, '']
+    end += len(delimend)
+    return ['', line[:end]] + self.stringre.split(line[end:])
+
+# Compiled RuleSets, indexed by rules_key()
+rulesets = {}
+
+def get_rules(options=None):
+  '''Return the RuleSet for the conversion options in OPTIONS (see
+option_key()) and the user-defined rules in its `user_rules' attribute, if
+any (see load_rule_files()), compiling it the first time a given set of
+these is seen.'''
+  key = rules_key(options)
+  rules = rulesets.get(key)
+  if rules is None:
+    rules = rulesets[key] = RuleSet(*key)
+  return rules
 
+# Return the key of the RuleSet for OPTIONS: a tuple of option_key() and the
+# user-defined rules.
+def rules_key(options):
+  return (option_key(options), getattr(options, 'user_rules', None) or ())
+
+class FragmentMemo(object):
+  '''A memo of the code fragments rewritten by a Converter, mapping a key
+(the fragment and whatever else the rewrite depends on) to the result.  At
+most MAXSIZE entries are kept; when there are more, the least recently used
+is dropped.  The numbers of lookups that found an entry and that didn't are
+counted in `hits' and `misses'.'''
+
+  def __init__(self, maxsize):
+    self.maxsize = maxsize
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    '''Return the result memoized for KEY, or None if there isn't one.  The
+entry becomes the most recently used.'''
+    entries = self.entries
+    result = entries.pop(key, None)
+    if result is None:
+      self.misses += 1
     else:
-      # Not a delimiter
-
-      vv = re.sub(r'\bor\b', '||', vv)
-      vv = re.sub(r'\band\b', '&&', vv)
-      vv = re.sub(r'\bTrue\b', 'true', vv)
-      vv = re.sub(r'\bFalse\b', 'false', vv)
-      # some None in Scala code should actually be None (e.g. when
-      # Option[T] is used)
-      if not options.scala:
-        vv = re.sub(r'\bNone\b', 'null', vv)
-      vv = re.sub(r'\bnot ', '!', vv)
-      vv = re.sub(r'\bis (None|null)\b', '== null', vv)
-      vv = re.sub(r'\bis !.*(None|null)\b', '!= null', vv)
-      vv = re.sub(r'lambda ([A-Za-z0-9]+): ?', r'\1 => ', vv)
-      # Seems this isn't necessary; (for x <- y if foo) works fine in Scala
-      #vv = re.sub(r'[\[(](.*) for (.*) in (.*) if (.*)[)\]]',
-      #             r'(for (\2 <- \3; if \4) yield \1)', vv)
-      vv = re.sub(r'[\[(](%s) for (.*) in (%s)[)\]]' % (bal2str, bal2str),
-                   r'(for (\2 <- \3) yield \1)', vv)
-      if not re.match(r'.*\bfor\b', vv):
-        vv = re.sub(r'(%s) in (%s)\b' % (bal2strnospace, bal2strnospace),
-            r'\2 contains \1', vv)
-      vv = re.sub(r'len\((%s)\)' % bal2str, r'\1.length', vv)
-      vv = re.sub(r'\bpass\b', '()', vv)
-      # change % to format but only when applied to string
-      if prev and prev[0] in single_quote_delims:
-        vv = re.sub(r'^( +)%( +)', r'\1format\2', vv)
-      if options.remove_self:
-        vv = re.sub(r'\bself\.', '', vv)
-        vv = re.sub(r'\bself\b', 'this', vv)
-        vv = re.sub(r'\bcls\.', '', vv)
-        # Not sure about this
-        #vv = re.sub(r'\bcls\b', 'this', vv)
-      if options.convert_brackets:
-        # Convert bracketed expressions, but avoid list constructors
-        # (previous character not alphanumeric) and scala generic vars/types
-        # (the type in brackets is usually uppercase)
-        vv = re.sub(r'([A-Za-z0-9_])\[([^A-Z\]]%s)\]' % bal2str0,
-            r'\1(\2)', vv)
-
-      yield vv
-
-# Indentation of current or latest line
-curindent = 0
-# If not None, a continuation line (line ending in backslash)
-contline = None
-# Status of any unclosed multi-line quotes (''' or """) or multi-line comments
-# at end of line
-openquote = None
-# Same, but for the beginning of the line
-old_openquote = None
-# Mismatch in parens/brackets so far at end of line (includes mismatch from
-# previous lines, so that a value of 0 means we are at the end of a logical
-# line)
-paren_mismatch = 0
-# Same, but for the beginning of the line
-old_paren_mismatch = 0
-# Indent last time paren mismatch was zero
-zero_mismatch_indent = 0
-# Source line number last time paren mismatch was zero
-zero_mismatch_lineno = 0
-# Blank/comment count last time paren mistmatch was zero
-zero_mismatch_prev_blank_or_comment_line_count = 0
-# Accumulation of line across paren mismatches and multi-line quotes.
-# This will hold the concatenation of all such lines, so that we can
-# properly handle multi-line if/def/etc. statements and variable assignments.
-bigline = None
-# Accumulation of unfrobbed line across paren mismatches
-old_bigline = None
-# Lineno and indent at start of bigline
-bigline_indent = 0
-bigline_lineno = 0
-# Current source line number.  Not the same as a "line index", which is an
-# index into the lines[] array. (Not even simply off by 1, because we
-# add extra lines consisting of braces, and do other such changes.)
-lineno = 0
-# Lines accumulated so far.  We need to be able to go back and modify old
-# lines sometimes.  Note that len(lines) is the "line index" of the
-# current line being processed, at least after we handle dedentation
-# (where we might be inserting lines).
-lines = []
-# Number of blank or comment-only lines just seen
-blank_or_comment_line_count = 0
-# Same, not considering current line
-prev_blank_or_comment_line_count = 0
-# Whether we are ignoring lines due to PY2SCALA directive
-in_ignore_lines = False
+      entries[key] = result
+      self.hits += 1
+    return result
+
+  def put(self, key, result):
+    '''Memoize RESULT for KEY, dropping the least recently used entry if
+the memo is full.'''
+    entries = self.entries
+    entries[key] = result
+    if len(entries) > self.maxsize:
+      entries.popitem(last=False)
+
+  def report(self, outfile=sys.stderr):
+    '''Print the hit and miss counts to OUTFILE.'''
+    lookups = self.hits + self.misses
+    print("Fragment memo: %d lookups, %d hits (%.1f%%), "
+          "%d misses, %d of %d entries used" % (
+      lookups, self.hits, 100.0 * self.hits / max(lookups, 1), self.misses,
+      len(self.entries), self.maxsize), file=outfile)
+
+# Test function for the stringre RE.  Not called.
+def teststr(x, options=None):
+  split = get_rules(options).stringre.split(x)
+  for y in split:
+    print(y)
+
+# A line of output, stored in a LineList.  Indent and Define objects refer
+# to lines they may have to change later by their Line objects, which stay
+# valid however many lines get inserted or moved elsewhere (so nothing needs
+# renumbering when that happens).
+class Line(object):
+  __slots__ = ('text', 'prev', 'next', 'mark')
+
+  def __init__(self, text=None):
+    self.text = text
+    self.prev = None
+    self.next = None
+    # Used by Converter._flush() to find the lines still referred to
+    self.mark = 0
+
+class LineList(object):
+  '''Doubly-linked list of Line objects, for the output lines that may still
+change.  Inserting, moving and removing lines takes time independent of the
+number of lines.  Iterating over a LineList yields the text of the lines.'''
+
+  def __init__(self):
+    # Sentinel: end.next is the first line and end.prev the last
+    self.end = Line()
+    self.end.prev = self.end.next = self.end
+    self.size = 0
+    # The Line that the next line appended with append() will be stored in.
+    # This lets us refer to a line before it has been added.
+    self.nextline = Line()
+
+  def __len__(self):
+    return self.size
+
+  def __iter__(self):
+    line = self.end.next
+    while line is not self.end:
+      yield line.text
+      line = line.next
+
+  def first(self):
+    '''Return the first Line, or the end sentinel if there are none.'''
+    return self.end.next
+
+  def last(self):
+    '''Return the last Line, or the end sentinel if there are none.'''
+    return self.end.prev
+
+  # Link LINE in before BEFORE.
+  def _link(self, line, before):
+    line.prev = before.prev
+    line.next = before
+    before.prev.next = line
+    before.prev = line
+    self.size += 1
+
+  # Unlink LINE from the list.
+  def _unlink(self, line):
+    line.prev.next = line.next
+    line.next.prev = line.prev
+    self.size -= 1
+
+  def append(self, text):
+    '''Add a line with TEXT at the end, and return its Line (this is the
+Line that `nextline' was up to now).'''
+    line = self.nextline
+    self.nextline = Line()
+    line.text = text
+    self._link(line, self.end)
+    return line
+
+  def insert(self, before, texts):
+    '''Insert lines with the strings in TEXTS before the Line BEFORE (which
+may be the end sentinel).  Return the first Line inserted.'''
+    first = None
+    for text in texts:
+      line = Line(text)
+      self._link(line, before)
+      if first is None:
+        first = line
+    return first
+
+  def move_last(self, count, before):
+    '''Move the last COUNT lines, in order, to before the Line BEFORE.'''
+    for i in xrange(min(count, self.size)):
+      line = self.end.prev
+      self._unlink(line)
+      self._link(line, before)
+      before = line
+
+  def popfirst(self):
+    '''Remove the first line and return its text.'''
+    line = self.end.next
+    self._unlink(line)
+    return line.text
+
+# Return the mismatch of parens and brackets in the code of a line split by
+# stringre.split(), i.e. not counting quoted strings or comments.  We don't
+# do braces because we might be processing Scala-like code.
+def paren_delta(splitline):
+  delta = 0
+  for i in xrange(0, len(splitline), 2):
+    vv = splitline[i]
+    delta += vv.count('(') + vv.count('[') - vv.count(')') - vv.count(']')
+  return delta
 
 # Store information associated with an indentation block (e.g. an
-# if/def statement); stored into indents[]
+# if/def statement); stored into Converter.indents[]
 class Indent:
-  # startind: Line index of beginning of block-begin statement
-  # endind: Line index of end of block-begin statement
+  # startind: Line of beginning of block-begin statement
+  # endind: Line of end of block-begin statement
   # indent: Indentation of block-begin statement
   # ty: "python" or "scala"
   def __init__(self, startind, endind, indent, ty):
@@ -460,565 +1159,3466 @@ class Indent:
     self.indent = indent
     self.ty = ty
 
-  # Adjust line indices starting at AT up by BY.
-  def adjust_lineinds(self, at, by):
-    if self.startind >= at: self.startind += by
-    if self.endind >= at: self.endind += by
-
 # Store information associated with a class or function definition;
-# stored into defs[]
+# stored into Converter.defs[]
 class Define:
   # ty: "class" or "def"
   # name: name of class or def
   # vardict: dict of currently active params and local vars.  The key is
   #   a variable name and the value is one of "val" (unsettable function
   #   parameter), "var" (settable function parameter), "explicit"
-  #   (variable declared with an explicit var/val) or a line number
-  #   (bare variable assignment; the line number is so that we can change
-  #   an added 'val' to 'var' if necessary).
-  def __init__(self, ty, name, vardict):
+  #   (variable declared with an explicit var/val) or a Line (bare
+  #   variable assignment; the Line is so that we can change an added
+  #   'val' to 'var' if necessary).
+  # lineno: Source line number of the definition
+  # indent: Indentation of the definition
+  # lineind: Line of the definition
+  def __init__(self, ty, name, vardict, lineno, indent, lineind):
     self.ty = ty
     self.name = name
     self.vardict = vardict
-    self.lineno = bigline_lineno
-    self.indent = bigline_indent
-    self.lineind = len(lines)
-    # Line index of insertion point in companion object
+    self.lineno = lineno
+    self.indent = indent
+    self.lineind = lineind
+    # Line of insertion point in companion object
     self.compobj_lineind = None
 
-  # Adjust line indices starting at AT up by BY.
-  def adjust_lineinds(self, at, by):
-    #debprint("Adjusting lines at %s by %s", at, by)
-    if self.lineind >= at: self.lineind += by
-    if self.compobj_lineind and self.compobj_lineind >= at: self.compobj_lineind += by
-    for (k, v) in self.vardict.iteritems():
-      if type(v) is int and v >= at: self.vardict[k] += by
-    #debprint("Finishing adjusting lines at %s by %s, len(lines)=%s", at, by,
-    #    len(lines))
-    #for (k, v) in self.vardict.iteritems():
-    #  debprint("name=%s, vardict[%s] = %s", self.name, k, v)
-
-# List of currently active indentation blocks, of Indent objects
-indents = []
-# List, for each currently active function and class define, of Define objects
-defs = []
-
-# Adjust line indices starting at AT up by BY.  Used when inserting or
-# deleting lines from lines[].
-def adjust_lineinds(at, by):
-  for d in defs:
-    d.adjust_lineinds(at, by)
-  for i in indents:
-    i.adjust_lineinds(at, by)
-
-# Output a warning for the user.
-def warning(text, nonl=False):
-  '''Line errprint() but also add "Warning: " and line# to the beginning.'''
-  errprint("Warning: %d: %s" % (lineno, text), nonl=nonl)
+# RE matching the leading keyword of a statement, if any
+keywordre = re.compile(r'\s*([a-z]*)')
 
+# RE matching a Python or Scala def or class statement, with the name, the
+# arguments (or superclasses) in parentheses and what follows
+definere = re.compile(r'\s*(def|class)\s+(.*?)(?:\((.*)\))?\s*(:\s*$|=?\s*\{ *$|extends\s.*|with\s.*|\s*$)', re.S)
 
-################# Main loop
+# The pieces of definere, for match_define()
+define_start_re = re.compile(r'\s*(def|class)\s+')
+define_coda_re = re.compile(r'\s*(:\s*$|=?\s*\{ *$|extends\s.*|with\s.*|\s*$)',
+                            re.S)
+# Where a name can end: where the arguments or what follows can start
+define_name_end_re = re.compile(r'[\s(:={]|extends\s|with\s|\Z')
 
+# Statements longer than this many characters are matched by
+# match_define() without using definere
+define_regexp_limit = 1000
 
-# Loop over all lines in stdin or argument(s)
-for line in fileinput.input(args):
-  lineno += 1
+# Return the groups definere.match(TEXT) would, or None if it doesn't
+# match, in time linear in the length of TEXT.  definere itself tries every
+# `)' after every `(' when no `)' is followed by an allowed ending (e.g. for
+# a Python 3 def with a return annotation), which takes forever on a long
+# enough statement.
+def match_define(text):
+  if len(text) <= define_regexp_limit:
+    m = definere.match(text)
+    return m and m.groups()
+  m = define_start_re.match(text)
+  if not m:
+    return None
+  (ty, start) = (m.group(1), m.end())
+  # The arguments (being matched greedily) end at the last `)' followed by
+  # an allowed ending
+  close = -1
+  end = len(text)
+  while True:
+    close = text.rfind(')', start, end)
+    if close < 0:
+      break
+    closecoda = define_coda_re.match(text, close + 1)
+    if closecoda:
+      break
+    end = close
+  # The name (being matched lazily) ends at the first place followed by
+  # arguments and an ending, or by an ending alone
+  pos = start
+  while pos <= len(text):
+    pos = define_name_end_re.search(text, pos).start()
+    if close > pos and text[pos] == '(':
+      return (ty, text[start:pos], text[pos + 1:close], closecoda.group(1))
+    m = define_coda_re.match(text, pos)
+    if m:
+      return (ty, text[start:pos], None, m.group(1))
+    pos += 1
+  return None
 
-  # Remove LF or CRLF, convert tabs to spaces
-  line = line.rstrip("\r\n").expandtabs()
-  #debprint("Saw line: %s", line)
-  # If previous line was continued, add it to this line
-  if contline:
-    # This is OK because we checked to make sure continuation was not in
-    # a quote or comment
-    line = contline.rstrip() + " " + line.lstrip()
-    contline = None
-                                  
-  m = re.match('.*!!PY2SCALA: ([A-Z_]+)', line)
-  if m:
-    directive = m.group(1)
-    if directive == 'BEGIN_PASSTHRU':
-      in_ignore_lines = True
-      lines += [line]
-      continue
-    elif directive == 'END_PASSTHRU':
-      in_ignore_lines = False
-      lines += [line]
-      continue
-  if in_ignore_lines:
-    lines += [line]
-    continue
-
-  # If we are continuing a multiline quote, add the delimiter to the
-  # beginning.  That way we will parse the line correctly.  We remove
-  # the delimiter at the bottom.
-  if openquote:
-    line = openquote + line
-  # Split the line based on quoted and commented sections
-  #debprint("Line before splitting: [%s]", line)
-  splitline = list(stringre.split(line))
-
-  # If line is continued, don't do anything yet (till we get the whole line)
-  lasttext = splitline[-1]
-  if lasttext and lasttext[-1] == '\\':
-    contline = line_no_added_delim(line, openquote)[0:-1]
-    continue
-
-  # Look for blank or comment-only lines
-  blankline = re.match(r'^ *$', line)
-  if re.match('^ *(#.*|//.*)?$', line):
-    blank_or_comment_line_count += 1
-  else:
-    prev_blank_or_comment_line_count = blank_or_comment_line_count
-    blank_or_comment_line_count = 0
+# The Python statements introducing a block, by leading keyword, as lists of
+# (RE, TEMPLATE, KIND) tried in order: a statement (without the colon)
+# matching RE becomes TEMPLATE with the groups of the match substituted in,
+# and KIND names the variant (e.g. for --trace-rules).
+block_statements = {
+  # (The lookaheads for a final `)' keep a long statement without one from
+  # taking time quadratic in its length.)
+  'def': [(re.compile(r'def\s+(?=.*\)$)(.*?)\((.*)\)$', re.S), "def %s(%s)",
+           'def')],
+  'for': [(re.compile(r'for\s+(.*?)\s+in\s+(.*)$', re.S), "for (%s <- %s)",
+           'for')],
+  'if': [(re.compile(r'if\s+(.*)$', re.S), "if (%s)", 'if')],
+  'elif': [(re.compile(r'elif\s+(.*)$', re.S), "else if (%s)", 'elif')],
+  'else': [(re.compile(r'else\s*$', re.S), "else", 'else')],
+  'while': [(re.compile(r'while\s(.*)$', re.S), "while (%s)", 'while')],
+  'try': [(re.compile(r'try\s*$', re.S), "try", 'try')],
+  # FIXME: Should convert `except' to a case statement within the body
+  'except': [(re.compile(r'except\s*$', re.S), "catch", 'except'),
+             (re.compile(r'except\s+(.*)$', re.S), "catch %s", 'except')],
+  'finally': [(re.compile(r'finally\s*$', re.S), "finally", 'finally')],
+  # A class that inherits from `object' (new-style class) becomes a class
+  # without superclass
+  'class': [(re.compile(r'class\s+(.*)\(object\)', re.S), "class %s", 'class'),
+            (re.compile(r'class\s+(?=.*\)$)(.*)\((.*)\)$', re.S),
+             "class %s extends %s", 'class extends'),
+            (re.compile(r'class\s+([^(]*)$', re.S), "class %s", 'class')],
+}
 
-  # Record original line, and values of paren_mismatch and openquote
-  # at start of line
-  old_paren_mismatch = paren_mismatch
-  oldline = line
-  old_openquote = openquote
+# The classification of a logical line, made once by Converter._classify()
+# for all the stages that look at the statement in it
+class Statement:
+  # define: for a def or class statement, the groups of definere (type,
+  #   name, arguments and what follows), else None
+  # kind: for a Python statement introducing a block, the kind of
+  #   statement (see block_statements), else None
+  # header: for such a statement, its Scala version (e.g. "if (foo)" for
+  #   "if foo"), else None
+  # target: for an assignment or modifying assignment (e.g. +=) inside a
+  #   def or class, the name of the variable assigned, as in the source,
+  #   else None
+  # operator: for an assignment, the operator ("=", "+=" and so on)
+  # The class attributes are the defaults; only what is found is set on an
+  # instance.
+  define = None
+  kind = None
+  header = None
+  target = None
+  operator = None
 
-  # Count # of mismatched parens (also brackets)
-  for i in xrange(len(splitline)):
-    vv = splitline[i]
-    if i % 2 == 0: # Make sure not a quoted string or comment
-      # Count mismatch of parens and brackets.  We don't do braces because
-      # we might be processing Scala-like code.
-      paren_mismatch += vv.count('(') + vv.count('[') - \
-          vv.count(')') - vv.count(']')
-  #debprint("Line %d, old paren mismatch %d, new paren mismatch %d",
-  #    lineno, old_paren_mismatch, paren_mismatch)
-  if paren_mismatch < 0:
-    warning("Apparent unmatched right-paren, we might be confused: %s" % line)
-    paren_mismatch = 0
-
-  # Compute current indentation, handle dedenting (may need to insert braces).
-  # Note that blank lines don't have any effect on indentation in Python,
-  # and nor do continued multi-line quotes.
-  if not old_openquote and not blankline:
-    # Get current indentation
-    m = re.match('( *)', line)
-    indent = len(m.group(1))
-
-    # Handle dedent: End any blocks as appropriate, and add braces
-    if indent < curindent:
-      # Pop off all indentation blocks at or more indented than current
-      # position, and add right braces
-      while indents and indents[-1].indent >= indent:
-        indobj = indents.pop()
-        # Can happen, e.g., if // is used in Python to mean "integer division",
-        # or other circumstances where we got confused
-        if old_paren_mismatch > 0:
-          warning("Apparent unmatched left-paren somewhere before, possibly line %d, we might be confused" % zero_mismatch_lineno)
-          # Reset to only mismatched left parens on this line
-          paren_mismatch = paren_mismatch - old_paren_mismatch
-          if paren_mismatch < 0:
-            paren_mismatch = 0
-        if indobj.ty == "scala":
+###########################################################################
+#
+# Conversion
+#
+###########################################################################
+
+# Lexical analysis of a whole file, done in a single pass before converting
+# it (see --prescan).
+def lex_lines(rules, infile):
+  '''Split the lines of INFILE (any iterable of lines, with or without line
+terminators) into code, quoted strings and comments, the same way
+Converter._process_line() would using the regexps in RULES.  Yields (LINE,
+KIND, SPLITLINE, DEPTH, AT_REST) for each line: LINE is its text (with tabs
+expanded, and with any continued lines before it joined to it), KIND is its
+kind as for Prescan, SPLITLINE is the split line if it is LEXED (else
+None), DEPTH is the mismatch of parens and brackets after the line, and
+AT_REST is whether no continued line, multi-line quote or passthru section
+goes on past it.'''
+  LEXED = Prescan.LEXED
+  stringre_split = rules.stringre.split
+  delimchar_search = rules.delimcharre.search
+  openquote = None
+  contline = None
+  in_ignore_lines = False
+  depth = 0
+  for line in infile:
+    line = line.rstrip("\r\n").expandtabs()
+    if contline:
+      line = contline.rstrip() + " " + line.lstrip()
+      contline = None
+    kind = LEXED
+    splitline = None
+    if '!!PY2SCALA: ' in line:
+      m = re.match('.*!!PY2SCALA: ([A-Z_]+)', line)
+      if m and m.group(1) == 'BEGIN_PASSTHRU':
+        in_ignore_lines = True
+        kind = Prescan.PASSTHRU
+      elif m and m.group(1) == 'END_PASSTHRU':
+        in_ignore_lines = False
+        kind = Prescan.PASSTHRU
+    if in_ignore_lines:
+      kind = Prescan.PASSTHRU
+    if kind == LEXED:
+      if openquote:
+        splitline = rules.split_quote_rest(openquote, line)
+      elif delimchar_search(line):
+        splitline = stringre_split(line)
+      else:
+        splitline = [line]
+      lasttext = splitline[-1]
+      if lasttext and lasttext[-1] == '\\':
+        contline = line[0:-1]
+        kind = Prescan.CONTINUED
+        splitline = None
+    if kind == LEXED:
+      # Track multi-line quotes and comments the way _modline() does
+      for i in xrange(1, len(splitline), 2):
+        vv = splitline[i]
+        if i == 1 and openquote:
+          if vv and rules.closes_delim(openquote, vv):
+            openquote = None
           continue
-        rbrace = "%s}" % (' '*indobj.indent)
-        # Check for right brace already present; if so, just make sure
-        # corresponding left brace is present
-        if line.startswith(rbrace):
-          lines[indobj.endind] += " {"
-        else:
-          insertpos = len(lines)
-          # Insert the right brace *before* any blank lines (we skipped over
-          # them since they don't affect indentation)
-          while re.match('^ *$', lines[insertpos - 1]):
-            insertpos -= 1
-          # If the "block" is only a single line, and it's not introduced
-          # by "def" or "class", don't add braces.
-          # We check for 2 because with a single-line block, the potential
-          # right-brace insertion point is 2 lines past the opening block
-          # (1 for opening line itself, 1 for block)
-          #debprint("lineno:%s, startind:%s, endind:%s, lines:%s",
-          #    lineno, indobj.startind,
-          #    indobj.endind, len(lines))
-          if (insertpos - indobj.endind > 2 or
-              re.match('^ *(def|class) ', lines[indobj.startind])):
-            lines[indobj.endind] += " {"
-            lines[insertpos:insertpos] = [rbrace]
-      # Pop off all function definitions that have been closed
-      while defs and defs[-1].indent >= indent:
-        defs.pop()
-    # Set indentation value for current line
-    curindent = indent
-
-  # Record some values if no paren mismatch or continued quote at start of line
-  if not old_openquote and old_paren_mismatch == 0:
-    zero_mismatch_indent = curindent
-    zero_mismatch_lineno = lineno
-    zero_mismatch_prev_blank_or_comment_line_count = prev_blank_or_comment_line_count
-
-  ########## Now we modify the line itself
-
-  # Frob the line in various ways (e.g. change 'and' to '&&')
-  line = ''.join(modline(splitline))
-
-  # Accumulate a logical line into 'bigline' across unmatched parens and quotes
-  line_without_delim = line_no_added_delim(line, old_openquote)
-  old_line_without_delim = line_no_added_delim(oldline, old_openquote)
-  if old_paren_mismatch == 0 and not old_openquote:
-    assert bigline == None
-    bigline = line_without_delim
-    old_bigline = old_line_without_delim
-    bigline_indent = curindent
-    bigline_lineno = lineno
-    assert bigline_indent == zero_mismatch_indent
-    assert bigline_lineno == zero_mismatch_lineno
-  else:
-    bigline = bigline + "\n" + line_without_delim
-    old_bigline = old_bigline + "\n" + old_line_without_delim
-
-  # If we see a Scala-style opening block, just note it; important for
-  # unmatched-paren handling above (in particular where we reset the
-  # unmatched-paren count at the beginning of a block, to deal with
-  # errors in parsing)
-  if paren_mismatch == 0 and not openquote and (
-      re.match(r'.*\{ *$', splitline[-1])):
-    indents += [Indent(len(lines), len(lines) + (bigline or "").count('\n'),
-      zero_mismatch_indent, "scala")]
-
-  # Error recovery.  If we see a Python block opening, and we're not in
-  # a continued quote, and we were inside a parened or bracketed expr,
-  # something is probably wrong, so reset paren count.
-  if not old_openquote and old_paren_mismatch > 0 and \
-      re.match(r' *(if|for|with|while|try|elif|else|except|def|class) +.*:.*$',
-               line):
-    # Can happen, e.g., if // is used in Python to mean "integer division"
-    # but we interpret it as a comment (so a closing paren gets ignored),
-    # or other circumstances where we got confused or the user actually
-    # messed up their parens
-    warning("Apparent unmatched left-paren somewhere before, possibly line %d, we might be confused" % zero_mismatch_lineno)
-    # Reset to only mismatched parens on this line
-    paren_mismatch = paren_mismatch - old_paren_mismatch
-    if paren_mismatch < 0:
-      paren_mismatch = 0
-    # Restart the logical line, add any old line to lines[]
-    add_bigline(bigline)
-    bigline = line
-    old_bigline = oldline
-
-  # Skip to next line if this line doesn't really end
-  if paren_mismatch > 0 or openquote:
-    continue
-
-  # Remove self and cls parameters from def(), if called for
-  # Note that we changed 'self' to 'this' above
-  if options.remove_self:
-    m = re.match(r'^(\s*def\s+[A-Za-z0-9_]+\s*)\((?:\s*(?:this|cls)\s*)(\)|, *)(.*)$', bigline)
+        if vv[0] == 'r' and len(vv) > 1 and vv[1] in single_quote_delims:
+          vv = vv[1:]
+        (delimstart, unclosed) = rules.multi_line_delim(vv)
+        if delimstart:
+          openquote = delimstart if unclosed else None
+      depth += paren_delta(splitline)
+    yield (line, kind, splitline, depth,
+           not (contline or openquote or in_ignore_lines))
+
+class Prescan(object):
+  '''The lines of INFILE (any iterable of lines, with or without line
+terminators) split into code, quoted strings and comments by lex_lines(),
+using the regexps in RULES.  For line I, lines[I] is its text (with tabs
+expanded, and with any continued lines before it joined to it), and kinds[I]
+says whether it is a LEXED line, a CONTINUED one (continued on the next
+line, so there is nothing to do yet) or copied unchanged (PASSTHRU).  For a
+LEXED line, bounds[firsts[I]:firsts[I+1]] are the boundaries between the
+sections split() returns, or empty if the line is all code.  depths[I] is
+the mismatch of parens and brackets before line I.  The numbers are kept in
+arrays, to keep the memory needed for large files down.'''
+
+  LEXED = 0
+  CONTINUED = 1
+  PASSTHRU = 2
+
+  def __init__(self, rules, infile):
+    self.lines = []
+    self.kinds = array.array('b')
+    self.bounds = array.array('i')
+    self.firsts = array.array('i', [0])
+    self.depths = array.array('i', [0])
+    for (line, kind, splitline, depth, _) in lex_lines(rules, infile):
+      self.lines.append(line)
+      self.kinds.append(kind)
+      # A line that is all code needs no bounds
+      if splitline and len(splitline) > 1:
+        pos = 0
+        self.bounds.append(pos)
+        for vv in splitline:
+          pos += len(vv)
+          self.bounds.append(pos)
+      self.firsts.append(len(self.bounds))
+      self.depths.append(depth)
+
+  def split(self, i):
+    '''Return LEXED line I split into code, quoted strings and comments, as
+_process_split_line() wants it.'''
+    line = self.lines[i]
+    if self.firsts[i] == self.firsts[i + 1]:
+      return [line]
+    bounds = self.bounds[self.firsts[i]:self.firsts[i + 1]]
+    return [line[bounds[k]:bounds[k + 1]] for k in xrange(len(bounds) - 1)]
+
+class Converter(object):
+  '''Convert Python source to Scala.  All state for a conversion is kept in
+the Converter object, so any number of conversions can be done in one process
+(sequentially, using the same Converter, or interleaved, using several).
+OPTIONS holds the conversion options (see option_key()); the regexps that
+depend on them are compiled only once per option set.  If OPTIONS has a true
+`prescan' attribute, each file is lexed as a whole up front (see Prescan).
+Warnings are collected in `warnings' as (LINENO, TEXT) tuples and, if
+WARNFILE is given, also printed to it as they occur.  The rewrites of code
+fragments are memoized in the FragmentMemo `memo', which is kept from one
+file to the next; its size is the `memo_size' attribute of OPTIONS (default
+default_memo_size), and 0 turns it off.  If OPTIONS has a
+`max_logical_lines' attribute, a logical line left open by an unmatched
+paren or bracket is ended after that many lines.  If `symbols' is set to a
+SymbolIndex, it is used to decide between val and var for class variables
+and self.* attributes assigned in other files.'''
+
+  # Minimum number of lines to buffer before flushing finished lines
+  flush_lines = 256
+
+  # RE matching an assignment or modifying assignment (e.g. +=) to a
+  # variable, self.* or cls.* variable, with any Scala-style declaration
+  assignre = re.compile(r'(\s*)(val\s+|var\s+|)((?:self\.|cls\.)?[a-zA-Z_][a-zA-Z_0-9]*)(\s*[+\-*/]?=)(.*)', re.S)
+
+  def __init__(self, options=None, warnfile=None):
+    self.rules = get_rules(options)
+    self.prescan = getattr(options, 'prescan', False)
+    self.warnfile = warnfile
+    memo_size = getattr(options, 'memo_size', default_memo_size)
+    self.memo = memo_size and FragmentMemo(memo_size) or None
+    self.max_logical_lines = getattr(options, 'max_logical_lines', None)
+    self.symbols = None
+    self.reset()
+
+  def reset(self):
+    '''Reset the conversion state, to start converting a new file.'''
+    # Warnings issued so far, as (LINENO, TEXT) tuples
+    self.warnings = []
+    # Indentation of current or latest line
+    self.curindent = 0
+    # If not None, a continuation line (line ending in backslash)
+    self.contline = None
+    # Status of any unclosed multi-line quotes (''' or """) or multi-line comments
+    # at end of line
+    self.openquote = None
+    # Same, but for the beginning of the line
+    self.old_openquote = None
+    # Mismatch in parens/brackets so far at end of line (includes mismatch from
+    # previous lines, so that a value of 0 means we are at the end of a logical
+    # line)
+    self.paren_mismatch = 0
+    # Same, but for the beginning of the line
+    self.old_paren_mismatch = 0
+    # Indent last time paren mismatch was zero
+    self.zero_mismatch_indent = 0
+    # Source line number last time paren mismatch was zero
+    self.zero_mismatch_lineno = 0
+    # Blank/comment count last time paren mistmatch was zero
+    self.zero_mismatch_prev_blank_or_comment_line_count = 0
+    # Accumulation of line across paren mismatches and multi-line quotes.
+    # This will hold the concatenation of all such lines, so that we can
+    # properly handle multi-line if/def/etc. statements and variable assignments.
+    self.bigline = None
+    # Accumulation of unfrobbed line across paren mismatches
+    self.old_bigline = None
+    # While a logical line is being accumulated, the lines of bigline and
+    # old_bigline, joined only once it is complete, so that long logical
+    # lines take linear time
+    self.bigline_parts = None
+    self.old_bigline_parts = None
+    # The Statement classifying the latest logical line
+    self.statement = None
+    # Lineno and indent at start of bigline
+    self.bigline_indent = 0
+    self.bigline_lineno = 0
+    # Current source line number.  Not the same as the position of the
+    # line in the output, because we add extra lines consisting of braces,
+    # and do other such changes.
+    self.lineno = 0
+    # Lines accumulated so far, as a LineList.  We need to be able to go back
+    # and modify old lines sometimes, so we hold on to the Line objects of
+    # lines we might change.  Note that lines.nextline is the Line of the
+    # current line being processed, if it gets stored at the end.  Lines
+    # that can no longer change are moved out to ready[] from time to time
+    # (see _flush()), so this holds only the tail of the output.
+    self.lines = LineList()
+    # Finished lines waiting to be output
+    self.ready = []
+    # Size lines[] must reach before we try flushing it again
+    self.flush_at = self.flush_lines
+    # Value of Line.mark for the lines _flush() must keep
+    self.flush_mark = 0
+    # Number of blank or comment-only lines just seen
+    self.blank_or_comment_line_count = 0
+    # Same, not considering current line
+    self.prev_blank_or_comment_line_count = 0
+    # Whether we are ignoring lines due to PY2SCALA directive
+    self.in_ignore_lines = False
+    # List of currently active indentation blocks, of Indent objects
+    self.indents = []
+    # List, for each currently active function and class define, of Define
+    # objects
+    self.defs = []
+
+  # Output a warning for the user.
+  def warning(self, text):
+    '''Record a warning about the current line, and if we have a WARNFILE,
+print it there with "Warning: " and the line# at the beginning.'''
+    self.warnings.append((self.lineno, text))
+    if self.warnfile:
+      uniprint("Warning: %d: %s" % (self.lineno, text), outfile=self.warnfile)
+
+  # A hackish function for print-debugging.
+  def debprint(self, fmt, *vals):
+    errprint("Debug: Line %d, %s" % (self.lineno, fmt % vals))
+
+  # Move the lines at the beginning of lines[] that can no longer change to
+  # ready[].  A line can still change if an open block, def or variable
+  # refers to it; also, right braces get inserted before any trailing blank
+  # lines, so we keep everything from the last non-blank line on.  Only call
+  # this at the end of a logical line that isn't blank or a comment, since
+  # comments before a variable may get moved along with it.
+  #
+  # Finding the referenced lines means looking at all variables of all open
+  # defs, so we only do this when lines[] has doubled in size since the last
+  # time, which keeps the cost linear.
+  def _flush(self):
+    lines = self.lines
+    stop = lines.last()
+    while stop is not lines.first() and re.match('^ *$', stop.text):
+      stop = stop.prev
+    self.flush_mark += 1
+    mark = self.flush_mark
+    stop.mark = mark
+    for i in self.indents:
+      # The lines of Scala blocks are never used
+      if i.ty == "python":
+        i.startind.mark = mark
+    for d in self.defs:
+      d.lineind.mark = mark
+      if d.compobj_lineind is not None:
+        d.compobj_lineind.mark = mark
+      for v in d.vardict.values():
+        if type(v) is Line:
+          v.mark = mark
+    while lines.first().mark != mark:
+      self.ready.append(lines.popfirst())
+    self.flush_at = max(self.flush_lines, 2 * len(lines))
+
+  # Add a "virtual line", possibly spanning multiple lines, to the line list.
+  # Returns the Line of the first line added.
+  def _add_bigline(self, bigline):
+    if bigline is not None:
+      first = None
+      for text in bigline.split('\n'):
+        line = self.lines.append(text)
+        if first is None:
+          first = line
+      return first
+
+  # Frob the inside of a line split by stringre.split() using _modline(),
+  # returning the result.
+  def _frob_line(self, split):
+    return ''.join(self._modline(split))
+
+  # Main function to frob the inside of a line.  Passed a line split by
+  # stringre.split() into alternating text and delimiters composed of
+  # quoted strings and/or comments.  This is a generator function that
+  # returns values with `yield'.
+  def _modline(self, split):
+    for i in xrange(len(split)):
+      prev = None
+      if i > 0:
+        prev = split[i-1]
+      vv = split[i]
+      #debprint("Saw #%d: %s", i, vv)
+
+      # Skip blank sections (e.g. at end of line after a comment)
+      if len(vv) == 0:
+        yield vv
+        continue
+
+      # If we're handling the rest of a multi-line quote or comment from
+      # an earlier line (split without its opening delimiter), don't try to
+      # frob it, just see whether it ends here.
+      if self.old_openquote and i == 1 and prev == "":
+        if self.rules.closes_delim(self.old_openquote, vv):
+          self.openquote = None
+        yield vv
+        continue
+
+      if i % 2 == 1: # We are looking at a delimiter
+
+        # Look for raw-string prefix on strings
+        vv2 = vv
+        # raw will be None if no quote of any sort here, 'r' if a raw Python
+        # string, '' if non-raw string
+        raw = None
+        if vv[0] == 'r' and len(vv) > 1 and vv[1] in single_quote_delims:
+          vv2 = vv[1:]
+          raw = "r"
+        elif vv[0] in single_quote_delims:
+          raw = ""
+
+        # Look for (unclosed) multi-line quote or comment
+        (delimstart, unclosed) = self.rules.multi_line_delim(vv2)
+        saw_multiline_delim = delimstart is not None
+        if saw_multiline_delim:
+          #debprint("Saw multi-line delim %s", delimstart)
+          self.openquote = delimstart if unclosed else None
+
+        if raw is not None: # We're handline some sort of string, frob it
+          if saw_multiline_delim:
+            # FIXME!! Python has eight types of strings: Single and triple
+            # quoted strings, using both single and double quotes (i.e.
+            # ', ", ''', """), as well as the "raw" variants prefixed with r.
+            # Scala has only two types: Strings quoted like "foo", and
+            # raw multiline strings quoted like """foo""".  We're not properly
+            # shoehorning the various types of Python strings into Scala
+            # strings.  The only thing we do is try to convert Python strings
+            # like r"foo" and r'foo' into Scala raw """foo""" strings.
+            #
+            # Note that Scala also has single-character literals like 'f',
+            # whereas Python uses normal strings for this.  We try to do the
+            # right thing here (i.e. leave 'f' as 'f' but convert 'ff' to "ff"),
+            # but we can't be perfect because (a) we don't know whether a
+            # single-character Python string should become a Scala string or
+            # character literal, and (b) since we can be run more than once,
+            # we can't distinguish "f" as a Scala single-character string
+            # (should be left alone) from "f" as a Python single-character
+            # string (potentially convertible to Scala 'f').
+            if vv2.startswith("'''"):
+              if unclosed:
+                yield raw + '"""' + vv2[3:]
+              else:
+                yield raw + '"""' + vv2[3:-3] + '"""'
+            else:
+              yield vv
+            continue
+          for delim in single_quote_delims:
+            if (vv2.startswith(delim) and
+                (vv2 == delim or not vv2.endswith(delim))):
+              self.warning("Saw unfinished single quoted string %s" % vv)
+              yield vv
+              continue
+          revisedstr = vv2
+          if vv2.startswith("'") and (
+              (len(vv2) != 4 if not raw and vv2[1] == '\\' else len(vv2) != 3)
+              ):
+            # Single-quoted string of length != 1
+            # Convert to double-quoted string
+            revisedstr = '"' + vv2[1:-1] + '"'
+          # FIXME! This may fail with unbackslashed quotes of the other
+          # sort in the string.  See comments above about the eight types of
+          # Python strings.
+          if raw:
+            yield '""' + revisedstr + '""'
+          else:
+            yield revisedstr
+          continue
+          # We don't convert in the opposite direction because in Scala
+          # someone might reasonably have a double-quoted string of length 1
+
+        # Convert comments
+        if vv.startswith('#'):
+          yield '//' + vv[1:]
+          continue
+        yield vv
+
+      else:
+        # Not a delimiter
+
+        # Fast path: leave alone code that no rule can change
+        rules = self.rules
+        if not rules.triggerre.search(vv):
+          yield vv
+          continue
+
+        # Whether the code follows a string, for the `%' rule (the string
+        # may be the end of one continued from an earlier line)
+        if i == 2 and self.old_openquote:
+          prev = self.old_openquote
+        after_string = bool(prev) and prev[0] in single_quote_delims
+        memo = self.memo
+        if memo is None:
+          yield self._rewrite_code(vv, after_string)
+          continue
+        # The result depends only on the fragment, whether it follows a
+        # string and the options, which are fixed for the Converter.  Of the
+        # built-in rules only the `%' rule looks at leading spaces, so
+        # otherwise the indentation is left out, letting the same code at
+        # different depths share an entry.  User-defined rules can look at
+        # it (e.g. one anchored with ^), so with them it is kept.
+        indent = ''
+        if not after_string and not rules.user_rules and vv[0] == ' ':
+          code = vv.lstrip(' ')
+          indent = vv[:len(vv) - len(code)]
+          vv = code
+        key = (vv, after_string)
+        result = memo.get(key)
+        if result is None:
+          result = self._rewrite_code(vv, after_string)
+          memo.put(key, result)
+        yield indent + result
+
+  # Return the code fragment VV with the rewrite rules applied.  AFTER_STRING
+  # is whether it follows a string.
+  def _rewrite_code(self, vv, after_string):
+    rules = self.rules
+    if rules.user_rules:
+      vv = rules.user_rules.sub(vv)
+    # or, and, True, False, None (unless Scala) and not
+    vv = rules.keyword_rules.sub(vv)
+    vv = rules.is_none_rule.sub(vv)
+    vv = rules.is_not_none_rule.sub(vv)
+    vv = rules.lambda_rule.sub(vv)
+    # Seems this isn't necessary; (for x <- y if foo) works fine in Scala
+    #vv = re.sub(r'[\[(](.*) for (.*) in (.*) if (.*)[)\]]',
+    #             r'(for (\2 <- \3; if \4) yield \1)', vv)
+    if ' for ' in vv and ' in ' in vv:
+      vv = rules.comprehension_rule.sub(vv)
+    if ' in ' in vv and not re.search(r'\bfor\b', vv):
+      vv = rules.contains_rule.sub(vv)
+    if 'len(' in vv:
+      vv = rules.len_rule.sub(vv)
+    # change % to format but only when applied to string
+    if after_string:
+      vv = rules.format_rule.sub(vv)
+    # pass, and self. and such if removing self
+    vv = rules.statement_rules.sub(vv)
+    if rules.convert_brackets and '[' in vv:
+      vv = rules.brackets_rule.sub(vv)
+    return vv
+
+  def convert_lines(self, infile):
+    '''Convert the Python source lines in INFILE (any iterable of lines, with
+or without line terminators), starting from a fresh state.  This is a
+generator that yields the converted lines, without line terminators.
+Lines are yielded as soon as they can no longer change, so only the part of
+the file that the conversion might still need to modify (e.g. open classes)
+is held in memory (except that with prescan, all of the input is).'''
+    self.reset()
+    if self.prescan:
+      scan = Prescan(self.rules, infile)
+      infile = xrange(len(scan.lines))
+      process_line = lambda i: self._process_prescanned_line(scan, i)
+    else:
+      process_line = self._process_line
+    for line in infile:
+      process_line(line)
+      if self.ready:
+        for outline in self.ready:
+          yield outline
+        del self.ready[:]
+    # At the end, output all remaining lines
+    for line in self.lines:
+      yield line
+
+  # Names of the attributes of the conversion state that carry over from one
+  # top-level block to the next (see at_top_level()); everything else is back
+  # to its initial state there.  The first two are source line numbers, the
+  # rest don't depend on where in the file the block is.
+  carried_state = ('lineno', 'zero_mismatch_lineno', 'curindent',
+                   'zero_mismatch_indent', 'blank_or_comment_line_count',
+                   'prev_blank_or_comment_line_count',
+                   'zero_mismatch_prev_blank_or_comment_line_count')
+
+  def at_top_level(self, line):
+    '''Whether the source line LINE, if it came next, would begin a new
+top-level block: it is not indented, blank or a PY2SCALA directive, it
+isn't part of a logical line, multi-line quote or passthru section begun
+before, and it ends all blocks that are open (which a line that isn't
+indented does only if the line before it was).  Once such a line is seen,
+nothing before it can change any more.'''
+    return (line[:1] not in ('', ' ', '\t', '\r', '\n') and
+            '!!PY2SCALA: ' not in line and not self.contline and
+            not self.openquote and not self.in_ignore_lines and
+            self.paren_mismatch == 0 and
+            (self.curindent > 0 or not (self.indents or self.defs)))
+
+  def end_top_level(self, line):
+    '''End the conversion at the top-level source line LINE (see
+at_top_level()), closing all open blocks the way LINE would.  Returns a tuple
+(LINES, WARNINGS, STATE) of all converted lines not yet returned by
+convert_lines(), the warnings and the values of the attributes in
+carried_state, from which restart() can carry on with LINE.'''
+    self.old_paren_mismatch = self.paren_mismatch
+    self._close_blocks(0, line.rstrip("\r\n").expandtabs())
+    lines = self.ready + list(self.lines)
+    return (lines, self.warnings, self.top_level_state())
+
+  def top_level_state(self):
+    '''Return the values of the attributes in carried_state, as a tuple.'''
+    return tuple(getattr(self, name) for name in self.carried_state)
+
+  def restart(self, state=None):
+    '''Reset the conversion state, as for a new file, but then restore the
+values of the attributes in carried_state from STATE (as returned by
+end_top_level()), if given.'''
+    self.reset()
+    if state:
+      for (name, value) in izip(self.carried_state, state):
+        setattr(self, name, value)
+
+  # Process one line of source.
+  def _process_line(self, line):
+    self.lineno += 1
+
+    # Remove LF or CRLF, convert tabs to spaces
+    line = line.rstrip("\r\n").expandtabs()
+    #debprint("Saw line: %s", line)
+    # If previous line was continued, add it to this line
+    if self.contline:
+      # This is OK because we checked to make sure continuation was not in
+      # a quote or comment
+      line = self.contline.rstrip() + " " + line.lstrip()
+      self.contline = None
+                                  
+    m = re.match('.*!!PY2SCALA: ([A-Z_]+)', line)
     if m:
-      if m.group(2) == ')':
-        bigline = '%s()%s' % (m.group(1), m.group(3))
+      directive = m.group(1)
+      if directive == 'BEGIN_PASSTHRU':
+        self.in_ignore_lines = True
+        self.lines.append(line)
+        return
+      elif directive == 'END_PASSTHRU':
+        self.in_ignore_lines = False
+        self.lines.append(line)
+        return
+    if self.in_ignore_lines:
+      self.lines.append(line)
+      return
+
+    #debprint("Line before splitting: [%s]", line)
+    splitline = self._split_line(line)
+
+    # If line is continued, don't do anything yet (till we get the whole line)
+    lasttext = splitline[-1]
+    if lasttext and lasttext[-1] == '\\':
+      self.contline = line[0:-1]
+      return
+
+    self._process_split_line(line, splitline, self._paren_delta(splitline))
+
+  # Split LINE based on quoted and commented sections.  If we are continuing
+  # a multiline quote, the first section is the rest of it.
+  def _split_line(self, line):
+    if self.openquote:
+      return self.rules.split_quote_rest(self.openquote, line)
+    else:
+      return self.rules.stringre.split(line)
+
+  # Count the mismatch of parens in a split line (see paren_delta())
+  _paren_delta = staticmethod(paren_delta)
+
+  # Process line I of the Prescan SCAN; the equivalent of _process_line().
+  def _process_prescanned_line(self, scan, i):
+    self.lineno += 1
+    kind = scan.kinds[i]
+    if kind == Prescan.LEXED:
+      self._process_split_line(scan.lines[i], scan.split(i),
+                               scan.depths[i + 1] - scan.depths[i])
+    elif kind == Prescan.PASSTHRU:
+      self.lines.append(scan.lines[i])
+
+  # End the blocks at INDENT or more indented, the source line LINE having
+  # been dedented to INDENT, adding braces where needed.  Also ends the
+  # function and class definitions at that indentation.
+  def _close_blocks(self, indent, line):
+    # Pop off all indentation blocks at or more indented than current
+    # position, and add right braces
+    while self.indents and self.indents[-1].indent >= indent:
+      indobj = self.indents.pop()
+      # Can happen, e.g., if // is used in Python to mean "integer division",
+      # or other circumstances where we got confused
+      if self.old_paren_mismatch > 0:
+        self.warning("Apparent unmatched left-paren somewhere before, possibly line %d, we might be confused" % self.zero_mismatch_lineno)
+        # Reset to only mismatched left parens on this line
+        self.paren_mismatch = self.paren_mismatch - self.old_paren_mismatch
+        if self.paren_mismatch < 0:
+          self.paren_mismatch = 0
+      if indobj.ty == "scala":
+        continue
+      rbrace = "%s}" % (' '*indobj.indent)
+      # Check for right brace already present; if so, just make sure
+      # corresponding left brace is present
+      if line.startswith(rbrace):
+        indobj.endind.text += " {"
       else:
-        bigline = '%s(%s' % (m.group(1), m.group(3))
-    if re.match(r'^ *def +__init__\(', bigline):
-      warning("Need to convert to Scala constructor: %s" % bigline)
+        insertpos = self.lines.end
+        # Insert the right brace *before* any blank lines (we skipped over
+        # them since they don't affect indentation)
+        while re.match('^ *$', insertpos.prev.text):
+          insertpos = insertpos.prev
+        # If the "block" is only a single line, and it's not introduced
+        # by "def" or "class", don't add braces.
+        # We check for 2 because with a single-line block, the potential
+        # right-brace insertion point is 2 lines past the opening block
+        # (1 for opening line itself, 1 for block)
+        #debprint("lineno:%s, startind:%s, endind:%s, lines:%s",
+        #    lineno, indobj.startind,
+        #    indobj.endind, len(lines))
+        if (insertpos is not indobj.endind.next and
+            insertpos is not indobj.endind.next.next or
+            re.match('^ *(def|class) ', indobj.startind.text)):
+          indobj.endind.text += " {"
+          self.lines.insert(insertpos, [rbrace])
+    # Pop off all function definitions that have been closed
+    while self.defs and self.defs[-1].indent >= indent:
+      self.defs.pop()
 
-  ######### Handle blocks.
-  
-  front, body, back = "", "", ""
-  frontbody = bigline
-  # Look for a Python statement introducing a block.  Split off leading
-  # indentation and trailing spaces.
-  m = re.match(r'(\s*)(.*?)\s*:\s*$', frontbody, re.S)
-  if m:
-    front, body = m.groups()
-  else:
-    splits = re.split(r'(#|//)', line, 1)
-    if len(splits) == 3:
-      frontbody = splits[0]
-      newback = splits[1] + splits[2]
-      m = re.match(r'''(\s*)([^\'\"]*?)\s*:\s*$''', frontbody, re.S)
+  # Process one line of source, other than a continued line or one passed
+  # through, given the line split by stringre.split() (without any added
+  # delimiter, see above) and the mismatch of parens in it.
+  def _process_split_line(self, line, splitline, parendelta):
+    # Look for blank or comment-only lines.  The rest of a multi-line quote
+    # never counts as either.
+    blankline = not self.openquote and re.match(r'^ *$', line)
+    if not self.openquote and re.match('^ *(#.*|//.*)?$', line):
+      self.blank_or_comment_line_count += 1
+    else:
+      self.prev_blank_or_comment_line_count = self.blank_or_comment_line_count
+      self.blank_or_comment_line_count = 0
+
+    # Record original line, and values of paren_mismatch and openquote
+    # at start of line
+    self.old_paren_mismatch = self.paren_mismatch
+    oldline = line
+    self.old_openquote = self.openquote
+
+    # Count # of mismatched parens (also brackets)
+    self.paren_mismatch += parendelta
+    #debprint("Line %d, old paren mismatch %d, new paren mismatch %d",
+    #    lineno, old_paren_mismatch, paren_mismatch)
+    if self.paren_mismatch < 0:
+      self.warning("Apparent unmatched right-paren, we might be confused: %s%s" %
+                   (self.old_openquote or "", line))
+      self.paren_mismatch = 0
+
+    # Compute current indentation, handle dedenting (may need to insert braces).
+    # Note that blank lines don't have any effect on indentation in Python,
+    # and nor do continued multi-line quotes.
+    if not self.old_openquote and not blankline:
+      # Get current indentation
+      m = re.match('( *)', line)
+      indent = len(m.group(1))
+
+      # Handle dedent: End any blocks as appropriate, and add braces
+      if indent < self.curindent:
+        self._close_blocks(indent, line)
+      # Set indentation value for current line
+      self.curindent = indent
+
+    # Record some values if no paren mismatch or continued quote at start of line
+    if not self.old_openquote and self.old_paren_mismatch == 0:
+      self.zero_mismatch_indent = self.curindent
+      self.zero_mismatch_lineno = self.lineno
+      self.zero_mismatch_prev_blank_or_comment_line_count = self.prev_blank_or_comment_line_count
+
+    ########## Now we modify the line itself
+
+    # Frob the line in various ways (e.g. change 'and' to '&&')
+    line = self._frob_line(splitline)
+
+    # Accumulate a logical line into 'bigline' across unmatched parens and quotes
+    if self.old_paren_mismatch == 0 and not self.old_openquote:
+      assert self.bigline_parts == None
+      self.bigline_parts = [line]
+      self.old_bigline_parts = [oldline]
+      self.bigline_indent = self.curindent
+      self.bigline_lineno = self.lineno
+      assert self.bigline_indent == self.zero_mismatch_indent
+      assert self.bigline_lineno == self.zero_mismatch_lineno
+    else:
+      self.bigline_parts.append(line)
+      self.old_bigline_parts.append(oldline)
+
+    # If we see a Scala-style opening block, just note it; important for
+    # unmatched-paren handling above (in particular where we reset the
+    # unmatched-paren count at the beginning of a block, to deal with
+    # errors in parsing)
+    if self.paren_mismatch == 0 and not self.openquote and (
+        '{' in splitline[-1] and re.match(r'.*\{ *$', splitline[-1])):
+      # (The lines of Scala blocks are never used)
+      self.indents += [Indent(None, None, self.zero_mismatch_indent, "scala")]
+
+    # Error recovery.  If we see a Python block opening, and we're not in
+    # a continued quote, and we were inside a parened or bracketed expr,
+    # something is probably wrong, so reset paren count.
+    if not self.old_openquote and self.old_paren_mismatch > 0 and \
+        re.match(r' *(if|for|with|while|try|elif|else|except|def|class) +.*:.*$',
+                 line):
+      # Can happen, e.g., if // is used in Python to mean "integer division"
+      # but we interpret it as a comment (so a closing paren gets ignored),
+      # or other circumstances where we got confused or the user actually
+      # messed up their parens
+      self.warning("Apparent unmatched left-paren somewhere before, possibly line %d, we might be confused" % self.zero_mismatch_lineno)
+      # Reset to only mismatched parens on this line
+      self.paren_mismatch = self.paren_mismatch - self.old_paren_mismatch
+      if self.paren_mismatch < 0:
+        self.paren_mismatch = 0
+      # Restart the logical line, add any old line to lines[]
+      self._add_bigline('\n'.join(self.bigline_parts))
+      self.bigline_parts = [line]
+      self.old_bigline_parts = [oldline]
+
+    # Error recovery for runaway brackets.  If the logical line has gone on
+    # for max_logical_lines lines, a left-paren was probably never closed, so
+    # end the logical line here rather than carrying on until the next
+    # block opening, or the end of the file.
+    if (self.paren_mismatch > 0 and not self.openquote and
+        self.max_logical_lines and
+        len(self.bigline_parts) >= self.max_logical_lines):
+      self.warning("Logical line longer than %d lines, assuming an unmatched left-paren somewhere before, possibly line %d" % (self.max_logical_lines, self.zero_mismatch_lineno))
+      self.paren_mismatch = 0
+
+    # Skip to next line if this line doesn't really end
+    if self.paren_mismatch > 0 or self.openquote:
+      return
+    self.bigline = '\n'.join(self.bigline_parts)
+    self.old_bigline = '\n'.join(self.old_bigline_parts)
+    self.bigline_parts = self.old_bigline_parts = None
+
+    # Remove self and cls parameters from def(), if called for
+    # Note that we changed 'self' to 'this' above
+    if self.rules.remove_self and 'def' in self.bigline:
+      m = re.match(r'^(\s*def\s+[A-Za-z0-9_]+\s*)\((?:\s*(?:this|cls)\s*)(\)|, *)(.*)$', self.bigline)
       if m:
-        front, body = m.groups()
-        back = " " + newback
-
-  # FIXME: Don't yet handle single-line if statements, e.g. 'if foo: bar'
-
-  # Check for def/class and note function arguments.  We do this separately
-  # from the def check below so we find both def and class, and both
-  # Scala and Python style.
-
-  m = re.match('\s*(def|class)\s+(.*?)(?:\((.*)\))?\s*(:\s*$|=?\s*\{ *$|extends\s.*|with\s.*|\s*$)', bigline, re.S)
-  if m:
-    (ty, name, allargs, coda) = m.groups()
-    argdict = {}
-    # In Python class foo(bar): declarations, bar is a superclass, not
-    # parameters.  If Scala the equivalent decls are parameters, just like
-    # functions in both languages.
-    python_style_class = ty == 'class' and coda and coda[0] == ':'
-    if not python_style_class and allargs and allargs.strip():
-      args = allargs.strip().split(',')
-      # Strip off default assignments
-      args = [x.strip().split('=')[0].strip() for x in args]
-      # Strip off Scala types
-      args = [x.strip().split(':')[0].strip() for x in args]
-      for arg in args:
-        if arg.startswith("var "):
-          argdict[arg[4:].strip()] = "var"
-        elif arg.startswith("val "):
-          argdict[arg[4:].strip()] = "val"
+        if m.group(2) == ')':
+          self.bigline = '%s()%s' % (m.group(1), m.group(3))
         else:
-          argdict[arg] = "val"
-    defs += [Define(ty, name, argdict)]
-    #debprint("Adding args %s for function", argdict)
-
-  # Check for various types of blocks, and substitute.
-  # We only want to check once per line, and Python
-  # unfortunately makes it rather awkward to do convenient if-then checks
-  # with regexps because there's no equivalent of
-  #
-  # if ((m = re.match(...))):
-  #   do something with m.groups()
-  # elif ((m = re.match(...))):
-  #   etc.
-  #
-  # Instead you need assignment and check on separate lines, and so all
-  # ways of chaining multiple regex matches will be awkward.  We choose
-  # to create an infinite loop and break after each match, or at the end.
-  # This almost directly mirrors the architecture of a C switch() statement.
-  #
-  newblock = None
-  while True:
+          self.bigline = '%s(%s' % (m.group(1), m.group(3))
+      if re.match(r'^ *def +__init__\(', self.bigline):
+        self.warning("Need to convert to Scala constructor: %s" % self.bigline)
+
+    ######### Handle blocks.
+  
+    front, body, back = "", "", ""
+    frontbody = self.bigline
+    # Look for a Python statement introducing a block.  Split off leading
+    # indentation and trailing spaces.  Here and below, we check for the
+    # characters needed before looking further, since most lines aren't
+    # blocks (and none are, once converted).
+    code = frontbody.rstrip()
+    if code.endswith(':'):
+      body = code.lstrip()
+      front = code[:len(code) - len(body)]
+      body = body[:-1].rstrip()
+    else:
+      # (This looks at the line including the delimiter of any multi-line
+      # quote continued from the line before)
+      text = (self.old_openquote or "") + line
+      splits = []
+      if ':' in text and ('#' in text or '//' in text):
+        splits = re.split(r'(#|//)', text, maxsplit=1)
+      if len(splits) == 3:
+        frontbody = splits[0]
+        newback = splits[1] + splits[2]
+        m = re.match(r'''(\s*)([^\'\"]*?)\s*:\s*$''', frontbody, re.S)
+        if m:
+          front, body = m.groups()
+          back = " " + newback
+
+    # FIXME: Don't yet handle single-line if statements, e.g. 'if foo: bar'
+
+    # Classify the statement, once for the stages below
+    statement = self.statement = self._classify(body)
+
+    # Note the arguments of a def or class.  We do this separately from the
+    # block check below so we find both def and class, and both Scala and
+    # Python style.
+    self._note_define()
+
+    # Substitute a Python block statement.  If there is none, check for
+    # assignments to variables.
+    newblock = statement.header
+    if newblock is None and self.defs and self.paren_mismatch == 0:
+      self._track_variables()
+
+    # Store logical line or modified block-start line into lines[]
+    if self.bigline is None:
+      return
+    if newblock:
+      startind = self._add_bigline(front + newblock + back)
+      self.indents += [Indent(startind, self.lines.last(), self.bigline_indent, "python")]
+    else:
+      self._add_bigline(self.bigline)
+    self.bigline = None
+
+    if (self.blank_or_comment_line_count == 0 and
+        len(self.lines) >= self.flush_at):
+      self._flush()
+
+  # Return a Statement classifying the logical line in bigline, whose
+  # statement introducing a block (without the colon) is BODY, if any.  Each
+  # regexp is tried only if the leading keyword, or for an assignment an
+  # `=', allows it, so most lines need at most one or two scans.
+  def _classify(self, body):
+    statement = Statement()
+    if self.bigline.lstrip().startswith(('def', 'class')):
+      statement.define = match_define(self.bigline)
     if body:
-      # Check for def
-      m = re.match('def\s+(.*?)\((.*)\)$', body, re.S)
-      if m:
-        newblock = "def %s(%s)" % m.groups()
-        break
-      # Check for 'for' statement
-      m = re.match('for\s+(.*?)\s+in\s+(.*)$', body, re.S)
-      if m:
-        newblock = "for (%s <- %s)" % m.groups()
-        break
-      # Check for 'if' statement
-      m = re.match('if\s+(.*)$', body, re.S)
-      if m:
-        newblock = "if (%s)" % m.groups()
-        break
-      # Check for 'elif' statement
-      m = re.match('elif\s+(.*)$', body, re.S)
-      if m:
-        newblock = "else if (%s)" % m.groups()
-        break
-      # Check for 'else' statement
-      m = re.match('else\s*$', body, re.S)
-      if m:
-        newblock = "else"
-        break
-      # Check for 'while' statement
-      m = re.match('while\s(.*)$', body, re.S)
-      if m:
-        newblock = "while (%s)" % m.groups()
-        break
-      # Check for 'try' statement
-      m = re.match('try\s*$', body, re.S)
+      block = self._block_opener(body)
+      if block:
+        (statement.kind, statement.header) = block
+    # We might have removed a 'self.' from a variable assignment, if
+    # --remove-self was given.  But we want to know whether the assignment
+    # was a self.* variable, so we look in the unfrobbed line.
+    if (statement.header is None and self.defs and
+        '=' in self.old_bigline):
+      m = self.assignre.match(self.old_bigline)
       if m:
-        newblock = "try"
-        break
-      # Check for bare 'except' statement
-      m = re.match('except\s*$', body, re.S)
-      if m:
-        newblock = "catch"
-        break
-      # Check for 'except' statement
-      # FIXME: Should convert to a case statement within the body
-      m = re.match('except\s+(.*)$', body, re.S)
-      if m:
-        newblock = "catch %s" % m.groups()
-        break
-      # Check for 'finally' statement
-      m = re.match('finally\s*$', body, re.S)
-      if m:
-        newblock = "finally"
-        break
-      # Check for 'class(object)' statement
-      # Class that inherits from `object' (new-style class), convert to
-      # class without superclass
-      m = re.match('class\s+(.*)\(object\)', body, re.S)
-      if m:
-        newblock = "class %s" % m.groups()
-        break
-      # Check for 'class(superclass)' statement
-      m = re.match('class\s+(.*)\((.*)\)$', body, re.S)
-      if m:
-        newblock = "class %s extends %s" % m.groups()
-        break
-      # Check for 'class' statement (no superclass)
-      m = re.match('class\s+([^(]*)$', body, re.S)
-      if m:
-        newblock = "class %s" % m.groups()
-        break
+        statement.target = m.group(3)
+        statement.operator = m.group(4).strip()
+    return statement
+
+  # If the logical line in bigline is a def/class, note the function
+  # arguments in a new Define.
+  def _note_define(self):
+    if self.statement.define:
+      (ty, name, allargs, coda) = self.statement.define
+      argdict = {}
+      # In Python class foo(bar): declarations, bar is a superclass, not
+      # parameters.  If Scala the equivalent decls are parameters, just like
+      # functions in both languages.
+      python_style_class = ty == 'class' and coda and coda[0] == ':'
+      if not python_style_class and allargs and allargs.strip():
+        args = allargs.strip().split(',')
+        # Strip off default assignments
+        args = [x.strip().split('=')[0].strip() for x in args]
+        # Strip off Scala types
+        args = [x.strip().split(':')[0].strip() for x in args]
+        for arg in args:
+          if arg.startswith("var "):
+            argdict[arg[4:].strip()] = "var"
+          elif arg.startswith("val "):
+            argdict[arg[4:].strip()] = "val"
+          else:
+            argdict[arg] = "val"
+      self.defs += [Define(ty, name, argdict, self.bigline_lineno,
+                           self.bigline_indent, self.lines.nextline)]
+      #debprint("Adding args %s for function", argdict)
 
-    # Check for assignments and modifying assignments (e.g. +=) to variables
-    # inside of functions.  Add val/var to bare assignments to variables not
-    # yet seen.  Initially we add 'val', but if we later see the variable
-    # being reassigned or modified, we change it to 'var'.  Also look for
-    # self.* variables, but handle them differently.  For one,
-    # they logically belong to the class, not the function they're in,
-    # so we need to find the right dictionary to store them in.  Also,
-    # we don't add 'val' or 'var' to them unless we see them in __init__(),
-    # and in that case we move them outside the __init__() so they end up
-    # in class scope. Existing variables at class scope get moved to
-    # companion objects. (Note the following: Variables declared at class
-    # scope are instance variables in Scala, but class variables in Python.
-    # Instance variables in Python are set using assignments to self.*;
-    # class variables in Scala are stored in a companion object.)
+  # Return (KIND, HEADER) for BODY, a Python statement introducing a block
+  # (without the colon), where HEADER is its Scala version, e.g. "if (foo)"
+  # for "if foo", and KIND the kind of statement (see block_statements); or
+  # None if it isn't one.  Only the variants for the leading keyword of
+  # BODY are tried.
+  def _block_opener(self, body):
+    keyword = keywordre.match(body).group(1)
+    for (regexp, template, kind) in block_statements.get(keyword, ()):
+      m = regexp.match(body)
+      if m:
+        return (kind, template % m.groups())
+    return None
 
+  # Check for assignments and modifying assignments (e.g. +=) to variables
+  # inside of functions.  Add val/var to bare assignments to variables not
+  # yet seen.  Initially we add 'val', but if we later see the variable
+  # being reassigned or modified, we change it to 'var'.  Also look for
+  # self.* variables, but handle them differently.  For one,
+  # they logically belong to the class, not the function they're in,
+  # so we need to find the right dictionary to store them in.  Also,
+  # we don't add 'val' or 'var' to them unless we see them in __init__(),
+  # and in that case we move them outside the __init__() so they end up
+  # in class scope. Existing variables at class scope get moved to
+  # companion objects. (Note the following: Variables declared at class
+  # scope are instance variables in Scala, but class variables in Python.
+  # Instance variables in Python are set using assignments to self.*;
+  # class variables in Scala are stored in a companion object.)
+  def _track_variables(self):
     #debprint("About to check for vars, line %d, fun %s",
     #    lineno, defs and defs[-1].name)
-    if defs and paren_mismatch == 0:
-      # Retrieve most recent def/class definition
-      dd = defs[-1]
-      #debprint("Checking for vars, line %d, old_bigline[%s], bigline[%s]", lineno, old_bigline, bigline)
-
-      # We might have removed a 'self.' from a variable assignment, if
-      # --remove-self was given.  But we want to know whether the assignment
-      # was a self.* variable.  So we first look for an assignment in the
-      # unfrobbed line, and if so, retrieve the variable name, and then
-      # look at the frobbed line to get everything else (in particular,
-      # the RHS, which might have been frobbed).
-      assignre = re.compile('(\s*)(val\s+|var\s+|)((?:self\.|cls\.)?[a-zA-Z_][a-zA-Z_0-9]*)(\s*[+\-*/]?=)(.*)', re.S)
-      m = assignre.match(old_bigline)
-      if m:
-        (_, _, varvar, _, _) = m.groups()
-        m = assignre.match(bigline)
-      if m:
-        (newindent, newvaldecl, _, neweq, newrhs) = m.groups()
-        #debprint("lineno: %d, Saw var: %s", lineno, varvar)
-        is_self = varvar.startswith("self.") or varvar.startswith("cls.")
-        # An assignment rather than a += or whatever
-        is_assign = neweq.strip() == '='
-        # If this a Python-style variable assignment at class level?  If so,
-        # it's a class var, and we will move it to the companion object
-        is_new_class_var = (not newvaldecl and is_assign and
-            dd.ty == 'class' and not is_self)
-        # If a class var, give it a 'cls.' prefix in the variable-assignment
-        # dictionary, so we can match later refs to the var.  After this,
-        # 'varvar' is the name of the var as recorded in the vardict, but
-        # 'orig_varvar' is the actual name of the var in the text of the
-        # program.
-        orig_varvar = varvar
-        if is_new_class_var:
-          varvar = 'cls.' + varvar
-        # Don't add var/val to a self.foo assignment unless it's in an
-        # __init__() method (in which case it gets moved to class scope)
-        ok_to_var_self = is_self and dd.ty == 'def' and dd.name == '__init__'
-        curvardict = dd.vardict
-        if is_self:
-          # For a self.* variable, find the class vardict instead of the
-          # vardict of the current function.
-          i = len(defs) - 1
-          while i > 0 and defs[i].ty != 'class':
-            i -= 1
-            curvardict = defs[i].vardict
-        if newvaldecl:
-          # The text had an explicit var/val decl (Scala-style)
-          if varvar in curvardict:
-            warning("Apparent redefinition of variable %s" % varvar)
-          else:
-            # Signal not to try and change val to var
-            curvardict[varvar] = "explicit"
+    # The variable name comes from the unfrobbed line (see _classify())
+    varvar = self.statement.target
+    if varvar is None:
+      return
+    # Retrieve most recent def/class definition
+    dd = self.defs[-1]
+    #debprint("Checking for vars, line %d, old_bigline[%s], bigline[%s]", lineno, old_bigline, bigline)
+
+    # Look at the frobbed line to get everything else (in particular, the
+    # RHS, which might have been frobbed).
+    m = self.assignre.match(self.bigline)
+    if m:
+      (newindent, newvaldecl, _, neweq, newrhs) = m.groups()
+      #debprint("lineno: %d, Saw var: %s", lineno, varvar)
+      is_self = varvar.startswith("self.") or varvar.startswith("cls.")
+      # An assignment rather than a += or whatever
+      is_assign = neweq.strip() == '='
+      # If this a Python-style variable assignment at class level?  If so,
+      # it's a class var, and we will move it to the companion object
+      is_new_class_var = (not newvaldecl and is_assign and
+          dd.ty == 'class' and not is_self)
+      # If a class var, give it a 'cls.' prefix in the variable-assignment
+      # dictionary, so we can match later refs to the var.  After this,
+      # 'varvar' is the name of the var as recorded in the vardict, but
+      # 'orig_varvar' is the actual name of the var in the text of the
+      # program.
+      orig_varvar = varvar
+      if is_new_class_var:
+        varvar = 'cls.' + varvar
+      # Don't add var/val to a self.foo assignment unless it's in an
+      # __init__() method (in which case it gets moved to class scope)
+      ok_to_var_self = is_self and dd.ty == 'def' and dd.name == '__init__'
+      curvardict = dd.vardict
+      classdef = dd
+      # The declaration added, if any
+      newdecl = None
+      if is_self:
+        # For a self.* variable, find the class vardict instead of the
+        # vardict of the current function.
+        i = len(self.defs) - 1
+        while i > 0 and self.defs[i].ty != 'class':
+          i -= 1
+          curvardict = self.defs[i].vardict
+        classdef = self.defs[i]
+      if newvaldecl:
+        # The text had an explicit var/val decl (Scala-style)
+        if varvar in curvardict:
+          self.warning("Apparent redefinition of variable %s" % varvar)
         else:
-          # This is a Python-style variable (no declaration), or Scala-style
-          # assignment to existing variable.
-          #debprint("varvar: %s, curvardict: %s", varvar, curvardict)
-          if varvar not in curvardict:
-            if not is_assign:
-              # We saw 'foo += 1' or similar, but no previous assignment
-              # to 'foo'.
-              warning("Apparent attempt to modify non-existent variable %s" % varvar)
+          # Signal not to try and change val to var
+          curvardict[varvar] = "explicit"
+      else:
+        # This is a Python-style variable (no declaration), or Scala-style
+        # assignment to existing variable.
+        #debprint("varvar: %s, curvardict: %s", varvar, curvardict)
+        if varvar not in curvardict:
+          if not is_assign:
+            # We saw 'foo += 1' or similar, but no previous assignment
+            # to 'foo'.
+            self.warning("Apparent attempt to modify non-existent variable %s" % varvar)
+          else:
+            # First time we see an assignment.  Convert to a Scala
+            # declaration and record the number.  We convert it to 'val',
+            # but we may go back later and change to 'var'; unless the
+            # symbol index says the variable is reassigned somewhere, or
+            # that it's an attribute declared by a base class, which we
+            # don't declare again.
+            decl = 'val'
+            if self.symbols and (is_self or is_new_class_var):
+              decl = self._indexed_declaration(classdef, orig_varvar)
+            if decl is None:
+              curvardict[varvar] = "explicit"
             else:
-              # First time we see an assignment.  Convert to a Scala
-              # declaration and record the number.  We convert it to 'val',
-              # but we may go back later and change to 'var'.
-              curvardict[varvar] = len(lines)
+              curvardict[varvar] = self.lines.nextline
               if not is_self or ok_to_var_self:
-                bigline = "%sval %s%s%s%s" % (newindent, newvaldecl, orig_varvar, neweq, newrhs)
-          else:
-            # Variable is being reassigned, so change declaration to 'var'.
-            vardefline = curvardict[varvar]
-            if vardefline == "val":
-              warning("Attempt to set function parameter %s" % varvar)
-            elif type(vardefline) is int:
-              #debprint("Subbing var for val in [%s]", lines[vardefline])
-              lines[vardefline] = re.sub(r'^( *)val ', r'\1var ',
-                lines[vardefline])
-          if is_new_class_var:
-            # Bare assignment to variable at class level, without 'var/val'.
-            # This is presumably a Python-style class var, so move the
-            # variable (and preceding comments) to the companion object,
-            # creating one if necessary.
-            if dd.compobj_lineind is None:
-              # We need to create a companion object.
-              lines[dd.lineind:dd.lineind] = \
-                  ['%sobject %s {' % (' '*dd.indent, dd.name),
-                   '%s}' % (' '*dd.indent),
-                   '']
-              # This should adjust dd.lineind up by 3!
-              old_lineind = dd.lineind
-              adjust_lineinds(dd.lineind, 3)
-              assert dd.lineind == old_lineind + 3
-              dd.compobj_lineind = dd.lineind - 2
-            # Now move the variable assignment itself.
-            inslines = bigline.split('\n')
-            inspoint = dd.compobj_lineind
-            lines[inspoint:inspoint] = inslines
-            adjust_lineinds(inspoint, len(inslines))
-            curvardict[varvar] = inspoint
-            # Also move any blank or comment lines directly before.
-            bcomcount = zero_mismatch_prev_blank_or_comment_line_count
-            #debprint("Moving var %s, lineno=%s, bcomcount=%s",
-            #    varvar, lineno, bcomcount)
-            if bcomcount > 0:
-              lines[inspoint:inspoint] = (
-                  lines[-bcomcount:])
-              adjust_lineinds(inspoint, bcomcount)
-              del lines[-bcomcount:]
-              adjust_lineinds(len(lines)+1, -bcomcount)
-
-            bigline = None
-        if ok_to_var_self and bigline.strip().startswith('val '):
-          # If we've seen a self.* variable assignment in an __init__()
-          # function, move it outside of the init statement, along with
-          # any comments.
-          bigline = ' '*dd.indent + bigline.lstrip()
-          inslines = bigline.split('\n')
-          inspoint = dd.lineind
-          lines[inspoint:inspoint] = inslines
-          adjust_lineinds(inspoint, len(inslines))
-          if type(curvardict[varvar]) is int:
-            curvardict[varvar] = inspoint
-          bcomcount = zero_mismatch_prev_blank_or_comment_line_count
+                newdecl = decl
+                self.bigline = "%s%s %s%s%s%s" % (newindent, decl, newvaldecl, orig_varvar, neweq, newrhs)
+        else:
+          # Variable is being reassigned, so change declaration to 'var'.
+          vardefline = curvardict[varvar]
+          if vardefline == "val":
+            self.warning("Attempt to set function parameter %s" % varvar)
+          elif type(vardefline) is Line:
+            #debprint("Subbing var for val in [%s]", vardefline.text)
+            self._make_var(vardefline)
+        if is_new_class_var:
+          # Bare assignment to variable at class level, without 'var/val'.
+          # This is presumably a Python-style class var, so move the
+          # variable (and preceding comments) to the companion object,
+          # creating one if necessary.
+          if dd.compobj_lineind is None:
+            # We need to create a companion object.
+            objline = self.lines.insert(dd.lineind,
+                ['%sobject %s {' % (' '*dd.indent, dd.name),
+                 '%s}' % (' '*dd.indent),
+                 ''])
+            dd.compobj_lineind = objline.next
+          # Now move the variable assignment itself.
+          inslines = self.bigline.split('\n')
+          inspoint = self.lines.insert(dd.compobj_lineind, inslines)
+          curvardict[varvar] = inspoint
+          # Also move any blank or comment lines directly before.
+          bcomcount = self.zero_mismatch_prev_blank_or_comment_line_count
+          #debprint("Moving var %s, lineno=%s, bcomcount=%s",
+          #    varvar, lineno, bcomcount)
           if bcomcount > 0:
-            # Move comments, but beforehand fix indentation
-            for i in xrange(bcomcount):
-              lines[-(i+1)] = re.sub(r'^( *)', ' '*dd.indent, lines[-(i+1)])
-            lines[inspoint:inspoint] = (
-                lines[-bcomcount:])
-            adjust_lineinds(inspoint, bcomcount)
-            del lines[-bcomcount:]
-            adjust_lineinds(len(lines)+1, -bcomcount)
-          bigline = None
-
-    break
-
-  # Store logical line or modified block-start line into lines[]
-  if bigline is None:
-    continue
-  if newblock:
-    startind = len(lines)
-    add_bigline(front + newblock + back)
-    indents += [Indent(startind, len(lines)-1, bigline_indent, "python")]
+            self.lines.move_last(bcomcount, inspoint)
+
+          self.bigline = None
+      if ok_to_var_self and (newdecl or
+                             self.bigline.strip().startswith('val ')):
+        # If we've seen a self.* variable assignment in an __init__()
+        # function, move it outside of the init statement, along with
+        # any comments.
+        self.bigline = ' '*dd.indent + self.bigline.lstrip()
+        inslines = self.bigline.split('\n')
+        inspoint = self.lines.insert(dd.lineind, inslines)
+        if type(curvardict[varvar]) is Line:
+          curvardict[varvar] = inspoint
+        bcomcount = self.zero_mismatch_prev_blank_or_comment_line_count
+        if bcomcount > 0:
+          # Move comments, but beforehand fix indentation
+          comline = self.lines.last()
+          for i in xrange(bcomcount):
+            comline.text = re.sub(r'^( *)', ' '*dd.indent, comline.text)
+            comline = comline.prev
+          self.lines.move_last(bcomcount, inspoint)
+        self.bigline = None
+
+  # Return the declaration to give the first assignment to VARNAME, a class
+  # variable or self.* or cls.* variable of the class defined by CLASSDEF
+  # (a Define), going by the symbol index: 'var' if it is reassigned
+  # anywhere, 'val' if not, or None for a self.* attribute declared by a
+  # base class.
+  def _indexed_declaration(self, classdef, varname):
+    if classdef.ty != 'class':
+      return 'val'
+    symbols = self.symbols
+    if varname.startswith('self.'):
+      attr = varname[5:]
+      if symbols.attribute_inherited(classdef.name, attr):
+        return None
+      reassigned = symbols.attribute_reassigned(classdef.name, attr)
+    else:
+      if varname.startswith('cls.'):
+        varname = varname[4:]
+      reassigned = symbols.class_var_reassigned(classdef.name, varname)
+    return reassigned and 'var' or 'val'
+
+  # Change the declaration on VARDEFLINE (a Line) from val to var, the
+  # variable declared having been reassigned.
+  def _make_var(self, vardefline):
+    vardefline.text = re.sub(r'^( *)val ', r'\1var ', vardefline.text)
+
+
+###########################################################################
+#
+# Profiling
+#
+###########################################################################
+
+class InstrumentedConverter(Converter):
+  '''Base class for Converters that measure the conversion as they go,
+file by file (ProfilingConverter and TracingConverter).  Subclasses define
+begin_file(), called at the beginning of the input and of each file read
+through input_files(), and line_done(), called with the time taken to
+process each source line.'''
+
+  def __init__(self, options=None, warnfile=None):
+    Converter.__init__(self, options, warnfile)
+    # (LINECOUNT, NAME) for each file seen by input_files() that hasn't
+    # begun yet, LINECOUNT being the number of lines before it
+    self.file_starts = collections.deque()
+    self.begin_file('<input>')
+
+  def input_files(self, sources):
+    '''Return the lines of SOURCES, a list of (NAME, LINES) for each input
+file, calling begin_file() at the beginning of each file.  The files are
+noted as they are read and begun when their first line is processed, since
+with prescan all of the input is read first.'''
+    count = 0
+    for (name, lines) in sources:
+      self.file_starts.append((count, name))
+      for line in lines:
+        count += 1
+        yield line
+
+  def begin_file(self, name):
+    '''Called when the source NAME begins, after self.lineno lines.'''
+    pass
+
+  def line_done(self, elapsed):
+    '''Called after each source line, with the time ELAPSED taken to
+process it.'''
+    pass
+
+  # Begin the next file if its first line is next (skipping empty files).
+  def _check_file_start(self):
+    while self.file_starts and self.file_starts[0][0] == self.lineno:
+      self.begin_file(self.file_starts.popleft()[1])
+
+  def _process_line(self, line):
+    self._check_file_start()
+    start = time.time()
+    Converter._process_line(self, line)
+    self.line_done(time.time() - start)
+
+  def _process_prescanned_line(self, scan, i):
+    self._check_file_start()
+    start = time.time()
+    Converter._process_prescanned_line(self, scan, i)
+    self.line_done(time.time() - start)
+
+class StageProfile(object):
+  '''The time spent in each stage of converting the source NAME, as
+measured by ProfilingConverter.  LINEOFFSET is the number of lines converted
+before NAME in the same conversion, so that line numbers can be reported
+relative to NAME.'''
+
+  def __init__(self, name, lineoffset=0):
+    self.name = name
+    self.lineoffset = lineoffset
+    # Number of lines processed, and the time taken
+    self.lines = 0
+    self.total = 0.0
+    # Time taken and number of calls, by stage
+    self.times = dict((stage, 0.0) for stage in ProfilingConverter.stages)
+    self.calls = dict((stage, 0) for stage in ProfilingConverter.stages)
+    # Time taken by each logical line, by the line number where it starts
+    self.line_times = {}
+
+  def report(self, slowest=10, outfile=sys.stderr):
+    '''Print a report of the times to OUTFILE, including the SLOWEST slowest
+logical lines.'''
+    print("Stage profile for %s: %d lines in %.1f ms" % (
+      self.name, self.lines, self.total * 1000), file=outfile)
+    print("  %-10s %8s %10s %6s" % ("stage", "calls", "ms", "%"),
+          file=outfile)
+    other = self.total
+    for stage in ProfilingConverter.stages:
+      other -= self.times[stage]
+      print("  %-10s %8d %10.1f %5.1f%%" % (
+        stage, self.calls[stage], self.times[stage] * 1000,
+        100 * self.times[stage] / max(self.total, 1e-9)), file=outfile)
+    print("  %-10s %8s %10.1f %5.1f%%" % (
+      "other", "", other * 1000, 100 * other / max(self.total, 1e-9)),
+          file=outfile)
+    lines = sorted(self.line_times.items(), key=lambda x: -x[1])
+    if lines:
+      print("  Slowest logical lines:", file=outfile)
+      for (lineno, t) in lines[:slowest]:
+        print("    line %-8d %8.2f ms" % (lineno - self.lineoffset,
+                                          t * 1000), file=outfile)
+
+class ProfilingConverter(InstrumentedConverter):
+  '''A Converter that also measures the wall time spent in each stage of
+the conversion, and in each logical line, for --profile-stages.  The times go
+into the StageProfile `profile'; a new one is started for each file if the
+input comes through input_files().  Converter itself has no timing code at
+all, so conversion costs nothing extra unless this class is used.  With
+prescan, the splitting of lines is done up front, and isn't included.'''
+
+  # The stages timed: splitting lines into code, strings and comments,
+  # counting parens, closing blocks at dedents (adding braces), frobbing the
+  # code with _modline(), classifying logical lines (recognizing def/class,
+  # block statements and assignments), noting def/class arguments, and
+  # tracking variables (including moving lines)
+  stages = ['split', 'parens', 'dedent', 'modline', 'classify', 'defs',
+            'variables']
+
+  # Number of slowest logical lines to report
+  slowest_count = 10
+
+  def __init__(self, options=None, warnfile=None):
+    # StageProfiles, for each file in turn
+    self.profiles = []
+    InstrumentedConverter.__init__(self, options, warnfile)
+
+  def begin_file(self, name):
+    '''Start a new StageProfile for the source NAME.'''
+    self.profile = StageProfile(name, self.lineno)
+    self.profiles.append(self.profile)
+
+  def line_done(self, elapsed):
+    profile = self.profile
+    profile.total += elapsed
+    profile.lines += 1
+
+  def report(self, outfile=sys.stderr):
+    '''Print the StageProfiles of all the files to OUTFILE, and the use of
+the FragmentMemo.'''
+    for profile in self.profiles:
+      if profile.lines:
+        profile.report(self.slowest_count, outfile)
+    if self.memo:
+      self.memo.report(outfile)
+
+  def _timed(self, stage, fun, *args):
+    start = time.time()
+    result = fun(*args)
+    profile = self.profile
+    profile.times[stage] += time.time() - start
+    profile.calls[stage] += 1
+    return result
+
+  def _process_split_line(self, line, splitline, parendelta):
+    start = time.time()
+    Converter._process_split_line(self, line, splitline, parendelta)
+    # The logical line is still current, or just finished
+    line_times = self.profile.line_times
+    line_times[self.bigline_lineno] = (line_times.get(self.bigline_lineno, 0) +
+                                       time.time() - start)
+
+  def _split_line(self, line):
+    return self._timed('split', Converter._split_line, self, line)
+
+  def _paren_delta(self, splitline):
+    return self._timed('parens', paren_delta, splitline)
+
+  def _close_blocks(self, indent, line):
+    return self._timed('dedent', Converter._close_blocks, self, indent, line)
+
+  def _frob_line(self, split):
+    return self._timed('modline', Converter._frob_line, self, split)
+
+  def _note_define(self):
+    return self._timed('defs', Converter._note_define, self)
+
+  def _classify(self, body):
+    return self._timed('classify', Converter._classify, self, body)
+
+  def _track_variables(self):
+    return self._timed('variables', Converter._track_variables, self)
+
+###########################################################################
+#
+# Rule tracing
+#
+###########################################################################
+
+class RuleTrace(object):
+  '''How many times each rewrite rule was applied, how many times it fired
+(changed something) and the time it took, as counted by TracingConverter
+for --trace-rules.  Rules are identified by name (see TracingConverter).'''
+
+  def __init__(self):
+    # Number of lines processed, and the time taken
+    self.lines = 0
+    self.total = 0.0
+    # Times applied and fired, and time taken, by rule
+    self.applied = {}
+    self.fired = {}
+    self.times = {}
+
+  def add(self, rule, fired, elapsed):
+    '''Count one application of RULE, taking ELAPSED seconds, and whether it
+FIRED.'''
+    self.applied[rule] = self.applied.get(rule, 0) + 1
+    self.times[rule] = self.times.get(rule, 0.0) + elapsed
+    if fired:
+      self.fired[rule] = self.fired.get(rule, 0) + 1
+
+  def add_word(self, rule, word):
+    '''Count a replacement of WORD by the word rules RULE.'''
+    name = '%s: %s' % (rule, word)
+    self.fired[name] = self.fired.get(name, 0) + 1
+
+  def report(self, outfile=sys.stderr):
+    '''Print the counts to OUTFILE, the rules that took the most time first,
+each of the word rules followed by the number of times each word was
+replaced.'''
+    print("Rule trace: %d lines in %.1f ms" % (self.lines,
+                                               self.total * 1000),
+          file=outfile)
+    print("  %-22s %8s %8s %10s %6s" % (
+      "rule", "applied", "fired", "ms", "%"), file=outfile)
+    for rule in sorted(self.times, key=lambda r: (-self.times[r], r)):
+      print("  %-22s %8d %8d %10.1f %5.1f%%" % (
+        rule, self.applied[rule], self.fired.get(rule, 0),
+        self.times[rule] * 1000,
+        100 * self.times[rule] / max(self.total, 1e-9)), file=outfile)
+      prefix = rule + ': '
+      words = [name for name in self.fired if name.startswith(prefix)]
+      for name in sorted(words, key=lambda w: (-self.fired[w], w)):
+        print("    %-20s %8s %8d" % (name[len(prefix):], "",
+                                     self.fired[name]), file=outfile)
+
+# A rule of a RuleSet wrapped to report each use of it to CONVERTER, a
+# TracingConverter, as rule NAME.
+class TracedRule(object):
+  def __init__(self, name, rule, converter):
+    self.name = name
+    self.rule = rule
+    self.converter = converter
+
+  def sub(self, text):
+    start = time.time()
+    result = self.rule.sub(text)
+    elapsed = time.time() - start
+    converter = self.converter
+    converter.rewrite(self.name, converter.lineno, text, result, elapsed)
+    return result
+
+# A TracedRule for WordRules, which also counts the words replaced.
+class TracedWordRules(TracedRule):
+  def sub(self, text):
+    table = self.rule.table
+    words = []
+    def replace(m):
+      words.append(m.group())
+      return table[m.group()]
+    start = time.time()
+    result = self.rule.regexp.sub(replace, text)
+    elapsed = time.time() - start
+    converter = self.converter
+    converter.rewrite(self.name, converter.lineno, text, result, elapsed)
+    for word in words:
+      converter.trace.add_word(self.name, word)
+    return result
+
+class TracingConverter(InstrumentedConverter):
+  '''A Converter that also counts how often each of its rewrite rules is
+applied and fires, and the time each takes, for --trace-rules.  The counts
+go into the RuleTrace `trace'.  The rules traced are those applied to code
+fragments by _modline() (see traced_rules), the kinds of block statement
+converted by _block_opener() (named "block def", "block for" and so on,
+with "block (none)" for lines that aren't one) and the changing of a
+declaration from val to var when a variable is reassigned ("val-to-var").
+If LOGFILE is given, each rewrite is also written to it as a line of JSON:
+an object with the source `file', the `line' number in it, the `rule' and
+the text `before' and `after'.  As with ProfilingConverter, Converter itself
+has no code for this, so it costs nothing unless this class is used.  The
+FragmentMemo is turned off, so that every rule application is counted.'''
+
+  # The rules of the RuleSet traced, as (NAME, ATTRIBUTE)
+  traced_rules = [
+    ('user', 'user_rules'),
+    ('keywords', 'keyword_rules'),
+    ('is-none', 'is_none_rule'),
+    ('is-not-none', 'is_not_none_rule'),
+    ('lambda', 'lambda_rule'),
+    ('comprehension', 'comprehension_rule'),
+    ('contains', 'contains_rule'),
+    ('len', 'len_rule'),
+    ('format', 'format_rule'),
+    ('statements', 'statement_rules'),
+    ('brackets', 'brackets_rule'),
+  ]
+
+  def __init__(self, options=None, warnfile=None, logfile=None):
+    self.trace = RuleTrace()
+    self.logfile = logfile
+    InstrumentedConverter.__init__(self, options, warnfile)
+    self.memo = None
+    # Trace the rules in a copy of the RuleSet, which is shared with other
+    # Converters
+    self.rules = copy.copy(self.rules)
+    for (name, attr) in self.traced_rules:
+      rule = getattr(self.rules, attr)
+      if rule is None:
+        continue
+      if isinstance(rule, WordRules):
+        rule = TracedWordRules(name, rule, self)
+      else:
+        rule = TracedRule(name, rule, self)
+      setattr(self.rules, attr, rule)
+
+  def begin_file(self, name):
+    self.source = name
+    self.lineoffset = self.lineno
+
+  def line_done(self, elapsed):
+    self.trace.lines += 1
+    self.trace.total += elapsed
+
+  def rewrite(self, rule, lineno, before, after, elapsed, fired=None):
+    '''Count an application of RULE to the text BEFORE from source line
+LINENO, which gave AFTER and took ELAPSED seconds, and log it if the rule
+fired.  Unless FIRED is given, the rule fired if it changed the text.'''
+    if fired is None:
+      fired = after != before
+    self.trace.add(rule, fired, elapsed)
+    if fired and self.logfile:
+      entry = {'file': self.source, 'line': lineno - self.lineoffset,
+               'rule': rule, 'before': json_text(before),
+               'after': json_text(after)}
+      self.logfile.write(json.dumps(entry, sort_keys=True) + '\n')
+
+  def report(self, outfile=sys.stderr):
+    '''Print the counts to OUTFILE.'''
+    self.trace.report(outfile)
+
+  def _block_opener(self, body):
+    start = time.time()
+    block = Converter._block_opener(self, body)
+    elapsed = time.time() - start
+    if block is None:
+      self.trace.add('block (none)', False, elapsed)
+    else:
+      (kind, newblock) = block
+      self.rewrite('block ' + kind, self.bigline_lineno, body, newblock,
+                   elapsed, fired=True)
+    return block
+
+  def _make_var(self, vardefline):
+    before = vardefline.text
+    start = time.time()
+    Converter._make_var(self, vardefline)
+    self.rewrite('val-to-var', self.bigline_lineno, before, vardefline.text,
+                 time.time() - start)
+
+class RewriteStats(object):
+  '''Counts of the lines of the source NAME that the rewrite rules left
+alone or changed, as counted by RewriteStatsConverter for --rewrite-stats.'''
+
+  def __init__(self, name):
+    self.name = name
+    # Number of lines processed
+    self.lines = 0
+    # Line numbers of the lines whose code the fast path in _modline()
+    # passed through without trying any rules on it.  Those that were
+    # changed anyway (e.g. a comment, or a brace added) aren't counted as
+    # skipped, so that no line is counted both as skipped and as rewritten.
+    self.skipped = set()
+    # Line numbers of the lines changed, either by _modline() or as part of
+    # a logical line changed by the block, def or variable handling
+    self.rewritten = set()
+
+  def report(self, outfile=sys.stderr):
+    '''Print the counts to OUTFILE.'''
+    print("%s: %d lines, %d skipped by the fast path, "
+          "%d rewritten (%.1f%%)" % (
+      self.name, self.lines, len(self.skipped - self.rewritten),
+      len(self.rewritten),
+      100.0 * len(self.rewritten) / max(self.lines, 1)), file=outfile)
+
+class RewriteStatsConverter(InstrumentedConverter):
+  '''A Converter that also counts, for each file, how many lines no rewrite
+rule could apply to and how many lines were changed, for --rewrite-stats.
+A file that has been converted already (with the same options) has no lines
+changed, except for any that need fixing by hand.  The counts go into the
+RewriteStats `stats'; a new one is started for each file if the input comes
+through input_files().'''
+
+  def __init__(self, options=None, warnfile=None):
+    # RewriteStats, for each file in turn
+    self.allstats = []
+    InstrumentedConverter.__init__(self, options, warnfile)
+
+  def begin_file(self, name):
+    self.stats = RewriteStats(name)
+    self.allstats.append(self.stats)
+
+  def line_done(self, elapsed):
+    self.stats.lines += 1
+
+  def report(self, outfile=sys.stderr):
+    '''Print the counts for all the files to OUTFILE, and the use of the
+FragmentMemo.'''
+    for stats in self.allstats:
+      if stats.lines:
+        stats.report(outfile)
+    if self.memo:
+      self.memo.report(outfile)
+
+  def _frob_line(self, split):
+    result = Converter._frob_line(self, split)
+    triggerre = self.rules.triggerre
+    # The same test as _modline() makes
+    if not any(triggerre.search(vv) for vv in split[0::2]):
+      self.stats.skipped.add(self.lineno)
+    if result != ''.join(split):
+      self.stats.rewritten.add(self.lineno)
+    return result
+
+  def _block_opener(self, body):
+    block = Converter._block_opener(self, body)
+    if block is not None:
+      # Even if the text stays the same (e.g. `else'), a brace gets added
+      self.stats.rewritten.add(self.bigline_lineno)
+    return block
+
+  def _track_variables(self):
+    before = self.bigline
+    Converter._track_variables(self)
+    if self.bigline != before:
+      self.stats.rewritten.add(self.bigline_lineno)
+
+# Return TEXT, a string from the source, as Unicode for JSON, replacing
+# anything that isn't valid UTF-8.
+def json_text(text):
+  if not py3 and type(text) is unicode:
+    return text
+  return encode_output(text).decode('utf-8', 'replace')
+
+###########################################################################
+#
+# Incremental conversion
+#
+###########################################################################
+
+# A run of source lines converted together: a top-level block, plus any
+# blank lines, comments and other top-level statements up to the next one.
+class Segment(object):
+  # start: Index of the first source line
+  # size: Number of source lines
+  # state: The carried conversion state at the start (see
+  #   Converter.carried_state)
+  # lines: The converted lines
+  # warnings: The warnings, as (LINENO, TEXT) tuples
+  __slots__ = ('start', 'size', 'state', 'lines', 'warnings')
+
+  def __init__(self, start, size, state, lines, warnings):
+    self.start = start
+    self.size = size
+    self.state = state
+    self.lines = lines
+    self.warnings = warnings
+
+  # Return a copy of the segment moved BY lines down in the source.
+  def shifted(self, by):
+    if not by:
+      return self
+    state = (self.state[0] + by, self.state[1] + by) + self.state[2:]
+    return Segment(self.start + by, self.size, state, self.lines,
+                   [(lineno + by, text) for (lineno, text) in self.warnings])
+
+  # Whether the text of a warning mentions a line number, so the segment
+  # can't simply be moved with shifted().
+  def mentions_lines(self):
+    for (lineno, text) in self.warnings:
+      if re.search(r'\bline [0-9]', text):
+        return True
+    return False
+
+class IncrementalConverter(object):
+  '''Convert successive versions of the same file, reconverting only what
+changed.  The conversion is cut into segments at the start of each top-level
+block (see Converter.at_top_level()), recording the little conversion state
+that carries over.  When a new version is converted, the segments before the
+first changed line are kept, conversion restarts at the segment containing
+it, and as soon as it gets back in step with an old segment after the last
+changed line, the rest of the old segments are reused.  The result is
+always the same as converting the new version with Converter.convert_lines().
+OPTIONS are as for Converter.'''
+
+  def __init__(self, options=None):
+    self.converter = Converter(options)
+    # Source lines of the last version converted
+    self.source = []
+    # Its Segments
+    self.segments = []
+    # Number of segments of the last version that were reused, and converted
+    self.reused = 0
+    self.converted = 0
+
+  def convert(self, source):
+    '''Convert SOURCE, a list of source lines (with or without line
+terminators), the new version of the file.  Returns (LINES, WARNINGS), the
+converted lines and the warnings, as from Converter.convert_lines().'''
+    old = self.source
+    oldsegs = self.segments
+    if source != old or not oldsegs:
+      self.segments = self._convert(old, oldsegs, source)
+      self.source = source
+    else:
+      self.reused = len(oldsegs)
+      self.converted = 0
+    lines = []
+    warnings = []
+    for seg in self.segments:
+      lines += seg.lines
+      warnings += seg.warnings
+    return (lines, warnings)
+
+  def _convert(self, old, oldsegs, source):
+    # Find the unchanged lines at the beginning and the end
+    n = min(len(old), len(source))
+    prefix = 0
+    while prefix < n and old[prefix] == source[prefix]:
+      prefix += 1
+    suffix = 0
+    while suffix < n - prefix and old[-1 - suffix] == source[-1 - suffix]:
+      suffix += 1
+    shift = len(source) - len(old)
+    # Keep the old segments that end before the first changed line.  (How a
+    # segment is ended depends on the line after it.)
+    k = 0
+    while k < len(oldsegs) and oldsegs[k].start + oldsegs[k].size < prefix:
+      k += 1
+    segments = oldsegs[:k]
+    # Old segments in the unchanged part at the end, by where they start in
+    # SOURCE.  If we get to one of these in the same state as before, it and
+    # the ones after it can be reused.
+    resync = {}
+    for m in xrange(len(oldsegs) - 1, k - 1, -1):
+      seg = oldsegs[m]
+      if seg.start + shift < len(source) - suffix:
+        break
+      if shift and seg.mentions_lines():
+        break
+      resync[seg.start + shift] = m
+    if k < len(oldsegs):
+      start = oldsegs[k].start
+      state = oldsegs[k].state
+    else:
+      start = 0
+      state = None
+    self.reused = k
+    self.converted = 0
+    conv = self.converter
+    conv.restart(state)
+    state = conv.top_level_state()
+    i = start
+    while i < len(source):
+      line = source[i]
+      if i > start and conv.at_top_level(line):
+        (lines, warnings, nextstate) = conv.end_top_level(line)
+        segments.append(Segment(start, i - start, state, lines, warnings))
+        self.converted += 1
+        m = resync.get(i)
+        # (The line numbers in the state don't matter, see
+        # Converter.carried_state)
+        if m is not None and oldsegs[m].state[2:] == nextstate[2:]:
+          segments += [seg.shifted(shift) for seg in oldsegs[m:]]
+          self.reused += len(oldsegs) - m
+          return segments
+        start = i
+        state = nextstate
+        conv.restart(state)
+      conv._process_line(line)
+      i += 1
+    segments.append(Segment(start, i - start, state,
+                            conv.ready + list(conv.lines), conv.warnings))
+    self.converted += 1
+    return segments
+
+###########################################################################
+#
+# Conversion cache
+#
+###########################################################################
+
+# Split the contents of a source file into lines, the way iterating over the
+# file would (i.e. only at newlines), but without the newlines.  The contents
+# can be given as bytes, to be decoded by decode_source(), or as text.
+def split_lines(data):
+  lines = decode_source(data).split('\n')
+  if lines[-1] == '':
+    lines.pop()
+  return lines
+
+# Age in seconds after which ConversionCache.evict() takes a temporary file
+# in the cache to have been left by a process that died while writing it,
+# rather than to be still being written
+stale_tmp_seconds = 3600
+
+class ConversionCache(object):
+  '''A persistent cache of conversions, stored in the directory DIRECTORY.
+Entries are keyed on a hash of the source text, the effective conversion
+options and the version of this program, and hold the converted lines and the
+warnings.  Looking up an entry marks it as recently used; evict() removes the
+least recently used entries until the cache fits in MAXSIZE bytes.  Several
+processes can safely share the same cache.'''
+
+  def __init__(self, directory, maxsize):
+    self.directory = directory
+    self.maxsize = maxsize
+
+  def key(self, data, options, symbols=None):
+    '''Return the cache key for converting the source text DATA using
+OPTIONS, and if given, what the SymbolIndex says about DATA (see
+SymbolIndex.facts()).'''
+    h = hashlib.sha1()
+    h.update(encode_output("%s\0%r\0" % (__version__, option_key(options))))
+    # The entries hold text, which is bytes on Python 2 but not on Python 3
+    if py3:
+      h.update(b"py3\0")
+    user_rules = rules_key(options)[1]
+    if user_rules:
+      h.update(encode_output("%r\0" % (user_rules,)))
+    max_logical_lines = getattr(options, 'max_logical_lines', None)
+    if max_logical_lines:
+      h.update(encode_output("max_logical_lines=%d\0" % max_logical_lines))
+    if symbols is not None:
+      h.update(encode_output("%s\0" % symbols))
+    h.update(data)
+    return h.hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self.directory, key[0:2], key)
+
+  def get(self, key):
+    '''Return the cached (LINES, WARNINGS) for KEY, or None.'''
+    path = self._path(key)
+    try:
+      f = open(path, "rb")
+      try:
+        entry = pickle.load(f)
+      finally:
+        f.close()
+      # The modification time records when the entry was last used
+      os.utime(path, None)
+    except (IOError, OSError):
+      return None
+    except Exception:
+      # Truncated or otherwise corrupt entry; treat as missing
+      return None
+    return entry
+
+  def put(self, key, lines, warnings):
+    '''Store the converted LINES and WARNINGS under KEY.'''
+    path = self._path(key)
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+      try:
+        os.makedirs(dirname)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+    # Write to a temporary file and rename it into place, so readers in other
+    # processes never see a partial entry.  evict() leaves it alone.
+    (fd, tmppath) = tempfile.mkstemp(dir=dirname, prefix=".tmp")
+    f = os.fdopen(fd, "wb")
+    try:
+      pickle.dump((lines, warnings), f, pickle.HIGHEST_PROTOCOL)
+    finally:
+      f.close()
+    os.rename(tmppath, path)
+
+  def evict(self):
+    '''Remove the least recently used entries until the total size of the
+cache is no more than its maximum size.  Temporary files that put() may
+still be writing in another process are left alone, unless they are older
+than stale_tmp_seconds.'''
+    entries = []
+    total = 0
+    now = time.time()
+    for (dirpath, dirnames, filenames) in os.walk(self.directory):
+      for filename in filenames:
+        path = os.path.join(dirpath, filename)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        if (filename.startswith(".tmp") and
+            now - st.st_mtime < stale_tmp_seconds):
+          continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    if total <= self.maxsize:
+      return
+    entries.sort()
+    for (mtime, size, path) in entries:
+      if total <= self.maxsize:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      total -= size
+
+###########################################################################
+#
+# Project symbol index
+#
+###########################################################################
+
+class SymbolScanner(Converter):
+  '''A Converter that notes the classes defined in the source it converts,
+for SymbolIndex: for each class, its base classes, and how many times each
+of its class variables and self.* attributes is assigned, and which of the
+attributes are assigned in __init__() (and so get declared there).
+Assignments to a class variable through the name of a class, like
+`Foo.count += 1', are counted too.  The output of the conversion isn't
+used.  After a conversion, `facts' holds what was found, as a dict with
+`classes', mapping the name of each class to a dict with `bases' (a list of
+names), `classvars' and `attrs' (dicts mapping each name to its count) and
+`initattrs' (a list of names); and `refs', mapping a class name to a dict
+of the counts of the variables assigned through it.  A modifying assignment
+(e.g. +=) counts as two, since it needs a var as much as two assignments
+do.'''
+
+  # RE matching an assignment through a class name, e.g. `Foo.count += 1'
+  classrefre = re.compile(r'\s*([A-Z][a-zA-Z_0-9]*)\.([a-zA-Z_][a-zA-Z_0-9]*)(\s*[+\-*/]?=)(?!=)')
+
+  # RE matching a Python class statement, with the base classes
+  classre = re.compile(r'\s*class\s+[a-zA-Z_0-9]+\s*\((.*)\)\s*:\s*$', re.S)
+
+  def __init__(self, options=None):
+    Converter.__init__(self, options)
+    self.memo = None
+    self.facts = {'classes': {}, 'refs': {}}
+
+  def _class_facts(self, name):
+    classes = self.facts['classes']
+    if name not in classes:
+      classes[name] = {'bases': [], 'classvars': {}, 'attrs': {},
+                       'initattrs': []}
+    return classes[name]
+
+  def _note_define(self):
+    count = len(self.defs)
+    Converter._note_define(self)
+    if len(self.defs) > count and self.defs[-1].ty == 'class':
+      facts = self._class_facts(self.defs[-1].name)
+      m = self.classre.match(self.bigline)
+      if m:
+        for base in m.group(1).split(','):
+          # Leave out keyword arguments (e.g. metaclass=) and `object', and
+          # go by the last part of a dotted name
+          base = base.strip().split('.')[-1]
+          if (base and '=' not in base and base != 'object' and
+              base not in facts['bases']):
+            facts['bases'].append(base)
+
+  def _track_variables(self):
+    if '=' in self.old_bigline:
+      self._note_assignment()
+    Converter._track_variables(self)
+
+  # Count the assignment in the logical line, if any.
+  def _note_assignment(self):
+    dd = self.defs[-1]
+    classdef = None
+    for define in reversed(self.defs):
+      if define.ty == 'class':
+        classdef = define
+        break
+    varname = self.statement.target
+    if varname is not None:
+      count = self.statement.operator == '=' and 1 or 2
+      if varname.startswith('self.'):
+        if classdef:
+          facts = self._class_facts(classdef.name)
+          attr = varname[5:]
+          facts['attrs'][attr] = facts['attrs'].get(attr, 0) + count
+          if (dd.ty == 'def' and dd.name == '__init__' and
+              attr not in facts['initattrs']):
+            facts['initattrs'].append(attr)
+      elif varname.startswith('cls.'):
+        if classdef:
+          classvars = self._class_facts(classdef.name)['classvars']
+          varname = varname[4:]
+          classvars[varname] = classvars.get(varname, 0) + count
+      elif dd.ty == 'class':
+        classvars = self._class_facts(dd.name)['classvars']
+        classvars[varname] = classvars.get(varname, 0) + count
+      return
+    m = self.classrefre.match(self.old_bigline)
+    if m:
+      (classname, varname, eq) = m.groups()
+      count = eq.strip() == '=' and 1 or 2
+      refs = self.facts['refs'].setdefault(classname, {})
+      refs[varname] = refs.get(varname, 0) + count
+
+# Return the SymbolScanner facts (see there) for DATA, the contents of a
+# source file, using OPTIONS.
+def scan_symbols(options, data):
+  scanner = SymbolScanner(options)
+  for line in scanner.convert_lines(split_lines(data)):
+    pass
+  return scanner.facts
+
+# Scan one file for SymbolIndex.update().  TASK is (OPTIONS, NAME, PATH,
+# DATA, DIGEST), where DATA is the contents of the file, or None to read them
+# from PATH, and DIGEST is the hash of the contents when last scanned.
+# Returns (NAME, NEWDIGEST, FACTS, ERROR), where FACTS is None if the
+# contents haven't changed, and ERROR is None or a description of why the
+# file couldn't be scanned.  Runs in a worker process, so errors are
+# returned rather than raised.
+def scan_symbols_task(task):
+  (options, name, path, data, digest) = task
+  try:
+    if data is None:
+      data = read_file(path)
+    newdigest = hashlib.sha1(data).hexdigest()
+    if newdigest == digest:
+      return (name, newdigest, None, None)
+    return (name, newdigest, scan_symbols(options, data), None)
+  except Exception as e:
+    return (name, None, None, "%s: %s" % (type(e).__name__, e))
+
+# The facts about a class in a SymbolIndex, merged over all the classes of
+# the same name in the files indexed.  See SymbolScanner.
+class ClassSymbols(object):
+  def __init__(self):
+    self.bases = []
+    # Number of assignments to each class variable and self.* attribute
+    self.classvars = {}
+    self.attrs = {}
+    # Attributes assigned in __init__()
+    self.initattrs = set()
+    # Names of the classes that have this one as a base
+    self.subclasses = set()
+
+class SymbolIndex(object):
+  '''A project-wide index of the classes defined in a set of source files,
+kept in the file PATH, for deciding between val and var for class variables
+and self.* attributes that may be assigned in other files (e.g. in a
+subclass), and for not declaring again in a subclass an attribute that a
+base class declares.  Classes are identified by name only, so classes of the
+same name in different files are taken to be the same.  The facts about
+each file are found by SymbolScanner and stored with a hash of the file's
+contents, so that update() only scans the files that have changed.  OPTIONS
+are the conversion options; the index is only valid for the same setting of
+-s (--scala), which changes how lines are split, and is rebuilt if that
+changes.'''
+
+  def __init__(self, path, options=None):
+    self.path = path
+    self.options = options
+    self.scala = option_key(options)[0]
+    # (DIGEST, FACTS) for each file indexed, by name
+    self.files = {}
+    # Number of files scanned by the last update()
+    self.scanned = 0
+    try:
+      f = open(path, "rb")
+      try:
+        stored = pickle.load(f)
+      finally:
+        f.close()
+      if (stored['version'] == __version__ and
+          stored['scala'] == self.scala):
+        self.files = stored['files']
+    except (IOError, OSError):
+      pass
+    except Exception:
+      # Truncated or otherwise corrupt; start again
+      pass
+    self._merge()
+
+  def update(self, sources, jobs=None):
+    '''Bring the index up to date with SOURCES, a list of (NAME, PATH, DATA)
+for each file, where DATA is the contents of the file, or None to read them
+from PATH.  Files not in SOURCES are dropped from the index, and those whose
+contents have changed are scanned again, using JOBS worker processes (default
+one per CPU).  Returns a list of (NAME, ERROR) for the files that couldn't be
+read or scanned, which are left out of the index.'''
+    if jobs is None:
+      jobs = multiprocessing.cpu_count()
+    tasks = [(self.options, name, path, data,
+              self.files.get(name, (None, None))[0])
+             for (name, path, data) in sources]
+    pool = None
+    if jobs <= 1 or len(tasks) <= 1:
+      results = imap(scan_symbols_task, tasks)
+    else:
+      pool = multiprocessing.Pool(jobs)
+      chunksize = max(1, min(32, len(tasks) // (jobs * 8)))
+      results = pool.imap(scan_symbols_task, tasks, chunksize)
+    files = {}
+    errors = []
+    self.scanned = 0
+    for (name, digest, facts, error) in results:
+      if error:
+        errors.append((name, error))
+      elif facts is None:
+        files[name] = self.files[name]
+      else:
+        files[name] = (digest, facts)
+        self.scanned += 1
+    if pool:
+      pool.close()
+      pool.join()
+    self.files = files
+    self._merge()
+    return errors
+
+  def save(self):
+    '''Write the index to its file.'''
+    dirname = os.path.dirname(os.path.abspath(self.path))
+    # Write to a temporary file and rename it into place, so that the index
+    # is never left half written
+    (fd, tmppath) = tempfile.mkstemp(dir=dirname, prefix=".tmp")
+    f = os.fdopen(fd, "wb")
+    try:
+      pickle.dump({'version': __version__, 'scala': self.scala,
+                   'files': self.files}, f, pickle.HIGHEST_PROTOCOL)
+    finally:
+      f.close()
+    os.rename(tmppath, self.path)
+
+  # Merge the facts about the files into `classes', a ClassSymbols for each
+  # class name, and note the classes each file defines in `file_classes',
+  # by the hash of its contents.
+  def _merge(self):
+    self.classes = {}
+    self.file_classes = {}
+    def get(name):
+      if name not in self.classes:
+        self.classes[name] = ClassSymbols()
+      return self.classes[name]
+    for name in sorted(self.files):
+      (digest, facts) = self.files[name]
+      self.file_classes[digest] = sorted(facts['classes'])
+      for (classname, classfacts) in facts['classes'].items():
+        info = get(classname)
+        for base in classfacts['bases']:
+          if base not in info.bases:
+            info.bases.append(base)
+          get(base).subclasses.add(classname)
+        for (varname, count) in classfacts['classvars'].items():
+          info.classvars[varname] = info.classvars.get(varname, 0) + count
+        for (attr, count) in classfacts['attrs'].items():
+          info.attrs[attr] = info.attrs.get(attr, 0) + count
+        info.initattrs.update(classfacts['initattrs'])
+    # Assignments through class names count against the class variables
+    for name in sorted(self.files):
+      for (classname, refs) in self.files[name][1]['refs'].items():
+        if classname in self.classes:
+          classvars = self.classes[classname].classvars
+          for (varname, count) in refs.items():
+            classvars[varname] = classvars.get(varname, 0) + count
+    h = hashlib.sha1()
+    for name in sorted(self.files):
+      h.update(encode_output("%s\0%s\0" % (name, self.files[name][0])))
+    self.digest = h.hexdigest()
+
+  # Return the names of the classes related to the class NAME through
+  # ATTR ('bases' or 'subclasses'), transitively, nearest first.
+  def _related(self, name, attr):
+    result = []
+    seen = set([name])
+    todo = [name]
+    while todo:
+      info = self.classes.get(todo.pop(0))
+      if info is None:
+        continue
+      for other in sorted(getattr(info, attr)):
+        if other not in seen:
+          seen.add(other)
+          result.append(other)
+          todo.append(other)
+    return result
+
+  def attribute_inherited(self, classname, attr):
+    '''Whether a base class of the class CLASSNAME declares the self.*
+attribute ATTR (i.e. assigns it in __init__()).'''
+    return any(attr in self.classes[base].initattrs
+               for base in self._related(classname, 'bases')
+               if base in self.classes)
+
+  def attribute_reassigned(self, classname, attr):
+    '''Whether the self.* attribute ATTR of the class CLASSNAME is assigned
+more than once, counting assignments in the class declaring it (the
+furthest base class assigning it in __init__(), or else CLASSNAME) and in
+all of that class's subclasses.'''
+    top = classname
+    for base in self._related(classname, 'bases'):
+      if base in self.classes and attr in self.classes[base].initattrs:
+        top = base
+    count = 0
+    for name in [top] + self._related(top, 'subclasses'):
+      if name in self.classes:
+        count += self.classes[name].attrs.get(attr, 0)
+    return count > 1
+
+  def class_var_reassigned(self, classname, varname):
+    '''Whether the class variable VARNAME of the class CLASSNAME is assigned
+more than once.'''
+    info = self.classes.get(classname)
+    return info is not None and info.classvars.get(varname, 0) > 1
+
+  def facts(self, data):
+    '''Return a string summing up what the index tells a conversion of
+DATA, the contents of a source file: for each class the file defines, which
+of its attributes are inherited or reassigned, and which of its class
+variables are reassigned.  For a file not in the index, this covers the
+whole index.  Part of the cache key of conversions using the index.'''
+    names = self.file_classes.get(hashlib.sha1(data).hexdigest())
+    if names is None:
+      return self.digest
+    summary = []
+    for name in names:
+      info = self.classes[name]
+      summary.append((name,
+        [(attr, self.attribute_inherited(name, attr),
+          self.attribute_reassigned(name, attr))
+         for attr in sorted(info.attrs)],
+        [(varname, self.class_var_reassigned(name, varname))
+         for varname in sorted(info.classvars)]))
+    return repr(summary)
+
+# Return the SymbolIndex in the file PATH, brought up to date with the
+# files given by OPTIONS and ARGS (the tree or archive in options.tree, or
+# the FILEs in ARGS), using options.jobs worker processes.  Files that can't
+# be scanned are reported to stderr and left out.
+def build_symbol_index(path, options, args):
+  index = SymbolIndex(path, options)
+  if options.tree and archive_type(options.tree) is not False:
+    sources = [(name, None, data)
+               for (name, data) in archive_sources(options.tree)]
+  elif options.tree:
+    sources = [(os.path.relpath(srcpath, options.tree), srcpath, None)
+               for (srcpath, _) in tree_files(options.tree, options.tree)]
+  else:
+    sources = [(srcpath, srcpath, None) for srcpath in args]
+  for (name, error) in index.update(sources, options.jobs):
+    errprint("%s: Error: %s" % (name, error))
+  index.save()
+  return index
+
+###########################################################################
+#
+# Input and output
+#
+###########################################################################
+
+# Size of the blocks that big files are read in, in bytes.  Files smaller
+# than this are read in one go.  Stdin and pipes are read in blocks of at
+# most this size, but as soon as there is anything to read.
+io_block_size = 1024 * 1024
+
+# Number of lines written at a time by write_chunked()
+io_chunk_lines = 8192
+
+# Yield the lines of the data returned by READ(SIZE) (e.g. the read() method
+# of a file or mmap object) without line terminators, the way split_lines()
+# would, but reading it up to io_block_size bytes at a time.  READ can
+# return less (as a pipe does), and only returns nothing at the end.
+def block_lines(read):
+  # The pieces of the line not ended yet, which can be many for a long line
+  # coming in through a pipe, so they are only joined at its end
+  rest = []
+  while True:
+    block = decode_source(read(io_block_size))
+    if not block:
+      break
+    lines = block.split('\n')
+    if len(lines) == 1:
+      rest.append(block)
+      continue
+    rest.append(lines[0])
+    lines[0] = ''.join(rest)
+    rest = [lines.pop()]
+    for line in lines:
+      yield line
+  rest = ''.join(rest)
+  if rest:
+    yield rest
+
+# Return a function like the read() method of the file INFILE (a pipe,
+# terminal or the like), but returning whatever can be read without waiting
+# for more, rather than waiting until it has as much as was asked for.
+def partial_reader(infile):
+  read1 = getattr(infile, 'read1', None)
+  if read1:
+    return read1
+  fd = infile.fileno()
+  return lambda size: os.read(fd, size)
+
+# Return whether the file INFILE is a regular file (rather than a pipe,
+# terminal or the like).
+def is_regular_file(infile):
+  try:
+    return stat.S_ISREG(os.fstat(infile.fileno()).st_mode)
+  except (AttributeError, IOError, OSError, ValueError):
+    # Not a real file at all (e.g. a StringIO)
+    return True
+
+# Return the contents of the file PATH.
+def read_file(path):
+  infile = open(path, "rb")
+  try:
+    return infile.read()
+  finally:
+    infile.close()
+
+def read_source(path):
+  '''Yield the lines of the file PATH ('-' for stdin), without line
+terminators.  Small files are read in one go; bigger ones are mapped into
+memory with mmap and split a block at a time, so they are never copied
+whole.  Stdin and other files that can't be mapped are read as their data
+comes in, so that conversion can start before the end.'''
+  if path == '-':
+    for line in block_lines(partial_reader(binary_stream(sys.stdin))):
+      yield line
+    return
+  infile = open(path, 'rb')
+  try:
+    st = os.fstat(infile.fileno())
+    if not stat.S_ISREG(st.st_mode):
+      lines = block_lines(partial_reader(infile))
+    elif st.st_size < io_block_size:
+      lines = split_lines(infile.read())
+    else:
+      mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+      lines = block_lines(mapped.read)
+    for line in lines:
+      yield line
+  finally:
+    infile.close()
+
+def write_chunked(outfile, lines):
+  '''Write LINES (an iterable of lines without line terminators) to the file
+OUTFILE, each followed by a newline, io_chunk_lines lines at a time.'''
+  lines = iter(lines)
+  while True:
+    chunk = list(itertools.islice(lines, io_chunk_lines))
+    if not chunk:
+      break
+    chunk.append('')
+    outfile.write('\n'.join(chunk))
+
+def write_output(outfile, lines):
+  '''Write LINES to OUTFILE as write_chunked() does if it is a regular file.
+Otherwise (e.g. stdout being a pipe or terminal) write each line as soon as
+LINES yields it, so that whatever reads it gets the output of a long
+conversion as it goes.'''
+  if is_regular_file(outfile):
+    write_chunked(outfile, lines)
+    return
+  for line in lines:
+    outfile.write(line + '\n')
+    outfile.flush()
+
+# Suffixes of the archives that --tree can read and --out can write, with
+# the compression tarfile uses for writing them (None for zip files)
+archive_suffixes = [('.tar', ''), ('.tar.gz', 'gz'), ('.tgz', 'gz'),
+                    ('.tar.bz2', 'bz2'), ('.tbz2', 'bz2'), ('.zip', None)]
+
+# Return the tarfile compression for writing the archive PATH (None for a
+# zip file), or False if PATH isn't an archive.
+def archive_type(path):
+  for (suffix, compression) in archive_suffixes:
+    if path.lower().endswith(suffix):
+      return compression
+  return False
+
+def archive_sources(path):
+  '''Yield (NAME, DATA) for each Python file in the archive PATH (a zip
+file, or a tar file, compressed or not), in the order they are stored in
+it.  Tar files are read sequentially, without seeking, so they can be
+compressed with anything tarfile handles.'''
+  if archive_type(path) is None:
+    archive = zipfile.ZipFile(path)
+    try:
+      for info in archive.infolist():
+        if info.filename.endswith('.py'):
+          yield (checked_name(path, info.filename), archive.read(info))
+    finally:
+      archive.close()
+  else:
+    archive = tarfile.open(path, 'r|*')
+    try:
+      for member in archive:
+        if member.isfile() and member.name.endswith('.py'):
+          yield (checked_name(path, member.name),
+                 archive.extractfile(member).read())
+    finally:
+      archive.close()
+
+# Return NAME, the name of a file in the archive PATH, normalized (e.g.
+# without a leading "./"), if it is safe to use as part of an output path,
+# i.e. it stays inside the output tree; otherwise raise an IOError.
+def checked_name(path, name):
+  normname = posixpath.normpath(name)
+  if normname.startswith('/') or '..' in normname.split('/'):
+    raise IOError("unsafe file name %s in %s" % (name, path))
+  return normname
+
+class ArchiveWriter(object):
+  '''A new archive PATH, of the type given by its suffix (see
+archive_suffixes), to which files are added by write().  Tar files are
+written sequentially, as a stream.'''
+
+  def __init__(self, path):
+    self.compression = archive_type(path)
+    if self.compression is None:
+      self.archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED,
+                                     allowZip64=True)
+    else:
+      self.archive = tarfile.open(path, 'w|' + self.compression)
+
+  def write(self, name, lines):
+    '''Add the file NAME to the archive, with the lines LINES (without line
+terminators).'''
+    data = encode_output(''.join(line + '\n' for line in lines))
+    now = time.time()
+    if self.compression is None:
+      info = zipfile.ZipInfo(name, time.localtime(now)[:6])
+      info.compress_type = zipfile.ZIP_DEFLATED
+      info.external_attr = 0o644 << 16
+      self.archive.writestr(info, data)
+    else:
+      info = tarfile.TarInfo(name)
+      info.size = len(data)
+      info.mtime = now
+      info.mode = 0o644
+      self.archive.addfile(info, io.BytesIO(data))
+
+  def close(self):
+    self.archive.close()
+
+class DirectoryWriter(object):
+  '''Like ArchiveWriter, but writing the files to the directory tree PATH,
+creating directories as needed.'''
+
+  def __init__(self, path):
+    self.path = path
+
+  def write(self, name, lines):
+    write_lines(os.path.join(self.path, name), lines)
+
+  def close(self):
+    pass
+
+# Return an ArchiveWriter or DirectoryWriter writing to PATH, depending on
+# whether it is an archive or a directory.
+def tree_writer(path):
+  if archive_type(path) is False:
+    return DirectoryWriter(path)
+  return ArchiveWriter(path)
+
+###########################################################################
+#
+# Batch conversion of source trees
+#
+###########################################################################
+
+# Return a list of (SRCPATH, DSTPATH) for all Python files in the directory
+# tree SRC, in sorted order.  DSTPATH is the corresponding .scala file in
+# the directory tree DST.
+def tree_files(src, dst):
+  files = []
+  for (dirpath, dirnames, filenames) in os.walk(src):
+    dirnames.sort()
+    for filename in sorted(filenames):
+      if filename.endswith('.py'):
+        srcpath = os.path.join(dirpath, filename)
+        relpath = os.path.relpath(srcpath, src)
+        files.append((srcpath, os.path.join(dst, relpath[:-3] + '.scala')))
+  return files
+
+# Converters used by convert_lines_cached(), indexed by rules_key().  Each
+# worker process in a batch run gets its own set.
+file_converters = {}
+
+# The SymbolIndex used by convert_lines_cached(), if any
+symbol_index = None
+
+# Make convert_lines_cached() use the SymbolIndex INDEX (or none if None).
+# Also the initializer of the worker processes of a batch run.
+def use_symbol_index(index):
+  global symbol_index
+  symbol_index = index
+
+# Return a copy of OPTIONS with the options of -2 (--second-pass) turned on,
+# for the second pass of --both-passes.
+def second_pass_options(options):
+  options = copy.copy(options)
+  options.second_pass = True
+  options.scala = True
+  options.remove_self = True
+  options.convert_brackets = True
+  return options
+
+# Return the converter for OPTIONS kept in file_converters, set to the
+# --max-logical-lines of OPTIONS and to use the symbol index given to
+# use_symbol_index(), except for second passes, since it describes the Python
+# source.
+def file_converter(options):
+  key = rules_key(options)
+  converter = file_converters.get(key)
+  if converter is None:
+    converter = file_converters[key] = Converter(options)
+  converter.max_logical_lines = getattr(options, 'max_logical_lines', None)
+  converter.symbols = None
+  if not is_second_pass(options):
+    converter.symbols = symbol_index
+  return converter
+
+# Convert LINES (a list of lines without line terminators, whose contents
+# are DATA) using OPTIONS, with a converter kept from earlier conversions.
+# If CACHE (a ConversionCache) is given, reuse a cached conversion if there
+# is one, and otherwise add this one.  DATA is only needed for the cache.
+# If POOL (a multiprocessing pool) is given and LINES are more than the
+# `shard_lines' attribute of OPTIONS, they are converted in shards by its
+# workers (see convert_sharded()).  Returns (OUTLINES, WARNINGS).
+def convert_lines_cached(options, lines, data=None, cache=None, pool=None):
+  converter = file_converter(options)
+  symbols = converter.symbols
+  if cache:
+    cachekey = cache.key(data, options, symbols and symbols.facts(data))
+    entry = cache.get(cachekey)
+    if entry:
+      return entry
+  shard_lines = getattr(options, 'shard_lines', None)
+  if pool and shard_lines and len(lines) > shard_lines:
+    (outlines, warnings) = convert_sharded(options, lines, pool, shard_lines)
+  else:
+    outlines = list(converter.convert_lines(lines))
+    warnings = converter.warnings
+  if cache:
+    cache.put(cachekey, outlines, warnings)
+  return (outlines, warnings)
+
+# Write LINES to the file PATH, one per line, creating its directory if
+# needed.
+def write_lines(path, lines):
+  dirname = os.path.dirname(path)
+  if dirname and not os.path.isdir(dirname):
+    try:
+      os.makedirs(dirname)
+    except OSError:
+      # Another worker may have created it in the meantime
+      if not os.path.isdir(dirname):
+        raise
+  outfile = open_output(path)
+  try:
+    write_chunked(outfile, lines)
+  finally:
+    outfile.close()
+
+def convert_file(options, srcpath, dstpath, cache=None, pass2path=None,
+                 pool=None):
+  '''Convert the Python file SRCPATH to Scala using OPTIONS, writing the
+result to DSTPATH and creating its directory if needed.  If PASS2PATH is
+given, also run a second pass (as with -2) over the result, writing that to
+PASS2PATH; this is the same as converting DSTPATH again with -2, but the
+first-pass output is handed over in memory.  If CACHE (a ConversionCache) is
+given, reuse cached conversions where possible, and otherwise add them.
+POOL is as for convert_source().  Returns a list of (PATH, WARNINGS) for
+the files converted (SRCPATH, then DSTPATH if there was a second pass), where
+WARNINGS is a list of (LINENO, TEXT) tuples.'''
+  passes = convert_source(options, read_file(srcpath), cache,
+                          bool(pass2path), pool)
+  write_lines(dstpath, passes[0][0])
+  results = [(srcpath, passes[0][1])]
+  if pass2path:
+    write_lines(pass2path, passes[1][0])
+    results.append((dstpath, passes[1][1]))
+  return results
+
+def convert_source(options, data, cache=None, second_pass=False, pool=None):
+  '''Convert DATA, the contents of a Python source file, using OPTIONS, and
+if SECOND_PASS, also run a second pass (as with -2) over the result.  CACHE
+is used as for convert_file().  If POOL, a multiprocessing pool, is given,
+a big file is split into shards converted by its workers (see --shard-lines).
+Returns a list of (OUTLINES, WARNINGS) for each pass.'''
+  (outlines, warnings) = convert_lines_cached(options, split_lines(data),
+                                              data, cache, pool)
+  results = [(outlines, warnings)]
+  if second_pass:
+    data = None
+    if cache:
+      data = encode_output(''.join(line + "\n" for line in outlines))
+    results.append(convert_lines_cached(second_pass_options(options),
+                                        outlines, data, cache, pool))
+  return results
+
+# Convert one file for convert_tree().  TASK is the arguments to
+# convert_file(), up to POOL if given.
+# Returns (WARNINGS, ERROR), where WARNINGS is what convert_file() returns and
+# ERROR is None or a description of why the conversion failed.  Usually runs
+# in a worker process, so errors are returned rather than raised, and don't
+# stop the rest of the batch.
+def convert_tree_task(task):
+  try:
+    return (convert_file(*task), None)
+  except Exception as e:
+    return ([], "%s: %s" % (type(e).__name__, e))
+
+# Return the name of the --both-passes output file for the first-pass output
+# file PATH, e.g. foo.pass2.scala for foo.scala.
+def pass2_path(path):
+  return os.path.splitext(path)[0] + '.pass2.scala'
+
+def convert_tree(options, src, dst, jobs=None, cache=None, both_passes=False):
+  '''Convert every Python file in the directory tree SRC to a Scala file
+in the directory tree DST, using OPTIONS.  Each file is converted from a
+fresh state.  If BOTH_PASSES, also write the result of a second pass over
+each output file (see convert_file()), as foo.pass2.scala next to foo.scala.
+JOBS is the number of worker processes (default: one per CPU).  CACHE, if
+given, is a ConversionCache to use.  Warnings and errors are printed to
+stderr, in file order.  Returns the number of files that could not be
+converted.'''
+  if archive_type(src) is not False or archive_type(dst) is not False:
+    return convert_archive_tree(options, src, dst, jobs, cache, both_passes)
+  tasks = [(options, srcpath, dstpath, cache,
+            both_passes and pass2_path(dstpath) or None)
+           for (srcpath, dstpath) in tree_files(src, dst)]
+  return convert_tasks(tasks, jobs, cache)
+
+# Amount of source convert_archive_tree() hands to the workers at a time,
+# in bytes
+archive_batch_size = 64 * 1024 * 1024
+
+# Convert one file for convert_archive_tree().  TASK is (OPTIONS, NAME,
+# DATA, CACHE, BOTH_PASSES), NAME being the name of the file in the source
+# tree and DATA its contents.
+# Returns (OUTPUTS, WARNINGS, ERROR), where OUTPUTS is a list of (NAME,
+# LINES) for the files to write to the output tree, WARNINGS is the warnings
+# of each pass, and ERROR is as for convert_tree_task().
+def convert_archive_task(task):
+  (options, name, data, cache, both_passes) = task
+  try:
+    passes = convert_source(options, data, cache, both_passes)
+  except Exception as e:
+    return ([], [], "%s: %s" % (type(e).__name__, e))
+  dstname = name[:-3] + '.scala'
+  outputs = [(dstname, passes[0][0])]
+  if both_passes:
+    outputs.append((pass2_path(dstname), passes[1][0]))
+  return (outputs, [warnings for (lines, warnings) in passes], None)
+
+def convert_archive_tree(options, src, dst, jobs=None, cache=None,
+                         both_passes=False):
+  '''Like convert_tree(), but where SRC or DST (or both) is an archive
+rather than a directory (see archive_suffixes), so that nothing needs to be
+unpacked to disk.  The files are read in the main process, in the order they
+are stored, and handed to the workers in batches of about archive_batch_size
+bytes, with the results written to DST as each batch finishes; so memory use
+is bounded however big the archive is.'''
+  if jobs is None:
+    jobs = multiprocessing.cpu_count()
+  if archive_type(src) is False:
+    sources = ((os.path.relpath(srcpath, src), read_file(srcpath))
+               for (srcpath, _) in tree_files(src, src))
+  else:
+    sources = archive_sources(src)
+  writer = tree_writer(dst)
+  pool = None
+  if jobs > 1:
+    pool = multiprocessing.Pool(jobs, use_symbol_index, (symbol_index,))
+  failures = [0]
+  def convert_batch(tasks):
+    if pool:
+      chunksize = max(1, min(32, len(tasks) // (jobs * 8)))
+      results = pool.imap(convert_archive_task, tasks, chunksize)
+    else:
+      results = imap(convert_archive_task, tasks)
+    for (task, (outputs, warnings, error)) in izip(tasks, results):
+      for (name, lines) in outputs:
+        writer.write(name, lines)
+      name = task[1]
+      paths = [os.path.join(src, name),
+               os.path.join(dst, name[:-3] + '.scala')]
+      for (path, passwarnings) in zip(paths, warnings):
+        for (lineno, text) in passwarnings:
+          errprint("%s: Warning: %d: %s" % (path, lineno, text))
+      if error:
+        errprint("%s: Error: %s" % (paths[0], error))
+        failures[0] += 1
+  try:
+    tasks = []
+    size = 0
+    for (name, data) in sources:
+      tasks.append((options, name, data, cache, both_passes))
+      size += len(data)
+      if size >= archive_batch_size:
+        convert_batch(tasks)
+        tasks = []
+        size = 0
+    if tasks:
+      convert_batch(tasks)
+  finally:
+    writer.close()
+    if pool:
+      pool.close()
+      pool.join()
+  if cache:
+    cache.evict()
+  return failures[0]
+
+# Run the convert_file() calls in TASKS (a list of argument tuples) for
+# convert_tree(), using JOBS worker processes.  With --shard-lines, files
+# likely to have more lines than that (see likely_more_lines()) are
+# converted in this process, in shards converted by the workers in between
+# the other files, or whole if they turn out to have fewer lines.
+def convert_tasks(tasks, jobs=None, cache=None):
+  if jobs is None:
+    jobs = multiprocessing.cpu_count()
+  sharded = set()
+  shard_lines = tasks and getattr(tasks[0][0], 'shard_lines', None)
+  if shard_lines and jobs > 1:
+    sharded = set(i for (i, task) in enumerate(tasks)
+                  if likely_more_lines(task[1], shard_lines))
+  pool = None
+  if jobs <= 1 or (len(tasks) <= 1 and not sharded):
+    results = imap(convert_tree_task, tasks)
+  else:
+    pool = multiprocessing.Pool(jobs, use_symbol_index, (symbol_index,))
+    # imap() returns results in task order, so the output is deterministic.
+    # Hand out tasks in small chunks to cut down on IPC without letting one
+    # worker get stuck with all the big files.
+    others = [task for (i, task) in enumerate(tasks) if i not in sharded]
+    chunksize = max(1, min(32, len(others) // (jobs * 8)))
+    results = pool.imap(convert_tree_task, others, chunksize)
+    if sharded:
+      results = sharded_results(tasks, sharded, results, pool)
+  failures = 0
+  for (task, (fileresults, error)) in izip(tasks, results):
+    for (path, warnings) in fileresults:
+      for (lineno, text) in warnings:
+        errprint("%s: Warning: %d: %s" % (path, lineno, text))
+    if error:
+      errprint("%s: Error: %s" % (task[1], error))
+      failures += 1
+  if pool:
+    pool.close()
+    pool.join()
+  if cache:
+    cache.evict()
+  return failures
+
+# Yield the results of convert_tree_task() for TASKS, taking those of the
+# tasks not in the set of indexes SHARDED from the iterator RESULTS, and
+# running the others here with the multiprocessing pool POOL.
+def sharded_results(tasks, sharded, results, pool):
+  for (i, task) in enumerate(tasks):
+    if i in sharded:
+      yield convert_tree_task(task + (pool,))
+    else:
+      yield next(results)
+
+###########################################################################
+#
+# Sharded conversion
+#
+###########################################################################
+
+# RE matching a line that counts as blank or comment-only for
+# Converter.blank_or_comment_line_count
+blank_or_comment_re = re.compile('^ *(#.*|//.*)?$')
+
+# Return the indexes of the lines of LINES at which to split them into
+# shards of at least SIZE lines, beginning with 0, lexing them with the
+# regexps in RULES.  A shard begins at a line that isn't indented, after a
+# blank line, with no parens or brackets, multi-line quote, continued line
+# or passthru section open; convert_sharded() makes sure the line really
+# begins a top-level block.
+def shard_starts(rules, lines, size):
+  starts = [0]
+  # Whether the next line begins outside everything
+  clear = True
+  depth = 0
+  lastdepth = 0
+  for (i, (line, kind, splitline, newdepth, at_rest)) in enumerate(
+      lex_lines(rules, lines)):
+    if (clear and i - starts[-1] >= size and
+        line[:1] not in ('', ' ', '\t') and '!!PY2SCALA: ' not in line and
+        not lines[i - 1].strip()):
+      starts.append(i)
+    # Converter._process_split_line() forgets unmatched right parens
+    depth = max(depth + newdepth - lastdepth, 0)
+    lastdepth = newdepth
+    clear = at_rest and depth == 0
+  return starts
+
+# Return the likely conversion state (see Converter.top_level_state()) at
+# line START of LINES, a line beginning a top-level block after a blank
+# line, going by the lines before it.  The guess is wrong only for unusual
+# input (e.g. blank lines continued with a backslash), which
+# convert_sharded() notices.
+def guess_shard_state(lines, start):
+  i = start
+  blank_or_comment = lambda k: blank_or_comment_re.match(
+    lines[k].rstrip("\r\n").expandtabs())
+  while i > 0 and blank_or_comment(i - 1):
+    i -= 1
+  count = start - i
+  prevcount = 0
+  if i > 0:
+    j = i - 1
+    while j > 0 and blank_or_comment(j - 1):
+      j -= 1
+    prevcount = i - 1 - j
+  indent = 0
+  for k in xrange(start - 1, -1, -1):
+    line = lines[k].rstrip("\r\n").expandtabs()
+    if line.strip(' '):
+      indent = len(line) - len(line.lstrip(' '))
+      break
+  return (start, start, indent, indent, count, prevcount, prevcount)
+
+# Convert one shard for convert_sharded().  TASK is (OPTIONS, LINES, STATE,
+# NEXTLINE): the lines of the shard, the state to begin in and the line
+# after the shard, or None for the last.
+# Returns (OK, LINES, WARNINGS, STATE), as from Converter.end_top_level(),
+# where OK is whether NEXTLINE begins a top-level block (otherwise the rest
+# is None).  If the conversion fails, OK is false too: the shard may not
+# really have begun in STATE, and converting it in the right one will tell.
+def convert_shard_task(task):
+  (options, lines, state, nextline) = task
+  converter = file_converter(options)
+  converter.restart(state)
+  try:
+    for line in lines:
+      converter._process_line(line)
+  except Exception:
+    return (False, None, None, None)
+  if nextline is None:
+    return (True, converter.ready + list(converter.lines), converter.warnings,
+            None)
+  if not converter.at_top_level(nextline):
+    return (False, None, None, None)
+  return (True,) + converter.end_top_level(nextline)
+
+def convert_sharded(options, lines, pool, size, warnfile=None):
+  '''Convert LINES (a list of source lines, with or without line
+terminators) using OPTIONS, split into shards of at least SIZE lines that
+are converted in parallel by the worker processes of the multiprocessing
+POOL.  Returns (OUTLINES, WARNINGS), exactly as converting LINES with
+Converter.convert_lines() would give them.  If WARNFILE is given, the
+warnings are also printed there as they become known, as a Converter does,
+so that those before an error in the conversion aren't lost.
+
+A shard begins at a line that begins a top-level block (see
+Converter.at_top_level()), where the only conversion state that carries
+over is a few numbers, which are guessed from the lines before it.  As the
+results come in, each shard is checked to have begun in the state the one
+before it ended in, and to have ended at a top-level line; where that isn't
+so, conversion carries on in this process from the end of the last good
+shard, up to the next shard boundary where it can stop.'''
+  starts = shard_starts(get_rules(options), lines, size)
+  ends = starts[1:] + [len(lines)]
+  states = [None] + [guess_shard_state(lines, start) for start in starts[1:]]
+  tasks = [(options, lines[start:end], state,
+            end < len(lines) and lines[end] or None)
+           for (start, end, state) in zip(starts, ends, states)]
+  outlines = []
+  warnings = []
+  state = None
+  # Whether converter is converting in this process, from an earlier shard
+  # whose result was unusable
+  converter = None
+  converting = False
+  try:
+    for (task, result) in izip(tasks, pool.imap(convert_shard_task, tasks)):
+      (ok, shardlines, shardwarnings, endstate) = result
+      if not converting:
+        if ok and state == task[2]:
+          outlines += shardlines
+          warnings += shardwarnings
+          if warnfile:
+            for (lineno, text) in shardwarnings:
+              uniprint("Warning: %d: %s" % (lineno, text), outfile=warnfile)
+          state = endstate
+          continue
+        # This converter prints its own warnings
+        converter = converter or file_converter(options)
+        converter.warnfile = warnfile
+        converter.restart(state)
+        converting = True
+      for line in task[1]:
+        converter._process_line(line)
+      nextline = task[3]
+      if nextline is None:
+        outlines += converter.ready + list(converter.lines)
+        warnings += converter.warnings
+      elif converter.at_top_level(nextline):
+        (shardlines, shardwarnings, state) = converter.end_top_level(nextline)
+        outlines += shardlines
+        warnings += shardwarnings
+        converting = False
+  finally:
+    # The converter is kept for other files
+    if converter:
+      converter.warnfile = None
+  return (outlines, warnings)
+
+# Average size of a source line in bytes, counting its terminator (about 35
+# in the standard library), for guessing the number of lines of a file
+average_line_bytes = 35
+
+# Whether the source file PATH likely has more than SIZE lines, going by its
+# size, so that it needn't be read an extra time to count them.
+def likely_more_lines(path, size):
+  return os.path.getsize(path) > size * average_line_bytes
+
+###########################################################################
+#
+# Checking for files that conversion would change
+#
+###########################################################################
+
+# Return the index of the first line at which OUTLINES (an iterable of
+# converted lines) differs from LINES, or None if they are the same.  No
+# more lines are taken from OUTLINES once one differs, so if it is a
+# Converter.convert_lines() generator, the rest of the file isn't
+# converted.
+def first_change(lines, outlines):
+  for (i, (line, outline)) in enumerate(izip_longest(lines, outlines)):
+    if line != outline:
+      return i
+  return None
+
+# Value of Converter.flush_lines for check_lines().  The converter yields
+# its lines only at the flushes, so flushing more often than for converting
+# finds a change sooner, at little cost.
+check_flush_lines = 16
+
+# Return the index of the first of LINES (a list of lines without line
+# terminators, whose contents are DATA) that converting them using OPTIONS
+# would change, or None if the conversion would leave them as they are.
+# The converted lines are compared as the converter yields them, and it is
+# stopped at the first difference.  If CACHE (a ConversionCache) is given, a
+# cached conversion is compared instead if there is one, and lines that
+# convert to themselves are added to it, so that checking them again takes a
+# lookup.  DATA is only needed for the cache.
+def check_lines(options, lines, data=None, cache=None):
+  converter = file_converter(options)
+  symbols = converter.symbols
+  if cache:
+    cachekey = cache.key(data, options, symbols and symbols.facts(data))
+    entry = cache.get(cachekey)
+    if entry:
+      return first_change(lines, entry[0])
+  converter.flush_lines = check_flush_lines
+  try:
+    change = first_change(lines, converter.convert_lines(lines))
+  finally:
+    del converter.flush_lines
+  if cache and change is None:
+    cache.put(cachekey, lines, converter.warnings)
+  return change
+
+# Check one file for check_files().  TASK is (OPTIONS, PATH, DATA, CACHE),
+# where DATA is the contents of the file PATH, or None to read it.
+# Returns (CHANGE, ERROR), where CHANGE is what check_lines() returns, and
+# ERROR is as for convert_tree_task().
+def check_task(task):
+  (options, path, data, cache) = task
+  try:
+    if data is None:
+      data = read_file(path)
+    return (check_lines(options, split_lines(data), data, cache), None)
+  except Exception as e:
+    return (None, "%s: %s" % (type(e).__name__, e))
+
+def check_files(options, sources, jobs=None, cache=None, outfile=sys.stdout):
+  '''Check whether converting each of SOURCES, an iterable of (PATH, DATA)
+where DATA is the contents of the file PATH or None to read it, using OPTIONS
+would change it, and for each that it would, print PATH:LINE to OUTFILE,
+LINE being the first line that would change.  Nothing is written, and the
+conversion of a file stops at its first change.  Files are spread across
+JOBS worker processes (default: one per CPU) and reported in order; CACHE is
+as for check_lines().  Errors are printed to stderr.  Returns a tuple
+(CHANGED, FAILURES) of the number of files that would change and that could
+not be checked.'''
+  if jobs is None:
+    jobs = multiprocessing.cpu_count()
+  pool = None
+  if jobs > 1:
+    pool = multiprocessing.Pool(jobs, use_symbol_index, (symbol_index,))
+  counts = [0, 0]
+  def check_batch(tasks):
+    if pool:
+      chunksize = max(1, min(32, len(tasks) // (jobs * 8)))
+      results = pool.imap(check_task, tasks, chunksize)
+    else:
+      results = imap(check_task, tasks)
+    for (task, (change, error)) in izip(tasks, results):
+      if error:
+        errprint("%s: Error: %s" % (task[1], error))
+        counts[1] += 1
+      elif change is not None:
+        uniprint("%s:%d: would be changed" % (task[1], change + 1),
+                 outfile=outfile)
+        counts[0] += 1
+  try:
+    # The contents of archive members are handed to the workers in batches,
+    # as in convert_archive_tree()
+    tasks = []
+    size = 0
+    for (path, data) in sources:
+      tasks.append((options, path, data, cache))
+      size += len(data or '')
+      if size >= archive_batch_size:
+        check_batch(tasks)
+        tasks = []
+        size = 0
+    if tasks:
+      check_batch(tasks)
+  finally:
+    if pool:
+      pool.close()
+      pool.join()
+  if cache:
+    cache.evict()
+  return tuple(counts)
+
+# Return the (PATH, DATA) of the files to check for check_files(): those of
+# the --tree SRC if given, else the FILEs in ARGS (stdin if none).  DATA is
+# None for files the workers read themselves.
+def check_sources(src, args):
+  if src and archive_type(src) is not False:
+    return ((os.path.join(src, name), data)
+            for (name, data) in archive_sources(src))
+  if src:
+    return ((srcpath, None) for (srcpath, _) in tree_files(src, src))
+  return [(path, None) if path != '-' else
+          ('<stdin>', binary_stream(sys.stdin).read())
+          for path in args or ['-']]
+
+###########################################################################
+#
+# Watch mode
+#
+###########################################################################
+
+# Return the name of the output file for the source file SRCPATH, given as a
+# FILE argument with --both-passes or --watch: foo.py -> foo.scala.
+def file_output_path(srcpath):
+  dstpath = os.path.splitext(srcpath)[0] + '.scala'
+  if dstpath == srcpath:
+    parser.error("output file for %s would overwrite it" % srcpath)
+  return dstpath
+
+class WatchedFile(object):
+  '''A source file watched by --watch.  SRCPATH is converted using OPTIONS
+and written to DSTPATH, and if PASS2PATH is given, a second pass over the
+result (see convert_file()) is written there.  Conversions are done with
+IncrementalConverters, so only what changed is reconverted.'''
+
+  def __init__(self, options, srcpath, dstpath, pass2path=None):
+    self.srcpath = srcpath
+    self.dstpath = dstpath
+    self.pass2path = pass2path
+    self.converter = IncrementalConverter(options)
+    self.pass2converter = None
+    if pass2path:
+      self.pass2converter = IncrementalConverter(second_pass_options(options))
+    # (mtime, size) of the source when last converted
+    self.stamp = None
+
+  def poll(self):
+    '''If the source file has changed (going by its modification time and
+size) since it was last converted, convert it again, printing any warnings to
+stderr.  Returns whether it was converted.'''
+    try:
+      st = os.stat(self.srcpath)
+    except OSError:
+      # Possibly being replaced by an editor; try again next time
+      return False
+    stamp = (st.st_mtime, st.st_size)
+    if stamp == self.stamp:
+      return False
+    self.stamp = stamp
+    infile = open(self.srcpath, "rb")
+    try:
+      data = infile.read()
+    finally:
+      infile.close()
+    start = time.time()
+    (lines, warnings) = self.converter.convert(split_lines(data))
+    reused = self.converter.reused
+    total = reused + self.converter.converted
+    results = [(self.srcpath, warnings)]
+    write_lines(self.dstpath, lines)
+    if self.pass2path:
+      (lines, warnings) = self.pass2converter.convert(lines)
+      reused += self.pass2converter.reused
+      total += self.pass2converter.reused + self.pass2converter.converted
+      results.append((self.dstpath, warnings))
+      write_lines(self.pass2path, lines)
+    for (path, warnings) in results:
+      for (lineno, text) in warnings:
+        errprint("%s: Warning: %d: %s" % (path, lineno, text))
+    errprint("%s: Converted in %.1f ms, reusing %d of %d blocks" %
+             (self.srcpath, (time.time() - start) * 1000, reused, total))
+    return True
+
+def watch(options, args, interval):
+  '''Convert the files given by OPTIONS and ARGS (either the tree in
+options.tree, or the FILEs in ARGS), as for --tree or --both-passes, and then
+keep checking them every INTERVAL seconds, reconverting the ones that change.
+With --tree, new files in the tree are picked up too.  Never returns.'''
+  watched = {}
+  while True:
+    if options.tree:
+      files = tree_files(options.tree, options.out)
+    else:
+      files = [(srcpath, file_output_path(srcpath)) for srcpath in args]
+    for (srcpath, dstpath) in files:
+      wfile = watched.get(srcpath)
+      if wfile is None:
+        pass2path = options.both_passes and pass2_path(dstpath) or None
+        wfile = watched[srcpath] = WatchedFile(options, srcpath, dstpath,
+                                               pass2path)
+      try:
+        wfile.poll()
+      except (IOError, OSError) as e:
+        errprint("%s: Error: %s" % (srcpath, e))
+      except Exception as e:
+        # A file the conversion trips up on shouldn't stop the watching of
+        # the others; it is tried again when it next changes
+        errprint("%s: Error: %s: %s" % (srcpath, type(e).__name__, e))
+    time.sleep(interval)
+
+###########################################################################
+#
+# Server mode
+#
+###########################################################################
+
+# The conversion options a --server request can give, all false by default.
+# These are the ones that affect the output; see option_key().
+server_options = ('scala', 'remove_self', 'convert_brackets', 'second_pass')
+
+# Source converted with each option set when a server worker starts, so that
+# the regexps compiled on first use (by the re module as well as RuleSets)
+# are ready before the first request.
+warm_up_source = '''\
+class Warm(object):
+  def go(self, a, b=None):
+    """Doc."""
+    if a is not None and not b:
+      x = [len(y) for y in a if y in b]
+    elif lambda z: z:
+      x = a[0] % 2
+    else:
+      pass
+    for y in a:
+      while True:
+        try:
+          x += 1
+        except ValueError as e:
+          break
+        finally:
+          self.v = 'ab'
+    return x
+'''
+
+# Initializer of the server's worker processes: convert warm_up_source with
+# each option set, keeping the converters for convert_lines_cached().
+# DEFAULTS is as for serve_request(), so that the converters are the ones the
+# requests use, with the server's user-defined rules.
+def warm_up(defaults=None):
+  lines = split_lines(warm_up_source)
+  for values in itertools.product((False, True), repeat=3):
+    values = dict(defaults or {}, **dict(zip(server_options, values)))
+    convert_lines_cached(optparse.Values(values), lines)
+
+# Carry out the --server request REQUEST (a dict decoded from JSON) in a
+# worker process.  DEFAULTS is a dict of the values of the options in
+# server_options for those not given in the request.  CACHE is a
+# ConversionCache to use, if given.  Returns the response as a dict.  Errors
+# are returned in the response rather than raised, so that a bad request
+# doesn't stop the server.
+def serve_request(request, defaults, cache=None):
+  response = {'id': request.get('id')}
+  try:
+    opts = request.get('options', {})
+    if not isinstance(opts, dict):
+      raise ValueError("options must be an object")
+    values = dict(defaults)
+    for (name, value) in opts.items():
+      if name not in server_options:
+        raise ValueError("unknown option %s" % name)
+      values[name] = bool(value)
+    options = optparse.Values(values)
+    if ('source' in request) == ('path' in request):
+      raise ValueError("exactly one of source and path must be given")
+    if 'source' in request:
+      data = request['source']
+      if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    else:
+      infile = open(request['path'], 'rb')
+      try:
+        data = infile.read()
+      finally:
+        infile.close()
+    (lines, warnings) = convert_lines_cached(options, split_lines(data),
+                                             data, cache)
+    output = encode_output(''.join(line + '\n' for line in lines))
+    try:
+      response['output'] = output.decode('utf-8')
+    except UnicodeDecodeError:
+      # Pass the bytes through as Latin-1, from which the client can get
+      # them back exactly
+      response['output'] = output.decode('latin-1')
+      response['encoding'] = 'latin-1'
+    response['warnings'] = [{'line': lineno, 'message': json_text(text)}
+                            for (lineno, text) in warnings]
+  except Exception as e:
+    response['error'] = "%s: %s" % (type(e).__name__, e)
+  return response
+
+class ConversionServer(object):
+  '''Carries out --server conversion requests in a pool of JOBS worker
+processes (default one per CPU), each keeping a warm Converter for each
+option set.  Requests not giving an option get its value in OPTIONS.
+CACHE, if given, is a ConversionCache to use.'''
+
+  def __init__(self, options=None, jobs=None, cache=None):
+    self.defaults = dict(zip(server_options, option_key(options)))
+    # User-defined rules and --max-logical-lines apply to all requests
+    self.defaults['user_rules'] = rules_key(options)[1]
+    self.defaults['max_logical_lines'] = getattr(options,
+                                                 'max_logical_lines', None)
+    self.cache = cache
+    # Compile all the RuleSets before the workers are forked, so that they
+    # all share them
+    for values in itertools.product((False, True), repeat=3):
+      values = dict(zip(server_options, values))
+      values['user_rules'] = self.defaults['user_rules']
+      get_rules(optparse.Values(values))
+    self.pool = multiprocessing.Pool(jobs, warm_up, (self.defaults,))
+
+  def submit(self, line, respond):
+    '''Start carrying out the request in LINE, a line of JSON, calling
+RESPOND with the response (a dict) when it is done, from another thread.'''
+    try:
+      request = json.loads(line)
+      if not isinstance(request, dict):
+        raise ValueError("request must be an object")
+    except ValueError as e:
+      respond({'id': None, 'error': "Bad request: %s" % e})
+      return
+    self.pool.apply_async(serve_request,
+                          (request, self.defaults, self.cache),
+                          callback=respond)
+
+  def serve(self, infile, outfile):
+    '''Read requests from INFILE, one per line, and write each response to
+OUTFILE as a line of JSON as soon as it is ready, until the end of INFILE,
+and then wait for all the responses.  Responses come in the order the
+requests finish, which needn't be the order they came in.  INFILE and
+OUTFILE are binary files (e.g. sys.stdin.buffer on Python 3).'''
+    lock = threading.Condition()
+    # Requests not yet responded to; a list so respond() can change it
+    pending = [0]
+    def respond(response):
+      text = json.dumps(response, sort_keys=True)
+      lock.acquire()
+      try:
+        try:
+          outfile.write((text + '\n').encode('ascii'))
+          outfile.flush()
+        except (IOError, socket.error):
+          # The client went away; nothing to do but drop the response
+          pass
+        pending[0] -= 1
+        lock.notify()
+      finally:
+        lock.release()
+    # Not `for line in infile', which reads ahead and so would wait for
+    # more requests before starting the ones already received
+    for line in iter(infile.readline, b''):
+      if not line.strip():
+        continue
+      lock.acquire()
+      pending[0] += 1
+      lock.release()
+      self.submit(line, respond)
+    lock.acquire()
+    try:
+      while pending[0]:
+        lock.wait()
+    finally:
+      lock.release()
+
+  def serve_socket(self, path):
+    '''Listen on the Unix domain socket PATH, serving each connection as
+serve() does, several at once.  Never returns.'''
+    server = self
+    class Handler(SocketServer.StreamRequestHandler):
+      def handle(self):
+        server.serve(self.rfile, self.wfile)
+    # Remove the socket left by an earlier server that was killed
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+      os.unlink(path)
+    listener = SocketServer.ThreadingUnixStreamServer(path, Handler)
+    listener.daemon_threads = True
+    try:
+      listener.serve_forever()
+    finally:
+      listener.server_close()
+      os.unlink(path)
+
+  def close(self):
+    '''Shut down the worker processes.'''
+    self.pool.close()
+    self.pool.join()
+    if self.cache:
+      self.cache.evict()
+
+################# Main loop
+
+def main(argv=None):
+  set_up_std_streams()
+  (options, args) = parse_args(argv)
+  if options.rule_file:
+    try:
+      options.user_rules = load_rule_files(options.rule_file)
+    except (IOError, ValueError) as e:
+      errprint("Error: %s" % e)
+      sys.exit(1)
+  if options.trace_log:
+    options.trace_rules = True
+  for (name, given) in [('--profile-stages', options.profile_stages),
+                        ('--trace-rules', options.trace_rules),
+                        ('--rewrite-stats', options.rewrite_stats)]:
+    if given and (options.tree or options.out or options.watch or
+                  options.both_passes or options.server):
+      parser.error("%s only works when writing to stdout" % name)
+  if len([given for given in [options.profile_stages, options.trace_rules,
+                              options.rewrite_stats] if given]) > 1:
+    parser.error("only one of --profile-stages, --trace-rules and "
+                 "--rewrite-stats can be used at a time")
+  cache = None
+  if options.cache_dir:
+    cache = ConversionCache(options.cache_dir,
+                            options.cache_size * 1024 * 1024)
+  if options.check:
+    if (options.out or options.server or options.watch or
+        options.both_passes or options.shard_lines or
+        options.profile_stages or options.trace_rules or
+        options.rewrite_stats):
+      parser.error("--check doesn't work with --out, --server, --watch, "
+                   "--both-passes, --shard-lines, --profile-stages, "
+                   "--trace-rules or --rewrite-stats")
+  if options.tree or options.out:
+    if not (options.tree and (options.out or options.check)):
+      parser.error("--tree and --out must be given together")
+    if args:
+      parser.error("FILE arguments can't be used with --tree")
+  if options.socket and not options.server:
+    parser.error("--socket only works with --server")
+  if options.shard_lines is not None:
+    if options.shard_lines < 1:
+      parser.error("--shard-lines must be at least 1")
+    if (options.server or options.watch or options.profile_stages or
+        options.trace_rules or options.rewrite_stats):
+      parser.error("--shard-lines doesn't work with --server, --watch, "
+                   "--profile-stages, --trace-rules or --rewrite-stats")
+  if options.symbol_index:
+    if options.server or options.watch:
+      parser.error("--symbol-index doesn't work with --server or --watch")
+    if not (options.tree or args) or '-' in args:
+      parser.error("--symbol-index needs --tree or FILE arguments")
+    try:
+      use_symbol_index(build_symbol_index(options.symbol_index, options,
+                                          args))
+    except (IOError, OSError, tarfile.TarError, zipfile.BadZipfile) as e:
+      errprint("Error: %s" % e)
+      sys.exit(1)
+  if options.check:
+    try:
+      (changed, failures) = check_files(options,
+                                        check_sources(options.tree, args),
+                                        options.jobs, cache)
+    except (IOError, OSError, tarfile.TarError, zipfile.BadZipfile) as e:
+      errprint("Error: %s" % e)
+      sys.exit(1)
+    if changed or failures:
+      sys.exit(1)
+    return
+  if options.server:
+    if args or options.tree or options.out or options.watch or \
+       options.both_passes:
+      parser.error("--server takes no FILE arguments, and no --tree, --out, "
+                   "--watch or --both-passes")
+    server = ConversionServer(options, options.jobs, cache)
+    try:
+      if options.socket:
+        server.serve_socket(options.socket)
+      else:
+        server.serve(binary_stream(sys.stdin), binary_stream(sys.stdout))
+    except KeyboardInterrupt:
+      pass
+    server.close()
+    return
+  if options.watch:
+    if options.tree and (archive_type(options.tree) is not False or
+                         archive_type(options.out) is not False):
+      parser.error("--watch doesn't work with archives")
+    if not (options.tree or args):
+      parser.error("--watch needs --tree or FILE arguments")
+    try:
+      watch(options, args, options.watch_interval)
+    except KeyboardInterrupt:
+      return
+  if options.tree:
+    try:
+      failures = convert_tree(options, options.tree, options.out,
+                              options.jobs, cache, options.both_passes)
+    except (IOError, OSError, tarfile.TarError, zipfile.BadZipfile) as e:
+      # Reading or writing an archive failed
+      errprint("Error: %s" % e)
+      sys.exit(1)
+    if failures:
+      sys.exit(1)
+    return
+  if options.both_passes:
+    if not args:
+      parser.error("--both-passes needs --tree or FILE arguments")
+    tasks = []
+    for srcpath in args:
+      dstpath = file_output_path(srcpath)
+      tasks.append((options, srcpath, dstpath, cache, pass2_path(dstpath)))
+    if convert_tasks(tasks, options.jobs, cache):
+      sys.exit(1)
+    return
+  # All lines in stdin or argument(s), read as they are needed
+  sources = [(path == '-' and '<stdin>' or path, read_source(path))
+             for path in args or ['-']]
+  infile = itertools.chain.from_iterable(lines for (name, lines) in sources)
+  if options.shard_lines:
+    infile = list(infile)
+    jobs = options.jobs or multiprocessing.cpu_count()
+    if jobs > 1 and len(infile) > options.shard_lines:
+      pool = multiprocessing.Pool(jobs, use_symbol_index, (symbol_index,))
+      try:
+        (outlines, warnings) = convert_sharded(options, infile, pool,
+                                               options.shard_lines,
+                                               warnfile=sys.stderr)
+      finally:
+        pool.close()
+        pool.join()
+      write_output(sys.stdout, outlines)
+      return
+  logfile = None
+  if options.profile_stages:
+    converter = ProfilingConverter(options, warnfile=sys.stderr)
+    infile = converter.input_files(sources)
+  elif options.trace_rules:
+    if options.trace_log:
+      logfile = open(options.trace_log, 'w')
+    converter = TracingConverter(options, warnfile=sys.stderr,
+                                 logfile=logfile)
+    infile = converter.input_files(sources)
+  elif options.rewrite_stats:
+    converter = RewriteStatsConverter(options, warnfile=sys.stderr)
+    infile = converter.input_files(sources)
   else:
-    add_bigline(bigline)
-  bigline = None
+    converter = Converter(options, warnfile=sys.stderr)
+  if not is_second_pass(options):
+    converter.symbols = symbol_index
+  write_output(sys.stdout, converter.convert_lines(infile))
+  if logfile:
+    logfile.close()
+  if options.profile_stages or options.trace_rules or options.rewrite_stats:
+    sys.stdout.flush()
+    converter.report()
 
-# At the end, output all lines
-for line in lines:
-  print line
+if __name__ == '__main__':
+  main()
 
 # Ignore blank line for purposes of figuring out indentation
 # NOTE: No need to use \s* in these or other regexps because we call